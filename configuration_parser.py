@@ -41,6 +41,8 @@ def _parse_options( options_node ):
     configuration["job_submitter"] = options_node.findtext('JobSubmitter')
     if options_node.find('FilterMatrixFormat'):
         configuration["filter_matrix_format"] = options_node.findtext('FilterMatrixFormat')
+    if options_node.find('Regions') is not None:
+        configuration["regions"] = options_node.findtext('Regions')
 
 def _find_reads( folder, filepath ):
     import os
@@ -292,6 +294,9 @@ def write_config( configuration ):
     if "filter_matrix_format" in configuration:
         node = ElementTree.SubElement(options_node, "FilterMatrixFormat")
         node.text = configuration["filter_matrix_format"]
+    if "regions" in configuration:
+        node = ElementTree.SubElement(options_node, "Regions")
+        node.text = configuration["regions"]
         
     #Create the Files section
     files_node = ElementTree.SubElement(root, "Files")
@@ -99,7 +99,8 @@ def _index_reference( configuration ):
     reference = os.path.join(ref_folder, "reference.fasta")
     if os.path.exists(reference):
         os.remove(reference)
-    index_commands = ["format_fasta.py --inputfasta %s --outputfasta %s" % (ref_path, reference)] 
+    reference_pack = os.path.join(ref_folder, "reference.pack")
+    index_commands = ["format_fasta.py --inputfasta %s --outputfasta %s --outputpack %s" % (ref_path, reference, reference_pack)] 
     
     #Gather all of the index commands that need to be run
     bwa_done = False
@@ -324,7 +325,7 @@ def _run_samtools(nickname, bam_file, snpcaller, samtools, job_submitter, aligne
 def _find_dups( configuration, index_job_id, reference ):
     import os
     (name, path, args, job_parms) = configuration["dup_finder"]
-    command = "find_duplicates.py --nucmerpath %s --reference %s" % (path, reference)
+    command = "find_duplicates.py --nucmerpath %s --reference %s --reference-pack %s" % (path, reference, os.path.splitext(reference)[0] + ".pack")
     work_dir = os.path.dirname(reference)
     if not os.path.exists(work_dir):
         os.makedirs(work_dir)
@@ -428,7 +429,7 @@ def _create_matrices( configuration, reference, dups_file, vcf_files, franken_fa
     output_dir = configuration['output_folder']
     path = configuration["matrix_generator"][1]
     job_parms = configuration["matrix_generator"][3]
-    matrix_parms = {'reference-fasta':reference, 'reference-dups':dups_file}
+    matrix_parms = {'reference-fasta':reference, 'reference-dups':dups_file, 'reference-pack':os.path.splitext(reference)[0] + ".pack"}
     if "coverage_filter" in configuration:
         matrix_parms['minimum-coverage'] = configuration['coverage_filter']
     if "proportion_filter" in configuration:
@@ -439,6 +440,8 @@ def _create_matrices( configuration, reference, dups_file, vcf_files, franken_fa
     matrix_parms['contig-stats'] = os.path.join(output_dir, 'contig_stats.tsv')
     if 'filter_matrix_format' in configuration:
         matrix_parms['filter-matrix-format'] = configuration['filter_matrix_format']
+    if 'regions' in configuration:
+        matrix_parms['regions'] = configuration['regions']
     dto_file = os.path.join(output_dir, "matrix_dto.xml")
     matrix_DTO.write_dto(matrix_parms, franken_fastas, vcf_files, dto_file)
     jobs_to_wait_for = ":".join(job_ids)
@@ -11,6 +11,7 @@ def _parse_args():
     parser = argparse.ArgumentParser( description="Meant to be called from the pipeline automatically." )
     parser.add_argument( "--nucmerpath", default="nucmer", help="Path to the 'nucmer' executable." )
     parser.add_argument( "--reference", required=True, help="Path to the reference fasta file." )
+    parser.add_argument( "--reference-pack", help="Path to the reference genome pack to add the duplicates data to." )
     return parser.parse_args()
 
 # This should eventually be moved to the main job manager section
@@ -57,13 +58,22 @@ def parse_delta_file( delta_filename, dups_data ):
         current_contigs = _parse_delta_line( line_from_delta_file, dups_data, current_contigs )
     delta_handle.close()
 
+def update_genome_pack( pack_path, dups_path ):
+    from nasp_objects import ReferenceGenome
+    reference = ReferenceGenome()
+    reference.import_genome_pack( pack_path, False )
+    reference.import_dups_file( dups_path )
+    reference.write_to_genome_pack( pack_path )
+
 def main():
-    from nasp_objects import GenomeStatus
+    from nasp_objects import GenomeStatus, RunLengthContig
     commandline_args = _parse_args()
     run_nucmer_on_reference( commandline_args.nucmerpath, commandline_args.reference )
-    dups_data = GenomeStatus()
+    dups_data = GenomeStatus( RunLengthContig )
     parse_delta_file( "reference.delta", dups_data )
     dups_data.write_to_fasta_file( "duplicates.txt" )
+    if commandline_args.reference_pack:
+        update_genome_pack( commandline_args.reference_pack, "duplicates.txt" )
 
 if __name__ == "__main__": main()
 
@@ -12,14 +12,17 @@ def _parse_args():
     parser = argparse.ArgumentParser( description="Reformats a fasta to be split 80 characters per line, with system line-endings." )
     parser.add_argument( "--inputfasta", required=True, help="Path to input fasta." )
     parser.add_argument( "--outputfasta", required=True, help="Path to output fasta." )
+    parser.add_argument( "--outputpack", help="Path to an optional binary genome pack to write alongside the output fasta." )
     return parser.parse_args()
 
 def main():
-    from nasp_objects import Genome
+    from nasp_objects import ReferenceGenome
     commandline_args = _parse_args()
-    fasta_data = Genome()
+    fasta_data = ReferenceGenome()
     fasta_data.import_fasta_file( commandline_args.inputfasta )
     fasta_data.write_to_fasta_file( commandline_args.outputfasta )
+    if commandline_args.outputpack:
+        fasta_data.write_to_genome_pack( commandline_args.outputpack )
 
 
 if __name__ == "__main__": main()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+__author__ = "David Smith"
+__version__ = "1"
+__email__ = "dsmith@tgen.org"
+
+import logging
+
+
+def _parse_args():
+    import argparse
+    parser = argparse.ArgumentParser( description="Adds together the statistics snapshots of partial matrix runs, E.G. over separate regions or contigs, and writes their statistics files." )
+    parser.add_argument( "--snapshots", nargs="+", required=True, help="Paths to the statistics snapshots written by vcf_to_matrix.py, in any order." )
+    parser.add_argument( "--general-stats", default="general_stats.tsv", help="Name of general statistics file to create." )
+    parser.add_argument( "--sample-stats", default="sample_stats.tsv", help="Name of sample statistics file to create." )
+    parser.add_argument( "--stats-snapshot", help="Path to a statistics snapshot of the combined runs to write." )
+    return parser.parse_args()
+
+def main():
+    from nasp_objects import CollectionStatistics
+    commandline_args = _parse_args()
+    combined_stats = CollectionStatistics()
+    for snapshot_path in commandline_args.snapshots:
+        combined_stats.merge_stats_snapshot( snapshot_path )
+    combined_stats.write_to_stats_files( commandline_args.general_stats, commandline_args.sample_stats )
+    if commandline_args.stats_snapshot:
+        combined_stats.write_stats_snapshot( commandline_args.stats_snapshot )
+
+
+if __name__ == "__main__": main()
+
@@ -4,21 +4,160 @@ __author__ = "David Smith"
 __version__ = "0.9.6"
 __email__ = "dsmith@tgen.org"
 
+import io
 import logging
 
 
+# Compressed inputs are recognized by their magic bytes rather than their file names. Returns None for plain files,
+# "bgzf" for blocked gzip files, like those made by bgzip, whose blocks can be inflated independently, and "gzip" otherwise.
+def get_input_compression( file_path ):
+    with open( file_path, 'rb' ) as magic_handle:
+        file_header = magic_handle.read( 16 )
+    if file_header[0:2] != b'\x1f\x8b':
+        return None
+    if len( file_header ) == 16 and file_header[3] & 0x04 and file_header[12:14] == b'BC' and file_header[14:16] == b'\x02\x00':
+        return "bgzf"
+    return "gzip"
+
+# Opens an input file for reading whether it is compressed or not. Text modes decode the same way open() would.
+# BGZF input is inflated by a pool of num_threads threads, but cannot seek; pass seekable to get a plain gzip handle instead.
+def open_input_file( file_path, mode = 'rb', num_threads = None, seekable = False ):
+    import gzip
+    input_compression = get_input_compression( file_path )
+    if input_compression is None:
+        return open( file_path, mode )
+    if input_compression == "bgzf" and not seekable:
+        input_handle = io.BufferedReader( BGZFReader( file_path, num_threads ), BGZFReader.BUFFER_SIZE )
+    else:
+        input_handle = gzip.open( file_path, 'rb' )
+    if 'b' not in mode:
+        input_handle = io.TextIOWrapper( input_handle )
+    return input_handle
+
+
+# Raw binary reader for BGZF files. Compressed blocks are read in file order, handed out to a thread pool a batch at a time,
+# and the inflated batches are read back in the same order. zlib releases the GIL while it works, so the threads run in parallel.
+class BGZFReader( io.RawIOBase ):
+
+    BLOCKS_PER_TASK = 16
+    TASKS_PER_THREAD = 4
+    BUFFER_SIZE = 1048576
+
+    def __init__( self, file_path, num_threads = None ):
+        import os
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        super().__init__()
+        self._file_path = file_path
+        self._file_handle = open( file_path, 'rb' )
+        num_threads = num_threads or os.cpu_count() or 1
+        self._max_pending_tasks = num_threads * BGZFReader.TASKS_PER_THREAD
+        self._thread_pool = ThreadPoolExecutor( max_workers = num_threads )
+        self._pending_tasks = deque()
+        self._current_data = memoryview( b'' )
+        self._end_of_file = False
+
+    def readable( self ):
+        return True
+
+    # Returns the compressed data, CRC and inflated size of up to BLOCKS_PER_TASK blocks.
+    def _read_blocks( self ):
+        compressed_blocks = []
+        while len( compressed_blocks ) < BGZFReader.BLOCKS_PER_TASK:
+            block_header = self._file_handle.read( 12 )
+            if not block_header:
+                break
+            if len( block_header ) < 12 or block_header[0:3] != b'\x1f\x8b\x08' or not block_header[3] & 0x04:
+                raise MalformedInputFile( self._file_path, "not a BGZF block at offset {0}".format( self._file_handle.tell() - len( block_header ) ) )
+            extra_length = int.from_bytes( block_header[10:12], 'little' )
+            extra_field = self._file_handle.read( extra_length )
+            block_size = None
+            field_start = 0
+            while field_start + 4 <= len( extra_field ):
+                field_length = int.from_bytes( extra_field[( field_start + 2 ):( field_start + 4 )], 'little' )
+                if extra_field[field_start:( field_start + 2 )] == b'BC' and field_length == 2:
+                    block_size = int.from_bytes( extra_field[( field_start + 4 ):( field_start + 6 )], 'little' ) + 1
+                field_start += 4 + field_length
+            if block_size is None:
+                raise MalformedInputFile( self._file_path, "BGZF block without a block size" )
+            block_data = self._file_handle.read( block_size - 12 - extra_length )
+            if len( block_data ) != block_size - 12 - extra_length:
+                raise MalformedInputFile( self._file_path, "truncated BGZF block" )
+            compressed_blocks.append( ( block_data[:-8], int.from_bytes( block_data[-8:-4], 'little' ), int.from_bytes( block_data[-4:], 'little' ) ) )
+        return compressed_blocks
+
+    @staticmethod
+    def _inflate_blocks( file_path, compressed_blocks ):
+        import zlib
+        inflated_blocks = []
+        for ( compressed_data, block_crc, block_length ) in compressed_blocks:
+            inflated_data = zlib.decompress( compressed_data, -15 )
+            if len( inflated_data ) != block_length or zlib.crc32( inflated_data ) != block_crc:
+                raise MalformedInputFile( file_path, "BGZF block failed its integrity check" )
+            inflated_blocks.append( inflated_data )
+        return b''.join( inflated_blocks )
+
+    def _queue_tasks( self ):
+        while not self._end_of_file and len( self._pending_tasks ) < self._max_pending_tasks:
+            compressed_blocks = self._read_blocks()
+            if compressed_blocks:
+                self._pending_tasks.append( self._thread_pool.submit( BGZFReader._inflate_blocks, self._file_path, compressed_blocks ) )
+            else:
+                self._end_of_file = True
+
+    def readinto( self, read_buffer ):
+        while not self._current_data:
+            self._queue_tasks()
+            if not self._pending_tasks:
+                return 0
+            self._current_data = memoryview( self._pending_tasks.popleft().result() )
+        read_length = min( len( read_buffer ), len( self._current_data ) )
+        read_buffer[:read_length] = self._current_data[:read_length]
+        self._current_data = self._current_data[read_length:]
+        return read_length
+
+    def close( self ):
+        if not self.closed:
+            self._thread_pool.shutdown( wait=True, cancel_futures=True )
+            self._file_handle.close()
+        super().close()
+
+
 class GenomeStatus:
 
     # Arrays are zero-indexed, genome positions are one-indexed. Off-by-one errors? Never heard of 'em.
-    def __init__( self ):
+    # Each contig is a contiguous bytearray holding one byte per position instead of a list of one-character strings.
+    # Mostly-uniform data can use RunLengthContig as the contig type instead, and be made dense again with to_dense().
+    def __init__( self, contig_type = bytearray ):
         self._status_data = {}
         self._current_contig = None
+        self._contig_type = contig_type
+
+    @staticmethod
+    def _encode_data( genome_data ):
+        if isinstance( genome_data, ( bytes, bytearray ) ):
+            return genome_data
+        if isinstance( genome_data, list ):
+            genome_data = ''.join( genome_data )
+        return genome_data.encode( 'latin-1' )
 
     def add_contig( self, contig_name ):
         if contig_name not in self._status_data:
-            self._status_data[contig_name] = []
+            self._status_data[contig_name] = self._contig_type()
         self._current_contig = contig_name
 
+    # Drops the data of a contig, E.G. once it has been written out, so its memory can be reused.
+    def remove_contig( self, contig_name ):
+        self._status_data.pop( contig_name, None )
+        if self._current_contig == contig_name:
+            self._current_contig = None
+
+    def to_dense( self ):
+        for current_contig in self._status_data:
+            if not isinstance( self._status_data[current_contig], bytearray ):
+                self._status_data[current_contig] = bytearray( self._status_data[current_contig][0:len( self._status_data[current_contig] )] )
+        self._contig_type = bytearray
+
     def set_current_contig( self, contig_name, create_contig = True ):
         if contig_name is None:
             contig_name = self._current_contig
@@ -30,67 +169,377 @@ class GenomeStatus:
             raise InvalidContigName( contig_name, self.get_contigs() )
         return contig_name
 
-    def get_contigs( self ):
-        return sorted( self._status_data.keys() )
+    def get_contigs( self, sort_contigs = True ):
+        if sort_contigs:
+            return sorted( self._status_data.keys() )
+        return list( self._status_data.keys() )
 
     def append_contig( self, genome_data, contig_name = None ):
         contig_name = self.set_current_contig( contig_name )
-        self._status_data[contig_name].extend( genome_data )
+        self._status_data[contig_name].extend( GenomeStatus._encode_data( genome_data ) )
 
+    # Also used to preallocate a whole contig in one go when its final length is already known.
     def extend_contig( self, new_length, missing_range_filler, contig_name = None ):
         contig_name = self.set_current_contig( contig_name )
         if len( self._status_data[contig_name] ) < new_length:
-            self._status_data[contig_name].extend( [ missing_range_filler ] * ( new_length - len( self._status_data[contig_name] ) ) )
+            self._status_data[contig_name].extend( GenomeStatus._encode_data( missing_range_filler ) * ( new_length - len( self._status_data[contig_name] ) ) )
 
     def set_value( self, new_data, position_number, missing_range_filler = "!", contig_name = None ):
         contig_name = self.set_current_contig( contig_name )
         self.extend_contig( position_number, missing_range_filler, contig_name )
-        if isinstance( new_data, list ):
-            self._status_data[contig_name][position_number-1:position_number-1+len( new_data )] = new_data
-        else:
-            self._status_data[contig_name][position_number-1] = new_data
+        new_data = GenomeStatus._encode_data( new_data )
+        self._status_data[contig_name][position_number-1:position_number-1+len( new_data )] = new_data
 
     def get_value( self, first_position, last_position = None, contig_name = None, filler_value = None ):
         contig_name = self.set_current_contig( contig_name )
         queried_value = filler_value
         if last_position is None:
             if first_position <= len( self._status_data[contig_name] ):
-                queried_value = self._status_data[contig_name][first_position-1]
+                queried_value = chr( self._status_data[contig_name][first_position-1] )
         else:
             queried_value = []
             if last_position == -1:
                 last_position = len( self._status_data[contig_name] )
             if last_position >= first_position and first_position <= len( self._status_data[contig_name] ):
-                queried_value = self._status_data[contig_name][first_position-1:last_position]
+                queried_value = list( str( self._status_data[contig_name][first_position-1:last_position], 'latin-1' ) )
                 if filler_value is not None and len( queried_value ) < last_position - first_position + 1:
                     queried_value.extend( [ filler_value ] * ( last_position - first_position + 1 - len( queried_value ) ) )
         return queried_value
 
+    # Same as get_value over a range, but returns raw bytes padded out to the full range with the filler.
+    def get_value_block( self, first_position, last_position, contig_name = None, filler_value = "!" ):
+        contig_name = self.set_current_contig( contig_name )
+        value_block = bytes( self._status_data[contig_name][first_position-1:last_position] )
+        if len( value_block ) < last_position - first_position + 1:
+            value_block += GenomeStatus._encode_data( filler_value ) * ( last_position - first_position + 1 - len( value_block ) )
+        return value_block
+
     def get_contig_length( self, contig_name = None ):
         contig_name = self.set_current_contig( contig_name )
         return len( self._status_data[contig_name] )
 
-    def _send_to_fasta_handle( self, output_handle, contig_prefix = "", max_chars_per_line = 80 ):
+    # Number of sequence bytes gathered into each write when sending a contig to a fasta file.
+    FASTA_WRITE_SIZE = 1048576
+
+    # Expects a binary handle. The contig buffer is sliced through a memoryview a batch of lines at a time,
+    # and each batch is joined with the line separator and written in one go instead of one write per line.
+    # A max_chars_per_line of 0 writes each contig on a single line.
+    def _send_to_fasta_handle( self, output_handle, contig_prefix = "", max_chars_per_line = 80, line_separator = b'\n' ):
         for current_contig in self.get_contigs():
-            output_handle.write( ">" + contig_prefix + current_contig + "\n" )
+            output_handle.write( ( ">" + contig_prefix + current_contig ).encode( 'utf-8' ) + line_separator )
+            contig_view = self._status_data[current_contig]
+            # Contig types that are not buffers, like RunLengthContig, hand back bytes when sliced
+            if isinstance( contig_view, ( bytes, bytearray ) ):
+                contig_view = memoryview( contig_view )
             if max_chars_per_line > 0:
-                i = 0
-                while ( max_chars_per_line * i ) < len( self._status_data[current_contig] ):
-                    output_handle.write( ''.join( self._status_data[current_contig][( max_chars_per_line * i ):( max_chars_per_line * ( i + 1 ) )] ) + "\n" )
-                    i = i + 1
+                batch_size = max( GenomeStatus.FASTA_WRITE_SIZE // max_chars_per_line, 1 ) * max_chars_per_line
+                for batch_start in range( 0, len( contig_view ), batch_size ):
+                    batch_data = bytes( contig_view[batch_start:( batch_start + batch_size )] )
+                    output_handle.write( line_separator.join( [ batch_data[line_start:( line_start + max_chars_per_line )] for line_start in range( 0, len( batch_data ), max_chars_per_line ) ] ) + line_separator )
             else:
-                output_handle.write( ''.join( self._status_data[current_contig] + "\n" ) )
+                output_handle.writelines( [ contig_view[0:len( contig_view )], line_separator ] )
+            del contig_view
 
     def write_to_fasta_file( self, output_filename, contig_prefix = "", max_chars_per_line = 80 ):
-        output_handle = open( output_filename, 'w' )
-        self._send_to_fasta_handle( output_handle, contig_prefix, max_chars_per_line )
+        import os
+        output_handle = open( output_filename, 'wb' )
+        self._send_to_fasta_handle( output_handle, contig_prefix, max_chars_per_line, os.linesep.encode( 'ascii' ) )
         output_handle.close()
 
+    # A digest of the contig names and data, E.G. to tell whether results worked out against this genome still hold.
+    def get_content_digest( self ):
+        import hashlib
+        content_hash = hashlib.sha1()
+        for current_contig in self.get_contigs( False ):
+            contig_storage = self._status_data[current_contig]
+            content_hash.update( "{0}\t{1}\n".format( current_contig, len( contig_storage ) ).encode( 'utf-8' ) )
+            for chunk_start in range( 0, len( contig_storage ), GenomeStatus.FASTA_WRITE_SIZE ):
+                content_hash.update( bytes( contig_storage[chunk_start:( chunk_start + GenomeStatus.FASTA_WRITE_SIZE )] ) )
+        return content_hash.hexdigest()
+
+    # Genome packs and track files share a layout: an 8-byte magic string, the version and the length of a JSON table as
+    # 32-bit little-endian integers, the table itself, then, from the next 16-byte boundary, the data section.
+    @staticmethod
+    def _encode_table_header( magic_string, version, table ):
+        import json
+        table_data = json.dumps( table ).encode( 'utf-8' )
+        header_data = magic_string + version.to_bytes( 4, 'little' ) + len( table_data ).to_bytes( 4, 'little' ) + table_data
+        return header_data + b'\0' * ( -len( header_data ) % 16 )
+
+    # Maps such a file read-only and returns its table and a view of its data section.
+    @staticmethod
+    def _map_table_file( filename, magic_string, version, file_description ):
+        import json
+        import mmap
+        with open( filename, 'rb' ) as table_handle:
+            file_map = mmap.mmap( table_handle.fileno(), 0, access=mmap.ACCESS_READ )
+        if file_map[0:8] != magic_string or int.from_bytes( file_map[8:12], 'little' ) != version:
+            raise MalformedInputFile( filename, "not a version {0} {1}".format( version, file_description ) )
+        table_length = int.from_bytes( file_map[12:16], 'little' )
+        table = json.loads( file_map[16:( 16 + table_length )].decode( 'utf-8' ) )
+        data_start = 16 + table_length + ( -( 16 + table_length ) % 16 )
+        return ( table, memoryview( file_map )[data_start:] )
+
+    # A track file holds the contigs of one genome, laid out like a genome pack, so another process can map them
+    # instead of parsing or unpickling them. Dense contigs are stored as their raw bytes, RunLengthContig contigs as
+    # their run ends, 64-bit little-endian integers, followed by their run values. IndexedFastaContig contigs only store
+    # where they are in their fasta file, which gets mapped again on import. Contigs are kept in insertion order.
+    TRACK_FILE_MAGIC = b'NASPTRAK'
+    TRACK_FILE_VERSION = 1
+
+    # Written to a temporary file first and moved into place. track_metadata is stored in the table as is.
+    def write_to_track_file( self, track_filename, track_metadata = None ):
+        import os
+        import sys
+        from array import array
+        contig_table = []
+        contig_data = []
+        data_offset = 0
+        for current_contig in self.get_contigs( False ):
+            contig_storage = self._status_data[current_contig]
+            run_count = None
+            fasta_location = None
+            if isinstance( contig_storage, IndexedFastaContig ):
+                fasta_location = contig_storage.get_fasta_location()
+                contig_storage = b''
+            elif isinstance( contig_storage, RunLengthContig ):
+                run_ends = array( 'q', contig_storage._run_ends )
+                if sys.byteorder != 'little':
+                    run_ends.byteswap()
+                run_count = contig_storage.get_run_count()
+                contig_storage = run_ends.tobytes() + bytes( contig_storage._run_values )
+            elif not isinstance( contig_storage, ( bytes, bytearray, memoryview ) ):
+                contig_storage = contig_storage[0:len( contig_storage )]
+            contig_table.append( { 'name': current_contig, 'offset': data_offset, 'length': len( self._status_data[current_contig] ), 'runs': run_count, 'fasta': fasta_location } )
+            contig_data.append( contig_storage )
+            data_offset += len( contig_storage )
+        temporary_filename = track_filename + ".tmp{0}".format( os.getpid() )
+        with open( temporary_filename, 'wb' ) as track_handle:
+            track_handle.write( GenomeStatus._encode_table_header( GenomeStatus.TRACK_FILE_MAGIC, GenomeStatus.TRACK_FILE_VERSION, { 'contigs': contig_table, 'metadata': track_metadata } ) )
+            track_handle.writelines( contig_data )
+        os.replace( temporary_filename, track_filename )
+
+    # Dense contigs become read-only views of the mapped file. Returns the track metadata.
+    def import_track_file( self, track_filename ):
+        import sys
+        from array import array
+        ( track_table, track_view ) = GenomeStatus._map_table_file( track_filename, GenomeStatus.TRACK_FILE_MAGIC, GenomeStatus.TRACK_FILE_VERSION, "track file" )
+        fasta_maps = {}
+        for contig_entry in track_table['contigs']:
+            contig_start = contig_entry['offset']
+            if contig_entry['fasta'] is not None:
+                ( fasta_filename, data_offset, line_bases, line_width ) = contig_entry['fasta']
+                if fasta_filename not in fasta_maps:
+                    fasta_maps[fasta_filename] = IndexedFastaContig.map_fasta_file( fasta_filename )
+                self._status_data[contig_entry['name']] = IndexedFastaContig( fasta_filename, fasta_maps[fasta_filename], data_offset, contig_entry['length'], line_bases, line_width )
+            elif contig_entry['runs'] is None:
+                self._status_data[contig_entry['name']] = track_view[contig_start:( contig_start + contig_entry['length'] )]
+            else:
+                run_ends = array( 'q' )
+                run_ends.frombytes( track_view[contig_start:( contig_start + contig_entry['runs'] * 8 )] )
+                if sys.byteorder != 'little':
+                    run_ends.byteswap()
+                self._status_data[contig_entry['name']] = RunLengthContig.from_runs( run_ends, track_view[( contig_start + contig_entry['runs'] * 8 ):( contig_start + contig_entry['runs'] * 9 )] )
+            self.add_contig( contig_entry['name'] )
+        return track_table['metadata']
+
+    # Number of bytes read from a fasta-style file at a time.
+    FASTA_READ_SIZE = 16777216
+
+    # Reads a fasta-style file in large binary blocks and yields ( contig_name, sequence_data ) in file order.
+    # contig_name is set when a header starts a new contig, and None when the data continues the current one.
+    # Lines are kept or dropped the same way the old line-at-a-time importer did: headers must carry the contig prefix,
+    # and data lines must be nothing but sequence characters, optionally followed by whitespace.
+    @staticmethod
+    def _read_fasta_file( fasta_filename, contig_prefix, sequence_characters ):
+        import re
+        header_regex = re.compile( r'^>' + re.escape( contig_prefix ) + r'([^\s]+)(?:\s|$)' )
+        data_regex = re.compile( rb'^([' + re.escape( sequence_characters ) + rb']+)\s*$' )
+        # Anything left over after removing these means some line needs a closer look.
+        clean_characters = sequence_characters + b'\n'
+        fasta_handle = open_input_file( fasta_filename )
+        leftover_data = b''
+        next_block = fasta_handle.read( GenomeStatus.FASTA_READ_SIZE )
+        while next_block:
+            fasta_block = leftover_data + next_block
+            next_block = fasta_handle.read( GenomeStatus.FASTA_READ_SIZE )
+            if next_block:
+                # Only hand on whole lines; a \r\n split across blocks just leaves behind an empty line.
+                line_end = max( fasta_block.rfind( b'\n' ), fasta_block.rfind( b'\r' ) ) + 1
+                ( fasta_block, leftover_data ) = ( fasta_block[:line_end], fasta_block[line_end:] )
+            if b'\r' in fasta_block:
+                fasta_block = fasta_block.replace( b'\r\n', b'\n' ).replace( b'\r', b'\n' )
+            fasta_records = ( b'\n' + fasta_block ).split( b'\n>' )
+            for record_number in range( len( fasta_records ) ):
+                contig_name = None
+                sequence_data = fasta_records[record_number]
+                if record_number > 0:
+                    ( header_line, line_break, sequence_data ) = sequence_data.partition( b'\n' )
+                    contig_match = header_regex.match( '>' + header_line.decode( 'utf-8', 'replace' ) )
+                    if contig_match:
+                        contig_name = contig_match.group(1)
+                if sequence_data.translate( None, clean_characters ):
+                    sequence_data = b''.join( data_match.group(1) for data_match in map( data_regex.match, sequence_data.split( b'\n' ) ) if data_match )
+                else:
+                    sequence_data = sequence_data.translate( None, b'\n' )
+                if contig_name is not None or sequence_data:
+                    yield ( contig_name, sequence_data )
+        fasta_handle.close()
+
+
+# Contig storage for data that is mostly long runs of the same value, like the dups track or a VCF that only carries variant sites.
+# Holds a sorted list of run end positions and the value of each run, and behaves like the bytearray GenomeStatus would
+# otherwise use: len(), integer indexing, slicing to bytes, slice assignment and extend().
+class RunLengthContig:
+
+    _RUN_REGEX = None
+
+    def __init__( self, contig_data = b'' ):
+        self._run_ends = []
+        self._run_values = []
+        self.extend( contig_data )
+
+    def __len__( self ):
+        return self._run_ends[-1] if len( self._run_ends ) > 0 else 0
+
+    def get_run_count( self ):
+        return len( self._run_ends )
+
+    @staticmethod
+    def from_runs( run_ends, run_values ):
+        run_contig = RunLengthContig()
+        run_contig._run_ends = list( run_ends )
+        run_contig._run_values = list( run_values )
+        return run_contig
+
+    # Returns ( run_length, value ) pairs for a byte string.
+    @staticmethod
+    def _find_runs( contig_data ):
+        import re
+        if len( contig_data ) == 0:
+            return []
+        if contig_data.count( contig_data[0:1] ) == len( contig_data ):
+            return [ ( len( contig_data ), contig_data[0] ) ]
+        if RunLengthContig._RUN_REGEX is None:
+            RunLengthContig._RUN_REGEX = re.compile( rb'(.)\1*', re.DOTALL )
+        return [ ( run_match.end() - run_match.start(), contig_data[run_match.start()] ) for run_match in RunLengthContig._RUN_REGEX.finditer( contig_data ) ]
+
+    # Makes sure a run starts at the position and returns the index of that run.
+    def _split_at( self, position ):
+        import bisect
+        run_index = bisect.bisect_right( self._run_ends, position )
+        run_start = self._run_ends[run_index-1] if run_index > 0 else 0
+        if run_index < len( self._run_ends ) and run_start != position:
+            self._run_ends.insert( run_index, position )
+            self._run_values.insert( run_index, self._run_values[run_index] )
+            run_index += 1
+        return run_index
+
+    def _merge_at( self, run_index ):
+        if 0 < run_index < len( self._run_ends ) and self._run_values[run_index-1] == self._run_values[run_index]:
+            del self._run_ends[run_index-1]
+            del self._run_values[run_index-1]
+
+    def __getitem__( self, index ):
+        import bisect
+        if isinstance( index, slice ):
+            ( first_index, last_index, step ) = index.indices( len( self ) )
+            if step != 1:
+                return self[first_index:last_index][::step] if last_index > first_index else b''
+            value_pieces = []
+            run_index = bisect.bisect_right( self._run_ends, first_index )
+            while first_index < last_index:
+                run_end = min( self._run_ends[run_index], last_index )
+                value_pieces.append( bytes( ( self._run_values[run_index], ) ) * ( run_end - first_index ) )
+                first_index = run_end
+                run_index += 1
+            return b''.join( value_pieces )
+        if index < 0:
+            index += len( self )
+        if not 0 <= index < len( self ):
+            raise IndexError( "run-length contig index out of range" )
+        return self._run_values[bisect.bisect_right( self._run_ends, index )]
+
+    # Same resizing behaviour as assigning to a bytearray slice.
+    def __setitem__( self, index, new_data ):
+        if not isinstance( index, slice ):
+            if index < 0:
+                index += len( self )
+            if not 0 <= index < len( self ):
+                raise IndexError( "run-length contig index out of range" )
+            ( index, new_data ) = ( slice( index, index + 1 ), bytes( ( new_data, ) ) )
+        ( first_index, last_index, step ) = index.indices( len( self ) )
+        if step != 1:
+            raise ValueError( "run-length contigs only support contiguous slices" )
+        last_index = max( first_index, last_index )
+        first_run = self._split_at( first_index )
+        last_run = self._split_at( last_index )
+        new_runs = RunLengthContig._find_runs( bytes( new_data ) )
+        new_ends = []
+        run_end = first_index
+        for ( run_length, run_value ) in new_runs:
+            run_end += run_length
+            new_ends.append( run_end )
+        size_change = len( new_data ) - ( last_index - first_index )
+        if size_change != 0:
+            self._run_ends[last_run:] = [ old_end + size_change for old_end in self._run_ends[last_run:] ]
+        self._run_ends[first_run:last_run] = new_ends
+        self._run_values[first_run:last_run] = [ run_value for ( run_length, run_value ) in new_runs ]
+        self._merge_at( first_run + len( new_runs ) )
+        self._merge_at( first_run )
+
+    def extend( self, contig_data ):
+        self[len( self ):len( self )] = contig_data
+
+
+# Read-only contig that stays in its fasta file, found through a samtools faidx style index entry: where its first base is,
+# and how many bases and bytes there are per line. Slices read just the lines they cover from the mapped file.
+class IndexedFastaContig:
+
+    def __init__( self, fasta_filename, fasta_data, data_offset, contig_length, line_bases, line_width ):
+        self._fasta_filename = fasta_filename
+        self._fasta_data = fasta_data
+        self._data_offset = data_offset
+        self._contig_length = contig_length
+        self._line_bases = line_bases
+        self._line_width = line_width
+
+    def __len__( self ):
+        return self._contig_length
+
+    # Everything needed to map the contig again in another process.
+    def get_fasta_location( self ):
+        return [ self._fasta_filename, self._data_offset, self._line_bases, self._line_width ]
+
+    @staticmethod
+    def map_fasta_file( fasta_filename ):
+        import mmap
+        with open( fasta_filename, 'rb' ) as fasta_handle:
+            return mmap.mmap( fasta_handle.fileno(), 0, access=mmap.ACCESS_READ )
+
+    def _get_file_offset( self, index ):
+        return self._data_offset + ( index // self._line_bases ) * self._line_width + index % self._line_bases
+
+    def __getitem__( self, index ):
+        if isinstance( index, slice ):
+            ( first_index, last_index, step ) = index.indices( self._contig_length )
+            if last_index <= first_index:
+                return b''
+            contig_data = self._fasta_data[self._get_file_offset( first_index ):( self._get_file_offset( last_index - 1 ) + 1 )]
+            if self._line_width != self._line_bases:
+                contig_data = bytes( contig_data ).translate( None, b'\r\n' )
+            return bytes( contig_data[::step] )
+        if index < 0:
+            index += self._contig_length
+        if not 0 <= index < self._contig_length:
+            raise IndexError( "indexed fasta contig index out of range" )
+        return self._fasta_data[self._get_file_offset( index )]
+
 
 class Genome( GenomeStatus ):
 
-    def __init__( self ):
-        GenomeStatus.__init__( self )
+    def __init__( self, contig_type = bytearray ):
+        GenomeStatus.__init__( self, contig_type )
         self._genome = self._status_data
 
     def set_call( self, new_data, first_position, missing_range_filler = "X", contig_name = None ):
@@ -99,21 +548,107 @@ class Genome( GenomeStatus ):
     def get_call( self, first_position, last_position = None, contig_name = None, filler_value = "X" ):
         return self.get_value( first_position, last_position, contig_name, filler_value )
 
-    def _import_fasta_line( self, line_from_fasta, contig_prefix = "" ):
-        import re
-        contig_match = re.match( r'^>' + re.escape( contig_prefix ) + r'([^\s]+)(?:\s|$)', line_from_fasta )
-        if contig_match:
-            self.add_contig( contig_match.group(1) )
-        else:
-            data_match = re.match( r'^([A-Za-z.-]+)\s*$', line_from_fasta )
-            if data_match:
-                self.append_contig( list( data_match.group(1) ) )
+    def get_call_block( self, first_position, last_position, contig_name = None, filler_value = "X" ):
+        return self.get_value_block( first_position, last_position, contig_name, filler_value )
+
+    # Characters a fasta data line may consist of.
+    FASTA_CHARACTERS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz.-'
 
     def import_fasta_file( self, fasta_filename, contig_prefix = "" ):
-        fasta_handle = open( fasta_filename, 'r' )
-        for line_from_fasta in fasta_handle:
-            self._import_fasta_line( line_from_fasta, contig_prefix )
-        fasta_handle.close()
+        for ( contig_name, sequence_data ) in GenomeStatus._read_fasta_file( fasta_filename, contig_prefix, Genome.FASTA_CHARACTERS ):
+            if contig_name is not None:
+                self.add_contig( contig_name )
+            if sequence_data:
+                self.append_contig( sequence_data )
+
+    # Builds a samtools faidx style index of a fasta file: one ( name, length, offset, line_bases, line_width ) entry per contig,
+    # where offset is that of its first base. Returns None when the file does not fit that layout, E.G. when line lengths vary
+    # within a contig or a line holds anything but sequence characters, as import_fasta_file() would drop such lines.
+    @staticmethod
+    def index_fasta_file( fasta_filename ):
+        import re
+        data_regex = re.compile( rb'^[' + re.escape( Genome.FASTA_CHARACTERS ) + rb']+\r?\n?$' )
+        fasta_index = []
+        contig_names = set()
+        current_entry = None
+        contig_ended = False
+        current_offset = 0
+        with open( fasta_filename, 'rb' ) as fasta_handle:
+            for line_from_fasta in fasta_handle:
+                current_offset += len( line_from_fasta )
+                if line_from_fasta.startswith( b'>' ):
+                    header_words = line_from_fasta[1:].split( None, 1 )
+                    if len( header_words ) == 0 or line_from_fasta[1:2].isspace() or header_words[0] in contig_names:
+                        return None
+                    contig_names.add( header_words[0] )
+                    current_entry = [ header_words[0].decode( 'utf-8', 'replace' ), 0, current_offset, 0, 0 ]
+                    fasta_index.append( current_entry )
+                    contig_ended = False
+                elif line_from_fasta.strip() == b'':
+                    contig_ended = True
+                elif current_entry is None or contig_ended or not data_regex.match( line_from_fasta ):
+                    return None
+                else:
+                    line_bases = len( line_from_fasta.rstrip( b'\r\n' ) )
+                    if current_entry[3] == 0:
+                        ( current_entry[3], current_entry[4] ) = ( line_bases, len( line_from_fasta ) )
+                    elif line_bases > current_entry[3]:
+                        return None
+                    elif line_bases < current_entry[3] or len( line_from_fasta ) != current_entry[4]:
+                        contig_ended = True
+                    current_entry[1] += line_bases
+        return [ tuple( index_entry ) for index_entry in fasta_index ]
+
+    # Reads a .fai index, or returns None if it can not be parsed or has a contig that runs past the end of the fasta
+    # file, E.G. when another run is still writing it or the fasta file was cut short.
+    @staticmethod
+    def _read_fasta_index_file( index_filename, fasta_size ):
+        fasta_index = []
+        try:
+            with open( index_filename, 'r' ) as index_handle:
+                for index_line in index_handle:
+                    index_fields = index_line.rstrip( '\r\n' ).split( '\t' )
+                    index_entry = ( index_fields[0], int( index_fields[1] ), int( index_fields[2] ), int( index_fields[3] ), int( index_fields[4] ) )
+                    ( contig_name, contig_length, data_offset, line_bases, line_width ) = index_entry
+                    if contig_length < 0 or data_offset < 0 or ( contig_length > 0 and ( line_bases <= 0 or line_width < line_bases ) ):
+                        return None
+                    if contig_length > 0 and data_offset + ( ( contig_length - 1 ) // line_bases ) * line_width + ( contig_length - 1 ) % line_bases >= fasta_size:
+                        return None
+                    fasta_index.append( index_entry )
+        except ( OSError, ValueError, IndexError ):
+            return None
+        return fasta_index
+
+    # Reads the .fai index next to a fasta file, E.G. one made by samtools faidx, if it is newer than the fasta file and
+    # usable. Otherwise the index is built in memory; nothing is ever written next to the fasta file. Contig names are
+    # returned without contig_prefix. Returns None when the file can not be used through an index: it is compressed,
+    # fails index_fasta_file(), or has a contig without the prefix.
+    @staticmethod
+    def read_fasta_index( fasta_filename, contig_prefix = "" ):
+        import os
+        if get_input_compression( fasta_filename ) is not None:
+            return None
+        index_filename = fasta_filename + ".fai"
+        fasta_index = None
+        if os.path.exists( index_filename ) and os.path.getmtime( index_filename ) > os.path.getmtime( fasta_filename ):
+            fasta_index = Genome._read_fasta_index_file( index_filename, os.path.getsize( fasta_filename ) )
+        if fasta_index is None:
+            fasta_index = Genome.index_fasta_file( fasta_filename )
+        if fasta_index is None or any( not index_entry[0].startswith( contig_prefix ) for index_entry in fasta_index ):
+            return None
+        return [ ( index_entry[0][len( contig_prefix ):], ) + index_entry[1:] for index_entry in fasta_index ]
+
+    # Leaves the sequence in the fasta file and maps it instead, so only the bytes that get asked for are ever read.
+    # Returns False, without importing anything, when the file can not be used through an index; see read_fasta_index().
+    def import_indexed_fasta_file( self, fasta_filename, contig_prefix = "" ):
+        fasta_index = Genome.read_fasta_index( fasta_filename, contig_prefix )
+        if fasta_index is None:
+            return False
+        fasta_data = IndexedFastaContig.map_fasta_file( fasta_filename ) if len( fasta_index ) > 0 else b''
+        for ( contig_name, contig_length, data_offset, line_bases, line_width ) in fasta_index:
+            self._status_data[contig_name] = IndexedFastaContig( fasta_filename, fasta_data, data_offset, contig_length, line_bases, line_width )
+            self.add_contig( contig_name )
+        return True
 
     @staticmethod
     def reverse_complement( dna_string ):
@@ -135,6 +670,9 @@ class Genome( GenomeStatus ):
             simple_base = 'N'
         return simple_base
 
+    # Byte translation table equivalent to simple_call() with the default arguments.
+    SIMPLE_CALL_TABLE = bytes( ( byte & 0xDF ) if ( byte & 0xDF ) in b'ACGT' else ( 84 if ( byte & 0xDF ) == 85 else 78 ) for byte in range( 256 ) )
+
 
 class GenomeMeta:
 
@@ -173,11 +711,21 @@ class GenomeMeta:
             identifier = '' + identifier + "::" + ( ','.join( self._generators ) )
         return identifier
 
+    # What a track file needs to carry to rebuild the metadata.
+    def get_meta_table( self ):
+        return { 'nickname': self._nickname, 'file_path': self._file_path, 'file_type': self._file_type, 'generators': self._generators }
+
+    def set_meta_table( self, meta_table ):
+        self._nickname = meta_table['nickname']
+        self._file_path = meta_table['file_path']
+        self._file_type = meta_table['file_type']
+        self._generators = list( meta_table['generators'] )
+
     @staticmethod
     def generate_nickname_from_filename( filename ):
         import re
         import random
-        filename_match = re.match( r'^(?:.*\/)?([^\/]+?)(?:\.(?:[Ff][Rr][Aa][Nn][Kk][Ee][Nn])?[Ff][Aa](?:[Ss](?:[Tt][Aa])?)?|\.[Vv][Cc][Ff])?$', filename )
+        filename_match = re.match( r'^(?:.*\/)?([^\/]+?)(?:\.(?:[Ff][Rr][Aa][Nn][Kk][Ee][Nn])?[Ff][Aa](?:[Ss](?:[Tt][Aa])?)?|\.[Vv][Cc][Ff])?(?:\.[Bb]?[Gg][Zz])?$', filename )
         if filename_match:
             nickname = filename_match.group(1)
         else:
@@ -189,37 +737,284 @@ class GenomeMeta:
         return dna_string.translate( ''.maketrans( 'ABCDGHMNRSTUVWXYabcdghmnrstuvwxy', 'TVGHCDKNYSAABWXRtvghcdknysaabwxr' ) )[::-1]
 
 
+# Read-only dups contig backed by a bitmap, one bit per position, as stored in a genome pack.
+# Looks like the bytes a dups file would have produced, except that anything other than '1' reads back as '0'.
+class DupsBitmap:
+
+    def __init__( self, bitmap_data, contig_length ):
+        self._bitmap_data = bitmap_data
+        self._contig_length = contig_length
+
+    def __len__( self ):
+        return self._contig_length
+
+    def __getitem__( self, index ):
+        if isinstance( index, slice ):
+            ( first_index, last_index, step ) = index.indices( self._contig_length )
+            if last_index <= first_index:
+                return b''
+            first_byte = first_index >> 3
+            last_byte = ( ( last_index - 1 ) >> 3 ) + 1
+            bit_string = format( int.from_bytes( self._bitmap_data[first_byte:last_byte], 'big' ), '0{0}b'.format( ( last_byte - first_byte ) * 8 ) ).encode( 'ascii' )
+            return bit_string[( first_index - first_byte * 8 ):( last_index - first_byte * 8 ):step]
+        if index < 0:
+            index += self._contig_length
+        if not 0 <= index < self._contig_length:
+            raise IndexError( "dups bitmap index out of range" )
+        return 48 + ( ( self._bitmap_data[index >> 3] >> ( 7 - ( index & 7 ) ) ) & 1 )
+
+    # Packs dups data, one byte per position, into a bitmap of its '1' positions.
+    @staticmethod
+    def pack_bits( dups_data ):
+        bit_string = bytes( dups_data[:] ).translate( DupsBitmap._BIT_TABLE )
+        bit_string += b'0' * ( -len( bit_string ) % 8 )
+        if len( bit_string ) == 0:
+            return b''
+        return int( bit_string, 2 ).to_bytes( len( bit_string ) // 8, 'big' )
+
+    _BIT_TABLE = bytes( 49 if byte == 49 else 48 for byte in range( 256 ) )
+
+
 class IndelList:
 
     def __init__( self ):
         self._indels = {}
 
 
+# A folder of parsed inputs, kept as the track files of their genomes, so a rerun maps them instead of parsing the inputs again.
+# Entries are keyed by a digest of the input's path, size and modification time, the track file version, and the parse
+# settings the caller gives, E.G. its version and filters. Each entry is a JSON manifest listing its tracks, written after
+# them so a half-written entry is never found. Manifests are touched whenever they are used, and the least recently used
+# entries are evicted once the folder grows past size_limit bytes. The folder can also hold the parsed inputs of one run,
+# E.G. so samples can be added to it later, in which case the entries the run did not use are dropped instead.
+class InputCache:
+
+    MANIFEST_SUFFIX = ".entry"
+
+    def __init__( self, cache_folder, size_limit = None ):
+        import os
+        os.makedirs( cache_folder, exist_ok=True )
+        self._cache_folder = cache_folder
+        self._size_limit = size_limit
+        self._used_entries = set()
+
+    def cache_folder( self ):
+        return self._cache_folder
+
+    # Returns None if the input can not be looked at, so it is parsed and not cached.
+    def get_entry_key( self, file_path, parse_settings ):
+        import hashlib
+        import json
+        import os
+        try:
+            file_stat = os.stat( file_path )
+        except OSError:
+            return None
+        key_data = json.dumps( [ os.path.realpath( file_path ), file_stat.st_size, file_stat.st_mtime_ns, GenomeStatus.TRACK_FILE_VERSION, parse_settings ], sort_keys=True )
+        return hashlib.sha1( key_data.encode( 'utf-8' ) ).hexdigest()
+
+    def _get_manifest_filename( self, entry_key ):
+        import os
+        return os.path.join( self._cache_folder, entry_key + InputCache.MANIFEST_SUFFIX )
+
+    # Returns the ( genome_class, track_filename ) of every genome of an entry, or None if it is not cached.
+    def get_entry( self, entry_key ):
+        import json
+        import os
+        manifest_filename = self._get_manifest_filename( entry_key )
+        try:
+            with open( manifest_filename ) as manifest_handle:
+                entry_tracks = [ ( genome_class, os.path.join( self._cache_folder, track_name ) ) for ( genome_class, track_name ) in json.load( manifest_handle ) ]
+            for ( genome_class, track_filename ) in entry_tracks:
+                if not os.path.isfile( track_filename ):
+                    return None
+            os.utime( manifest_filename )
+        except ( OSError, ValueError ):
+            return None
+        self._used_entries.add( entry_key + InputCache.MANIFEST_SUFFIX )
+        return entry_tracks
+
+    # Moves the track files of a freshly parsed input into the cache and returns where they ended up.
+    # They have to be on the same filesystem, E.G. written to a temporary folder inside the cache folder.
+    def add_entry( self, entry_key, genome_tracks ):
+        import json
+        import os
+        entry_tracks = []
+        for ( track_index, ( genome_class, track_filename ) ) in enumerate( genome_tracks ):
+            track_name = "{0}.{1}.tracks".format( entry_key, track_index )
+            os.replace( track_filename, os.path.join( self._cache_folder, track_name ) )
+            entry_tracks.append( ( genome_class, track_name ) )
+        manifest_filename = self._get_manifest_filename( entry_key )
+        temporary_filename = manifest_filename + ".tmp{0}".format( os.getpid() )
+        with open( temporary_filename, 'w' ) as manifest_handle:
+            json.dump( entry_tracks, manifest_handle )
+        os.replace( temporary_filename, manifest_filename )
+        self._used_entries.add( entry_key + InputCache.MANIFEST_SUFFIX )
+        return [ ( genome_class, os.path.join( self._cache_folder, track_name ) ) for ( genome_class, track_name ) in entry_tracks ]
+
+    # Manifests go first, so an entry that is only partly removed is already gone.
+    # With unused_only, every entry this instance did not look up or add is removed, whatever the size limit.
+    def evict_entries( self, unused_only = False ):
+        import json
+        import os
+        if self._size_limit is None and not unused_only:
+            return
+        cache_entries = []
+        cache_size = 0
+        for file_name in os.listdir( self._cache_folder ):
+            if file_name.endswith( InputCache.MANIFEST_SUFFIX ):
+                manifest_filename = os.path.join( self._cache_folder, file_name )
+                try:
+                    with open( manifest_filename ) as manifest_handle:
+                        entry_files = [ manifest_filename ] + [ os.path.join( self._cache_folder, track_name ) for ( genome_class, track_name ) in json.load( manifest_handle ) ]
+                    last_used = os.path.getmtime( manifest_filename )
+                    entry_size = sum( os.path.getsize( entry_file ) for entry_file in entry_files if os.path.isfile( entry_file ) )
+                except ( OSError, ValueError ):
+                    continue
+                if not unused_only or file_name not in self._used_entries:
+                    cache_entries.append( ( last_used, entry_size, entry_files ) )
+                    cache_size += entry_size
+        for ( last_used, entry_size, entry_files ) in sorted( cache_entries ):
+            if not unused_only and cache_size <= self._size_limit:
+                break
+            for entry_file in entry_files:
+                try:
+                    os.remove( entry_file )
+                except OSError:
+                    pass
+            cache_size -= entry_size
+
+
+# A set of intervals to restrict a run to, E.G. the targets of a gene panel, usually read from a BED file.
+# Intervals are one-indexed and inclusive, like genome positions everywhere else. Overlapping and adjacent intervals
+# are merged the first time the set is queried, and a position lookup is a binary search over its contig's intervals.
+class GenomeRegions:
+
+    def __init__( self ):
+        self._regions = {}
+        self._region_starts = None
+
+    def add_region( self, contig_name, first_position, last_position ):
+        self._regions.setdefault( contig_name, [] ).append( ( first_position, last_position ) )
+        self._region_starts = None
+
+    # BED intervals are zero-indexed and half-open. Header, comment and blank lines are skipped.
+    def import_bed_file( self, bed_filename ):
+        with open_input_file( bed_filename, 'r' ) as bed_handle:
+            for bed_line in bed_handle:
+                bed_fields = bed_line.rstrip( '\r\n' ).split( '\t' )
+                if bed_line.isspace() or bed_fields[0].startswith( ( '#', 'track', 'browser' ) ):
+                    continue
+                if len( bed_fields ) < 3 or not bed_fields[1].strip().isdigit() or not bed_fields[2].strip().isdigit():
+                    raise MalformedInputFile( bed_filename, "'{0}' is not a BED interval".format( bed_line.rstrip( '\r\n' ) ) )
+                if int( bed_fields[2] ) > int( bed_fields[1] ):
+                    self.add_region( bed_fields[0], int( bed_fields[1] ) + 1, int( bed_fields[2] ) )
+
+    def _merge_regions( self ):
+        if self._region_starts is None:
+            self._region_starts = {}
+            for contig_name in self._regions:
+                merged_regions = []
+                for ( first_position, last_position ) in sorted( self._regions[contig_name] ):
+                    if len( merged_regions ) > 0 and first_position <= merged_regions[-1][1] + 1:
+                        merged_regions[-1] = ( merged_regions[-1][0], max( merged_regions[-1][1], last_position ) )
+                    else:
+                        merged_regions.append( ( first_position, last_position ) )
+                self._regions[contig_name] = merged_regions
+                self._region_starts[contig_name] = [ first_position for ( first_position, last_position ) in merged_regions ]
+
+    def get_contigs( self ):
+        return sorted( self._regions.keys() )
+
+    # Returns the merged ( first_position, last_position ) intervals of a contig, in position order.
+    def get_contig_regions( self, contig_name ):
+        self._merge_regions()
+        return list( self._regions.get( contig_name, [] ) )
+
+    def contains( self, contig_name, position ):
+        import bisect
+        self._merge_regions()
+        if contig_name not in self._region_starts:
+            return False
+        region_index = bisect.bisect_right( self._region_starts[contig_name], position ) - 1
+        return region_index >= 0 and position <= self._regions[contig_name][region_index][1]
+
+
 class ReferenceGenome( Genome ):
 
     def __init__( self ):
         Genome.__init__( self )
         self._dups = GenomeStatus()
+        self._genome_pack = None
 
     def get_dups_call( self, first_position, last_position = None, contig_name = None ):
         return self._dups.get_value( first_position, last_position, contig_name, "?" )
 
-    def _import_dups_line( self, line_from_dups_file, contig_prefix = "" ):
-        import re
-        contig_match = re.match( r'^>' + re.escape( contig_prefix ) + r'([^\s]+)(?:\s|$)', line_from_dups_file )
-        if contig_match:
-            self.add_contig( contig_match.group(1) )
-            self._dups.add_contig( contig_match.group(1) )
-        else:
-            data_match = re.match( r'^([01-]+)\s*$', line_from_dups_file )
-            if data_match:
-                self._dups.append_contig( list( data_match.group(1) ) )
+    def get_dups_call_block( self, first_position, last_position, contig_name = None ):
+        return self._dups.get_value_block( first_position, last_position, contig_name, "?" )
 
     def import_dups_file( self, dups_filename, contig_prefix = "" ):
-        dups_handle = open( dups_filename, 'r' )
-        for line_from_dups_file in dups_handle:
-            self._import_dups_line( line_from_dups_file, contig_prefix )
-        dups_handle.close()
+        for ( contig_name, dups_data ) in GenomeStatus._read_fasta_file( dups_filename, contig_prefix, b'01-' ):
+            if contig_name is not None:
+                self.add_contig( contig_name )
+                self._dups.add_contig( contig_name )
+            if dups_data:
+                self._dups.append_contig( dups_data )
+
+    def has_dups_data( self ):
+        return len( self._dups.get_contigs() ) > 0
+
+    # Path of the genome pack the reference sequence was mapped from, if it was.
+    def get_genome_pack( self ):
+        return self._genome_pack
+
+    # A genome pack is the reference and its dups in a form that can be memory mapped instead of parsed:
+    # an 8-byte magic string, the version and the length of a JSON contig table as 32-bit little-endian integers, the table itself,
+    # then, from the next 16-byte boundary, the raw sequence bytes of every contig followed by the dups bitmaps.
+    # Offsets in the contig table are relative to the start of that data section. Contigs are kept in reference file order.
+    GENOME_PACK_MAGIC = b'NASPPACK'
+    GENOME_PACK_VERSION = 1
+
+    # Written to a temporary file first and moved into place, so processes that already have the old pack mapped are left alone.
+    def write_to_genome_pack( self, pack_filename ):
+        import os
+        contig_table = []
+        data_offset = 0
+        for current_contig in self.get_contigs( False ):
+            contig_entry = { 'name': current_contig, 'offset': data_offset, 'length': len( self._status_data[current_contig] ), 'dups_offset': None, 'dups_length': None }
+            data_offset += contig_entry['length']
+            contig_table.append( contig_entry )
+        dups_bitmaps = []
+        for contig_entry in contig_table:
+            if contig_entry['name'] in self._dups._status_data:
+                dups_bitmaps.append( DupsBitmap.pack_bits( self._dups._status_data[contig_entry['name']] ) )
+                contig_entry['dups_offset'] = data_offset
+                contig_entry['dups_length'] = len( self._dups._status_data[contig_entry['name']] )
+                data_offset += len( dups_bitmaps[-1] )
+        header_data = GenomeStatus._encode_table_header( ReferenceGenome.GENOME_PACK_MAGIC, ReferenceGenome.GENOME_PACK_VERSION, { 'contigs': contig_table } )
+        temporary_filename = pack_filename + ".tmp{0}".format( os.getpid() )
+        with open( temporary_filename, 'wb' ) as pack_handle:
+            pack_handle.write( header_data )
+            for contig_entry in contig_table:
+                contig_storage = self._status_data[contig_entry['name']]
+                if not isinstance( contig_storage, ( bytes, bytearray, memoryview ) ):
+                    contig_storage = contig_storage[0:len( contig_storage )]
+                pack_handle.write( contig_storage )
+            for dups_bitmap in dups_bitmaps:
+                pack_handle.write( dups_bitmap )
+        os.replace( temporary_filename, pack_filename )
+
+    # The contigs become read-only views of the mapped file, so every process that opens the same pack shares its pages.
+    def import_genome_pack( self, pack_filename, import_dups = True ):
+        self._genome_pack = pack_filename
+        ( pack_table, pack_view ) = GenomeStatus._map_table_file( pack_filename, ReferenceGenome.GENOME_PACK_MAGIC, ReferenceGenome.GENOME_PACK_VERSION, "genome pack" )
+        for contig_entry in pack_table['contigs']:
+            self._status_data[contig_entry['name']] = pack_view[contig_entry['offset']:( contig_entry['offset'] + contig_entry['length'] )]
+            self.add_contig( contig_entry['name'] )
+            if import_dups and contig_entry['dups_offset'] is not None:
+                dups_start = contig_entry['dups_offset']
+                self._dups._status_data[contig_entry['name']] = DupsBitmap( pack_view[dups_start:( dups_start + ( contig_entry['dups_length'] + 7 ) // 8 )], contig_entry['dups_length'] )
+                self._dups.add_contig( contig_entry['name'] )
 
 
 class FastaGenome( Genome, GenomeMeta ):
@@ -243,71 +1038,313 @@ class FastaGenome( Genome, GenomeMeta ):
     def get_proportion_pass( self, current_pos, contig_name = None ):
         return "-"
 
+    def write_to_track_file( self, track_filename, track_metadata = None ):
+        GenomeStatus.write_to_track_file( self, track_filename, self.get_meta_table() )
+
+    def import_track_file( self, track_filename ):
+        self.set_meta_table( GenomeStatus.import_track_file( self, track_filename ) )
+
+    _WAS_CALLED_TABLE = bytes( ( 78 if byte in b'XN' else 89 ) for byte in range( 256 ) )
+
+    def get_was_called_block( self, first_position, last_position, contig_name = None ):
+        return self.get_call_block( first_position, last_position, contig_name, "X" ).translate( FastaGenome._WAS_CALLED_TABLE )
+
+    def get_coverage_pass_block( self, first_position, last_position, contig_name = None ):
+        return b'-' * ( last_position - first_position + 1 )
 
+    def get_proportion_pass_block( self, first_position, last_position, contig_name = None ):
+        return b'-' * ( last_position - first_position + 1 )
+
+
+# VCF sample data is packed into one byte per position, so the call and its three filter flags live side by side:
+#   bits 0-2  call, as an index into 'XACGTN.' ( 7 means some other call, kept aside in _escaped_calls )
+#   bit 3     was_called, 'N' or 'Y'
+#   bits 4-5  coverage pass, one of '?YN-'
+#   bits 6-7  proportion pass, one of '?YN-'
+# A zero byte is an uncalled position ( 'X', 'N', '?', '?' ), so contigs can be allocated as zero-filled bytearrays.
 class VCFGenome( Genome, GenomeMeta ):
 
-    def __init__( self ):
-        Genome.__init__( self )
+    def __init__( self, contig_type = bytearray ):
+        Genome.__init__( self, contig_type )
         GenomeMeta.__init__( self )
         self._indels = IndelList()
-        self._was_called = GenomeStatus()
-        self._passed_coverage = GenomeStatus()
-        self._passed_proportion = GenomeStatus()
+        self._escaped_calls = {}
+
+    _FLAG_CODES = b'?YN-'
+    _CALL_ENCODE_TABLE = bytes( ( b'XACGTN.'.index( byte ) if byte in b'XACGTN.' else 7 ) for byte in range( 256 ) )
+    # Escaped calls decode to a zero byte, which marks them for patching from _escaped_calls.
+    _CALL_DECODE_TABLE = bytes( b'XACGTN.\0'[byte & 7] for byte in range( 256 ) )
+    _WAS_CALLED_DECODE_TABLE = bytes( b'NY'[( byte >> 3 ) & 1] for byte in range( 256 ) )
+    _COVERAGE_DECODE_TABLE = bytes( b'?YN-'[( byte >> 4 ) & 3] for byte in range( 256 ) )
+    _PROPORTION_DECODE_TABLE = bytes( b'?YN-'[( byte >> 6 ) & 3] for byte in range( 256 ) )
+    # Call and was_called bits for every call a VCF sample column can hold, with None packing as an uncalled position.
+    _CALL_FLAGS = dict( [ ( chr( byte ), byte_index | ( 0 if byte == 78 else 8 ) ) for ( byte_index, byte ) in enumerate( b'XACGTN.' ) ] + [ ( None, 0 ) ] )
+
+    # Sizes every contig to the reference up front so VCF import never has to grow a contig one record at a time.
+    def allocate_contigs( self, reference, contig_names = None ):
+        for current_contig in ( reference.get_contigs() if contig_names is None else contig_names ):
+            self.extend_contig( reference.get_contig_length( current_contig ), b'\0', current_contig )
+
+    def remove_contig( self, contig_name ):
+        GenomeStatus.remove_contig( self, contig_name )
+        self._escaped_calls.pop( contig_name, None )
+
+    # Values of None leave that part of the position untouched.
+    def set_values( self, current_pos, call, was_called, coverage_pass, proportion_pass, contig_name = None ):
+        contig_name = self.set_current_contig( contig_name )
+        self.extend_contig( current_pos, b'\0', contig_name )
+        packed_value = self._status_data[contig_name][current_pos-1]
+        if call is not None:
+            call_code = VCFGenome._CALL_ENCODE_TABLE[ord( call )]
+            if call_code == 7:
+                self._escaped_calls.setdefault( contig_name, {} )[current_pos] = ord( call )
+            packed_value = ( packed_value & 0xF8 ) | call_code
+        if was_called is not None:
+            packed_value = ( packed_value & 0xF7 ) | ( b'NY'.index( ord( was_called ) ) << 3 )
+        if coverage_pass is not None:
+            packed_value = ( packed_value & 0xCF ) | ( VCFGenome._FLAG_CODES.index( ord( coverage_pass ) ) << 4 )
+        if proportion_pass is not None:
+            packed_value = ( packed_value & 0x3F ) | ( VCFGenome._FLAG_CODES.index( ord( proportion_pass ) ) << 6 )
+        self._status_data[contig_name][current_pos-1] = packed_value
+
+    # Packs one sample's column of a VCFRecordBlock in a single pass, with the same values get_sample_values() gives every line.
+    # Returns the packed bytes and the indexes of the lines whose calls have to be escaped.
+    # A None value packs as a zero field, which matches set_values() leaving it untouched only where nothing has been set yet.
+    @staticmethod
+    def pack_record_column( record_block, sample_index, min_coverage, min_proportion ):
+        call_flags = VCFGenome._CALL_FLAGS
+        sample_calls = record_block.calls[sample_index]
+        # NaN compares unequal to itself, which is how the missing coverage and proportion values are picked out here
+        packed_values = bytes( [ call_flags.get( sample_call, 15 ) | ( 0 if sample_coverage != sample_coverage else ( 16 if sample_coverage >= min_coverage else 32 ) ) | ( ( 0 if is_a_snp else 192 ) if sample_proportion != sample_proportion else ( 64 if sample_proportion >= min_proportion else 128 ) ) for ( sample_call, sample_coverage, sample_proportion, is_a_snp ) in zip( sample_calls, record_block.coverages[sample_index], record_block.proportions[sample_index], record_block.snps[sample_index] ) ] )
+        escaped_records = []
+        if not call_flags.keys() >= set( sample_calls ):
+            escaped_records = [ record_index for record_index in range( len( sample_calls ) ) if sample_calls[record_index] not in call_flags ]
+        return ( packed_values, escaped_records )
+
+    # Writes a run of values packed by pack_record_column() over whatever the positions held before.
+    def set_packed_values( self, first_position, packed_values, contig_name = None ):
+        contig_name = self.set_current_contig( contig_name )
+        self.extend_contig( first_position + len( packed_values ) - 1, b'\0', contig_name )
+        self._status_data[contig_name][first_position-1:first_position-1+len( packed_values )] = packed_values
+
+    def set_call( self, new_data, first_position, missing_range_filler = "X", contig_name = None ):
+        for call_index in range( len( new_data ) ):
+            self.set_values( first_position + call_index, new_data[call_index], None, None, None, contig_name )
 
     def set_was_called( self, pass_value, current_pos, contig_name = None ):
-        self._was_called.set_value( pass_value, current_pos, "N", contig_name )
+        self.set_values( current_pos, None, pass_value, None, None, contig_name )
 
     def set_coverage_pass( self, pass_value, current_pos, contig_name = None ):
-        self._passed_coverage.set_value( pass_value, current_pos, "?", contig_name )
+        self.set_values( current_pos, None, None, pass_value, None, contig_name )
 
     def set_proportion_pass( self, pass_value, current_pos, contig_name = None ):
-        self._passed_proportion.set_value( pass_value, current_pos, "?", contig_name )
+        self.set_values( current_pos, None, None, None, pass_value, contig_name )
+
+    # The escaped calls travel in the track metadata, keyed by position.
+    def write_to_track_file( self, track_filename, track_metadata = None ):
+        track_metadata = self.get_meta_table()
+        track_metadata['escaped_calls'] = dict( ( contig_name, dict( ( str( current_pos ), call_byte ) for ( current_pos, call_byte ) in self._escaped_calls[contig_name].items() ) ) for contig_name in self._escaped_calls )
+        GenomeStatus.write_to_track_file( self, track_filename, track_metadata )
+
+    def import_track_file( self, track_filename ):
+        track_metadata = GenomeStatus.import_track_file( self, track_filename )
+        self.set_meta_table( track_metadata )
+        self._escaped_calls = dict( ( contig_name, dict( ( int( current_pos ), call_byte ) for ( current_pos, call_byte ) in track_metadata['escaped_calls'][contig_name].items() ) ) for contig_name in track_metadata['escaped_calls'] )
+
+    # Decodes one track of a range of positions; positions past the end of the contig are left off.
+    def _decode_block( self, decode_table, first_position, last_position, contig_name ):
+        decoded_block = bytes( self._status_data[contig_name][first_position-1:last_position] ).translate( decode_table )
+        if decode_table is VCFGenome._CALL_DECODE_TABLE and contig_name in self._escaped_calls:
+            decoded_block = bytearray( decoded_block )
+            block_index = decoded_block.find( 0 )
+            while block_index >= 0:
+                decoded_block[block_index] = self._escaped_calls[contig_name][first_position + block_index]
+                block_index = decoded_block.find( 0, block_index + 1 )
+            decoded_block = bytes( decoded_block )
+        return decoded_block
+
+    # Same results as GenomeStatus.get_value() and get_value_block() would give for the unpacked track.
+    def _get_decoded_value( self, decode_table, first_position, last_position, contig_name, filler_value ):
+        contig_name = self.set_current_contig( contig_name )
+        contig_length = len( self._status_data[contig_name] )
+        queried_value = filler_value
+        if last_position is None:
+            if first_position <= contig_length:
+                queried_value = chr( self._decode_block( decode_table, first_position, first_position, contig_name )[0] )
+        else:
+            queried_value = []
+            if last_position == -1:
+                last_position = contig_length
+            if last_position >= first_position and first_position <= contig_length:
+                queried_value = list( self._decode_block( decode_table, first_position, last_position, contig_name ).decode( 'latin-1' ) )
+                if filler_value is not None and len( queried_value ) < last_position - first_position + 1:
+                    queried_value.extend( [ filler_value ] * ( last_position - first_position + 1 - len( queried_value ) ) )
+        return queried_value
+
+    def _get_decoded_block( self, decode_table, first_position, last_position, contig_name, filler_value ):
+        contig_name = self.set_current_contig( contig_name )
+        value_block = self._decode_block( decode_table, first_position, last_position, contig_name )
+        if len( value_block ) < last_position - first_position + 1:
+            value_block += GenomeStatus._encode_data( filler_value ) * ( last_position - first_position + 1 - len( value_block ) )
+        return value_block
+
+    def get_call( self, first_position, last_position = None, contig_name = None, filler_value = "X" ):
+        return self._get_decoded_value( VCFGenome._CALL_DECODE_TABLE, first_position, last_position, contig_name, filler_value )
 
     def get_was_called( self, current_pos, contig_name = None ):
-        return self._was_called.get_value( current_pos, None, contig_name, "N" )
+        return self._get_decoded_value( VCFGenome._WAS_CALLED_DECODE_TABLE, current_pos, None, contig_name, "N" )
 
     def get_coverage_pass( self, current_pos, contig_name = None ):
-        return self._passed_coverage.get_value( current_pos, None, contig_name, "?" )
+        return self._get_decoded_value( VCFGenome._COVERAGE_DECODE_TABLE, current_pos, None, contig_name, "?" )
 
     def get_proportion_pass( self, current_pos, contig_name = None ):
-        return self._passed_proportion.get_value( current_pos, None, contig_name, "?" )
+        return self._get_decoded_value( VCFGenome._PROPORTION_DECODE_TABLE, current_pos, None, contig_name, "?" )
 
+    def get_call_block( self, first_position, last_position, contig_name = None, filler_value = "X" ):
+        return self._get_decoded_block( VCFGenome._CALL_DECODE_TABLE, first_position, last_position, contig_name, filler_value )
 
-class CollectionStatistics:
+    def get_was_called_block( self, first_position, last_position, contig_name = None ):
+        return self._get_decoded_block( VCFGenome._WAS_CALLED_DECODE_TABLE, first_position, last_position, contig_name, "N" )
+
+    def get_coverage_pass_block( self, first_position, last_position, contig_name = None ):
+        return self._get_decoded_block( VCFGenome._COVERAGE_DECODE_TABLE, first_position, last_position, contig_name, "?" )
+
+    def get_proportion_pass_block( self, first_position, last_position, contig_name = None ):
+        return self._get_decoded_block( VCFGenome._PROPORTION_DECODE_TABLE, first_position, last_position, contig_name, "?" )
+
+    def _send_to_fasta_handle( self, output_handle, contig_prefix = "", max_chars_per_line = 80, line_separator = b'\n' ):
+        call_data = Genome()
+        for current_contig in self.get_contigs():
+            call_data.append_contig( self._decode_block( VCFGenome._CALL_DECODE_TABLE, 1, self.get_contig_length( current_contig ), current_contig ), current_contig )
+        call_data._send_to_fasta_handle( output_handle, contig_prefix, max_chars_per_line, line_separator )
+
+
+# Streaming matrix generation only ever holds one window of positions on one contig per sample.
+# Windows answer the same *_block queries as VCFGenome, for positions inside the current window.
+class VCFGenomeWindow( GenomeMeta ):
 
     def __init__( self ):
-        self._contig_stats = {}
-        self._sample_stats = {}
-        self._cumulative_cache = {}
+        GenomeMeta.__init__( self )
+        self._contig_name = None
+        self._first_position = 1
+        self._calls = bytearray()
+        self._was_called = bytearray()
+        self._passed_coverage = bytearray()
+        self._passed_proportion = bytearray()
+
+    def reset_window( self, contig_name, first_position, last_position ):
+        window_length = last_position - first_position + 1
+        self._contig_name = contig_name
+        self._first_position = first_position
+        self._calls[:] = b'X' * window_length
+        self._was_called[:] = b'N' * window_length
+        self._passed_coverage[:] = b'?' * window_length
+        self._passed_proportion[:] = b'?' * window_length
+
+    # Values of None leave that track untouched, matching the set_* calls read_vcf_file() skips.
+    def set_values( self, current_pos, call, was_called, coverage_pass, proportion_pass ):
+        window_index = current_pos - self._first_position
+        if call is not None:
+            self._calls[window_index] = ord( call )
+        if was_called is not None:
+            self._was_called[window_index] = ord( was_called )
+        if coverage_pass is not None:
+            self._passed_coverage[window_index] = ord( coverage_pass )
+        if proportion_pass is not None:
+            self._passed_proportion[window_index] = ord( proportion_pass )
+
+    def set_call_range( self, call_data, first_position ):
+        window_index = first_position - self._first_position
+        self._calls[window_index:window_index+len( call_data )] = call_data
+
+    def get_call_block( self, first_position, last_position, contig_name = None, filler_value = "X" ):
+        return bytes( self._calls[( first_position - self._first_position ):( last_position - self._first_position + 1 )] )
+
+    def get_was_called_block( self, first_position, last_position, contig_name = None ):
+        return bytes( self._was_called[( first_position - self._first_position ):( last_position - self._first_position + 1 )] )
+
+    def get_coverage_pass_block( self, first_position, last_position, contig_name = None ):
+        return bytes( self._passed_coverage[( first_position - self._first_position ):( last_position - self._first_position + 1 )] )
+
+    def get_proportion_pass_block( self, first_position, last_position, contig_name = None ):
+        return bytes( self._passed_proportion[( first_position - self._first_position ):( last_position - self._first_position + 1 )] )
+
+
+class FastaGenomeWindow( VCFGenomeWindow ):
 
-    def _increment_by_contig( self, stat_id, contig_name ):
-        if ( stat_id, contig_name ) not in self._contig_stats:
-            self._contig_stats[( stat_id, contig_name )] = 0
-        self._contig_stats[( stat_id, contig_name )] += 1
+    def get_was_called_block( self, first_position, last_position, contig_name = None ):
+        return self.get_call_block( first_position, last_position, contig_name ).translate( FastaGenome._WAS_CALLED_TABLE )
 
-    def increment_contig_stat( self, stat_id, contig_name = None ):
-        self._increment_by_contig( stat_id, contig_name )
+    def get_coverage_pass_block( self, first_position, last_position, contig_name = None ):
+        return b'-' * ( last_position - first_position + 1 )
+
+    def get_proportion_pass_block( self, first_position, last_position, contig_name = None ):
+        return b'-' * ( last_position - first_position + 1 )
+
+
+class CollectionStatistics:
+
+    # Counters live in integer arrays, one slot per stat id: a row for every contig ( None being the whole genome ), and a row
+    # for every sample-analysis ( sample_nickname, ( identifier, path ), None ) and cumulative ( sample_nickname, None, 'any'/'all' ).
+    # Rows are looked up once per block and updated in place. The stats the matrices produce have their slots from the start;
+    # any other stat id gets one the first time it is used.
+    STAT_IDS = ( 'reference_length', 'reference_clean', 'reference_duplicated', 'all_called', 'all_passed_coverage', 'all_passed_proportion', 'all_passed_consensus', 'quality_breadth', 'any_snps', 'best_snps', 'was_called', 'passed_coverage_filter', 'passed_proportion_filter', 'called_reference', 'called_snp', 'called_indel', 'called_degen', 'consensus' )
+
+    def __init__( self ):
+        self._stat_ids = list( CollectionStatistics.STAT_IDS )
+        self._stat_indexes = dict( ( stat_id, stat_index ) for ( stat_index, stat_id ) in enumerate( self._stat_ids ) )
+        self._contig_counts = {}
+        self._sample_counts = {}
+        self._cumulative_cache = {}
+        self._snapshot_contigs = []
+        self._snapshot_samples = {}
+
+    def _get_stat_index( self, stat_id ):
+        stat_index = self._stat_indexes.get( stat_id )
+        if stat_index is None:
+            stat_index = len( self._stat_ids )
+            self._stat_ids.append( stat_id )
+            self._stat_indexes[stat_id] = stat_index
+            for stat_counts in list( self._contig_counts.values() ) + list( self._sample_counts.values() ):
+                stat_counts.append( 0 )
+        return stat_index
+
+    def _get_contig_counts( self, contig_name ):
+        from array import array
+        if contig_name not in self._contig_counts:
+            self._contig_counts[contig_name] = array( 'q', bytes( 8 * len( self._stat_ids ) ) )
+        return self._contig_counts[contig_name]
+
+    def _get_sample_counts( self, sample_nickname, sample_info, cum_type ):
+        from array import array
+        sample_key = ( sample_nickname, sample_info, cum_type )
+        if sample_key not in self._sample_counts:
+            self._sample_counts[sample_key] = array( 'q', bytes( 8 * len( self._stat_ids ) ) )
+        return self._sample_counts[sample_key]
+
+    def _increment_by_contig( self, stat_id, contig_name, increment_by = 1 ):
+        self._get_contig_counts( contig_name )[self._get_stat_index( stat_id )] += increment_by
+
+    def increment_contig_stat( self, stat_id, contig_name = None, increment_by = 1 ):
+        stat_index = self._get_stat_index( stat_id )
+        self._get_contig_counts( contig_name )[stat_index] += increment_by
         if contig_name is not None:
-            self._increment_by_contig( stat_id, None )
+            self._get_contig_counts( None )[stat_index] += increment_by
 
     def get_contig_stat( self, stat_id, contig_name = None ):
-        return_value = 0 
-        if ( stat_id, contig_name ) in self._contig_stats:
-            return_value = self._contig_stats[( stat_id, contig_name )]
-        return return_value
+        if stat_id not in self._stat_indexes or contig_name not in self._contig_counts:
+            return 0
+        return self._contig_counts[contig_name][self._stat_indexes[stat_id]]
 
     def _cache_cumulative_stats( self, stat_id, sample_nickname, did_pass ):
-        if ( stat_id, sample_nickname, 't' ) not in self._cumulative_cache:
-            self._cumulative_cache[( stat_id, sample_nickname, 't' )] = 0
-            self._cumulative_cache[( stat_id, sample_nickname, 'p' )] = 0
-        self._cumulative_cache[( stat_id, sample_nickname, 't' )] += 1
+        if ( stat_id, sample_nickname ) not in self._cumulative_cache:
+            self._cumulative_cache[( stat_id, sample_nickname )] = [ 0, 0 ]
+        self._cumulative_cache[( stat_id, sample_nickname )][0] += 1
         if did_pass:
-            self._cumulative_cache[( stat_id, sample_nickname, 'p' )] += 1
+            self._cumulative_cache[( stat_id, sample_nickname )][1] += 1
 
-    def _increment_by_sample( self, stat_id, sample_nickname, sample_info, cum_type ):
-        if ( stat_id, sample_nickname, sample_info, cum_type ) not in self._sample_stats:
-            self._sample_stats[( stat_id, sample_nickname, sample_info, cum_type )] = 0
-        self._sample_stats[( stat_id, sample_nickname, sample_info, cum_type )] += 1
+    def _increment_by_sample( self, stat_id, sample_nickname, sample_info, cum_type, increment_by = 1 ):
+        self._get_sample_counts( sample_nickname, sample_info, cum_type )[self._get_stat_index( stat_id )] += increment_by
 
     def record_sample_stat( self, stat_id, sample_nickname, sample_identifier, sample_path, did_pass ):
         if did_pass:
@@ -315,41 +1352,486 @@ class CollectionStatistics:
         self._cache_cumulative_stats( stat_id, sample_nickname, did_pass )
         self._cache_cumulative_stats( stat_id, None, did_pass )
 
+    # Bulk counterparts of record_sample_stat() and flush_cumulative_stat_cache() for a whole block of positions.
+    def add_sample_stat( self, stat_id, sample_nickname, sample_identifier, sample_path, passed_count ):
+        if passed_count > 0:
+            self._increment_by_sample( stat_id, sample_nickname, ( sample_identifier, sample_path ), None, passed_count )
+
+    def add_cumulative_stat( self, stat_id, cum_type, sample_nickname, passed_count ):
+        if passed_count > 0:
+            self._increment_by_sample( stat_id, sample_nickname, None, cum_type, passed_count )
+
+    def _get_sample_value( self, stat_id, sample_key ):
+        if stat_id not in self._stat_indexes or sample_key not in self._sample_counts:
+            return 0
+        return self._sample_counts[sample_key][self._stat_indexes[stat_id]]
+
     def get_sample_stat( self, stat_id, sample_nickname, sample_identifier, sample_path ):
-        return_value = 0
-        if ( stat_id, sample_nickname, ( sample_identifier, sample_path ), None ) in self._sample_stats:
-            return_value = self._sample_stats[( stat_id, sample_nickname, ( sample_identifier, sample_path ), None )]
-        return return_value
+        return self._get_sample_value( stat_id, ( sample_nickname, ( sample_identifier, sample_path ), None ) )
 
     def get_cumulative_stat( self, stat_id, cum_type, sample_nickname = None ):
-        return_value = 0
-        if ( stat_id, sample_nickname, None, cum_type ) in self._sample_stats:
-            return_value = self._sample_stats[( stat_id, sample_nickname, None, cum_type )]
-        return return_value
+        return self._get_sample_value( stat_id, ( sample_nickname, None, cum_type ) )
 
     def flush_cumulative_stat_cache( self ):
-        for ( stat_id, sample_nickname, stat_type ) in self._cumulative_cache:
-            if stat_type == 'p':
-                if self._cumulative_cache[( stat_id, sample_nickname, 'p' )] == self._cumulative_cache[( stat_id, sample_nickname, 't' )]:
-                    self._increment_by_sample( stat_id, sample_nickname, None, 'all' )
-                if self._cumulative_cache[( stat_id, sample_nickname, 'p' )] > 0:
-                    self._increment_by_sample( stat_id, sample_nickname, None, 'any' )
+        for ( stat_id, sample_nickname ) in self._cumulative_cache:
+            ( total_count, passed_count ) = self._cumulative_cache[( stat_id, sample_nickname )]
+            if passed_count == total_count:
+                self._increment_by_sample( stat_id, sample_nickname, None, 'all' )
+            if passed_count > 0:
+                self._increment_by_sample( stat_id, sample_nickname, None, 'any' )
         self._cumulative_cache = {}
 
+    # Every non-zero contig counter, keyed by ( stat_id, contig_name ).
+    def get_contig_stats( self ):
+        return dict( ( ( self._stat_ids[stat_index], contig_name ), stat_counts[stat_index] ) for ( contig_name, stat_counts ) in self._contig_counts.items() for stat_index in range( len( stat_counts ) ) if stat_counts[stat_index] != 0 )
+
+    # Every non-zero sample counter, keyed by ( stat_id, sample_nickname, sample_info, cum_type ).
+    def get_sample_stats( self ):
+        return dict( ( ( self._stat_ids[stat_index], ) + sample_key, stat_counts[stat_index] ) for ( sample_key, stat_counts ) in self._sample_counts.items() for stat_index in range( len( stat_counts ) ) if stat_counts[stat_index] != 0 )
+
+    # Adds every contig and sample counter of another instance into this one, E.G. the results of a matrix shard.
+    def merge( self, other_statistics ):
+        stat_indexes = [ self._get_stat_index( stat_id ) for stat_id in other_statistics._stat_ids ]
+        for ( contig_name, other_counts ) in other_statistics._contig_counts.items():
+            stat_counts = self._get_contig_counts( contig_name )
+            for other_index in range( len( other_counts ) ):
+                stat_counts[stat_indexes[other_index]] += other_counts[other_index]
+        for ( sample_key, other_counts ) in other_statistics._sample_counts.items():
+            stat_counts = self._get_sample_counts( *sample_key )
+            for other_index in range( len( other_counts ) ):
+                stat_counts[stat_indexes[other_index]] += other_counts[other_index]
+
+
+    # The contigs and the sample-analyses, { sample_nickname: { ( identifier, path ): True } }, the statistics files list.
+    # A bare instance lists what its imported snapshots did, sorted the way get_contigs() sorts them, whatever order
+    # the snapshots came in; GenomeCollection lists its own.
+    def _get_stats_contigs( self ):
+        return sorted( self._snapshot_contigs )
+
+    def _get_stats_samples( self ):
+        return self._snapshot_samples
+
+    # A statistics snapshot holds every counter of an instance, so runs over separate parts of the reference, E.G. other
+    # regions or contigs on other nodes, can be added back together. It is laid out like a track file, with the stat ids,
+    # row keys, contigs and sample-analyses in the table and the rows as 64-bit little-endian integers in the data section.
+    # Cumulative 'any'/'all' stats are only additive over positions, so partial runs must split the reference, not the samples.
+    STATS_SNAPSHOT_MAGIC = b'NASPSTAT'
+    STATS_SNAPSHOT_VERSION = 1
+
+    def write_stats_snapshot( self, snapshot_filename ):
+        import os
+        import sys
+        from array import array
+        self.flush_cumulative_stat_cache()
+        stats_samples = self._get_stats_samples()
+        snapshot_table = {
+            'stat_ids': self._stat_ids,
+            'contig_rows': list( self._contig_counts.keys() ),
+            'sample_rows': [ [ sample_nickname, sample_info, cum_type ] for ( sample_nickname, sample_info, cum_type ) in self._sample_counts.keys() ],
+            'contigs': list( self._get_stats_contigs() ),
+            'samples': [ [ sample_nickname, sorted( stats_samples[sample_nickname].keys() ) ] for sample_nickname in sorted( stats_samples.keys() ) ]
+        }
+        snapshot_rows = array( 'q' )
+        for stat_counts in list( self._contig_counts.values() ) + list( self._sample_counts.values() ):
+            snapshot_rows.extend( stat_counts )
+        if sys.byteorder != 'little':
+            snapshot_rows.byteswap()
+        temporary_filename = snapshot_filename + ".tmp{0}".format( os.getpid() )
+        with open( temporary_filename, 'wb' ) as snapshot_handle:
+            snapshot_handle.write( GenomeStatus._encode_table_header( CollectionStatistics.STATS_SNAPSHOT_MAGIC, CollectionStatistics.STATS_SNAPSHOT_VERSION, snapshot_table ) )
+            snapshot_handle.write( snapshot_rows.tobytes() )
+        os.replace( temporary_filename, snapshot_filename )
+
+    # Adds the counters of a snapshot to this instance, along with the contigs and sample-analyses it lists.
+    def merge_stats_snapshot( self, snapshot_filename ):
+        import sys
+        from array import array
+        ( snapshot_table, snapshot_view ) = GenomeStatus._map_table_file( snapshot_filename, CollectionStatistics.STATS_SNAPSHOT_MAGIC, CollectionStatistics.STATS_SNAPSHOT_VERSION, "statistics snapshot" )
+        row_length = len( snapshot_table['stat_ids'] )
+        row_count = len( snapshot_table['contig_rows'] ) + len( snapshot_table['sample_rows'] )
+        snapshot_rows = array( 'q' )
+        snapshot_rows.frombytes( snapshot_view[0:( row_count * row_length * 8 )] )
+        if sys.byteorder != 'little':
+            snapshot_rows.byteswap()
+        snapshot_stats = CollectionStatistics()
+        snapshot_stats._stat_ids = snapshot_table['stat_ids']
+        row_start = 0
+        for contig_name in snapshot_table['contig_rows']:
+            snapshot_stats._contig_counts[contig_name] = snapshot_rows[row_start:( row_start + row_length )]
+            row_start += row_length
+        for ( sample_nickname, sample_info, cum_type ) in snapshot_table['sample_rows']:
+            sample_key = ( sample_nickname, None if sample_info is None else tuple( sample_info ), cum_type )
+            snapshot_stats._sample_counts[sample_key] = snapshot_rows[row_start:( row_start + row_length )]
+            row_start += row_length
+        self.merge( snapshot_stats )
+        for contig_name in snapshot_table['contigs']:
+            if contig_name not in self._snapshot_contigs:
+                self._snapshot_contigs.append( contig_name )
+        for ( sample_nickname, sample_analyses ) in snapshot_table['samples']:
+            for ( sample_identifier, sample_path ) in sample_analyses:
+                self._snapshot_samples.setdefault( sample_nickname, {} )[( sample_identifier, sample_path )] = True
+
+    def _write_general_stats( self, general_handle ):
+        general_stat_array = [ 'reference_length', 'reference_clean', 'reference_duplicated', 'all_called', 'all_passed_coverage', 'all_passed_proportion', 'all_passed_consensus', 'quality_breadth', 'any_snps', 'best_snps' ]
+        denominator_stat = 'reference_length'
+        general_handle.write( "Contig\t" )
+        for current_stat in general_stat_array:
+            general_handle.write( '' + current_stat + "\t" )
+            if current_stat != denominator_stat:
+                general_handle.write( '' + current_stat + " (%)\t" )
+        general_handle.write( "\n" )
+        general_handle.write( "\tstat descriptions go here\n" )
+        for current_contig in ( [ None ] + self._get_stats_contigs() ):
+            denominator_value = self.get_contig_stat( denominator_stat, current_contig )
+            if current_contig is None:
+                general_handle.write( "Whole Genome\t" )
+            else:
+                general_handle.write( '' + current_contig + "\t" )
+            for current_stat in general_stat_array:
+                general_handle.write( '' + str( self.get_contig_stat( current_stat, current_contig ) ) + "\t" )
+                if current_stat != denominator_stat:
+                    general_handle.write( "%.2f%%\t" % ( self.get_contig_stat( current_stat, current_contig ) / denominator_value * 100 ) )
+            general_handle.write( "\n" )
+
+    def _write_sample_stats( self, sample_handle ):
+        sample_stat_array = [ 'was_called', 'passed_coverage_filter', 'passed_proportion_filter', 'called_reference', 'called_snp', 'called_degen' ]
+        #denominator_stat = 'reference_length'
+        #denominator_value = self.get_contig_stat( denominator_stat )
+        sample_handle.write( "Sample\tSample::Analysis\t" )
+        for current_stat in sample_stat_array:
+            sample_handle.write( '' + current_stat + "\t" )
+            #sample_handle.write( '' + current_stat + " (%)\t" )
+        sample_handle.write( "\n" )
+        sample_handle.write( "\tstat descriptions go here\n\n" )
+        stats_samples = self._get_stats_samples()
+        for current_sample in ( [ None ] + sorted( stats_samples.keys() ) ):
+            for current_analysis in [ 'any', 'all' ]:
+                if current_sample is not None:
+                    sample_handle.write( "{0}\t".format( current_sample ) )
+                sample_handle.write( "[{0}]\t".format( current_analysis ) )
+                if current_sample is None:
+                    sample_handle.write( "\t" )
+                for current_stat in sample_stat_array:
+                    sample_handle.write( '' + str( self.get_cumulative_stat( current_stat, current_analysis, current_sample ) ) + "\t" )
+                    #if current_stat != denominator_stat:
+                    #    sample_handle.write( "%.2f%%\t" % ( self.get_contig_stat( current_stat, current_contig ) / denominator_value * 100 ) )
+                sample_handle.write( "\n" )
+            if current_sample is not None:
+                for current_analysis in sorted( stats_samples[current_sample].keys() ):
+                    ( sample_identifier, sample_path ) = current_analysis
+                    sample_handle.write( "{0}\t{1}\t".format( current_sample, sample_identifier ) )
+                    for current_stat in sample_stat_array:
+                        sample_handle.write( '' + str( self.get_sample_stat( current_stat, current_sample, sample_identifier, sample_path ) ) + "\t" )
+                        #if current_stat != denominator_stat:
+                        #    sample_handle.write( "%.2f%%\t" % ( self.get_contig_stat( current_stat, current_contig ) / denominator_value * 100 ) )
+                    sample_handle.write( "\n" )
+            sample_handle.write( "\n" )
+
+    def write_to_stats_files( self, general_filename, sample_filename ):
+        general_handle = open( general_filename, 'w' )
+        sample_handle = open( sample_filename, 'w' )
+        self._write_general_stats( general_handle )
+        self._write_sample_stats( sample_handle )
+        general_handle.close()
+        sample_handle.close()
+
+
+# Matrix blocks evaluate per-position conditions as "lane masks": big integers holding one byte per position,
+# 0x01 where the condition holds and 0x00 where it does not, so bitwise operators act on a whole block at once.
+def _lane_mask( block_data, mask_table ):
+    return int.from_bytes( block_data.translate( mask_table ), 'big' )
+
+def _mask_table( true_values, invert = False ):
+    return bytes( ( 1 if ( ( byte in true_values ) != invert ) else 0 ) for byte in range( 256 ) )
+
+def _count_lanes( lane_mask ):
+    return bin( lane_mask ).count( '1' )
+
+# Collapses each byte of the input to 0x01 if any of its bits are set, without bleeding between bytes.
+def _differing_lanes( lanes, all_lanes ):
+    lanes |= lanes >> 4
+    lanes |= lanes >> 2
+    lanes |= lanes >> 1
+    return lanes & all_lanes
+
+# Interleaves equal-length per-sample columns into positions-by-samples rows, each cell optionally followed by separator.
+def _transpose_columns( columns, block_length, separator = b'' ):
+    cell_width = 1 + len( separator )
+    row_width = len( columns ) * cell_width
+    transposed = bytearray( ( b'\x00' + separator ) * ( block_length * len( columns ) ) )
+    for column_index in range( len( columns ) ):
+        transposed[( column_index * cell_width )::row_width] = columns[column_index]
+    return transposed
+
+_YES_TABLE = _mask_table( b'Y' )
+_PASSED_TABLE = _mask_table( b'Y-' )
+_DEGEN_TABLE = _mask_table( b'N' )
+_CLEAN_TABLE = _mask_table( b'N', True )
+_NOT_DUPLICATED_TABLE = _mask_table( b'1', True )
+
+
+# A binary, column-oriented counterpart of the master matrix, so downstream tools can load just the columns and positions
+# they need instead of parsing text. Positions are stored in chunks, one per matrix block, and every column of a chunk is
+# compressed on its own. The file starts with an 8-byte magic string and the version as a 32-bit little-endian integer,
+# followed by the compressed columns, a JSON table of the sample identifiers and chunks, and then the length of that
+# table as a 64-bit little-endian integer and the magic string again. Positions are not a column: each chunk covers the
+# contiguous positions from its first_position on.
+class MatrixColumnWriter:
+
+    FILE_MAGIC = b'NASPCOLS'
+    FILE_VERSION = 1
+    # Column name to ( array typecode, whether it holds one row per sample ). Calls and the per-sample flags are the
+    # characters of the master matrix, counts are unsigned 32-bit little-endian integers, and duplicated and consensus
+    # are 1 or 0. The sample columns are stored sample by sample, each row as long as the chunk.
+    COLUMN_TYPES = {
+        'reference': ( 'B', False ),
+        'calls': ( 'B', True ),
+        'was_called': ( 'B', True ),
+        'passed_coverage': ( 'B', True ),
+        'passed_proportion': ( 'B', True ),
+        'snp_count': ( 'I', False ),
+        'reference_count': ( 'I', False ),
+        'called_count': ( 'I', False ),
+        'passed_coverage_count': ( 'I', False ),
+        'passed_proportion_count': ( 'I', False ),
+        'a_count': ( 'I', False ),
+        'c_count': ( 'I', False ),
+        'g_count': ( 'I', False ),
+        't_count': ( 'I', False ),
+        'degen_count': ( 'I', False ),
+        'duplicated': ( 'B', False ),
+        'consensus': ( 'B', False )
+    }
+    # Fast compression; the columns are highly repetitive, so higher levels gain little.
+    COMPRESSION_LEVEL = 1
+
+    def __init__( self, columns_filename, sample_identifiers, failed_paths ):
+        self._columns_filename = columns_filename
+        self._columns_handle = open( columns_filename, 'wb' )
+        self._columns_handle.write( MatrixColumnWriter.FILE_MAGIC + MatrixColumnWriter.FILE_VERSION.to_bytes( 4, 'little' ) )
+        self._data_offset = 12
+        self._chunk_table = []
+        self._sample_identifiers = sample_identifiers
+        self._failed_paths = failed_paths
+
+    # Compresses the columns of one chunk. Returns its table entry, with offsets relative to the start of its data, and the data.
+    @staticmethod
+    def encode_chunk( contig_name, first_position, position_count, column_data ):
+        import sys
+        import zlib
+        chunk_entry = { 'contig': contig_name, 'first_position': first_position, 'length': position_count, 'columns': {} }
+        chunk_data = []
+        data_offset = 0
+        for column_name in sorted( column_data ):
+            column_values = column_data[column_name]
+            if MatrixColumnWriter.COLUMN_TYPES[column_name][0] != 'B':
+                if sys.byteorder != 'little':
+                    column_values = column_values[:]
+                    column_values.byteswap()
+                column_values = column_values.tobytes()
+            compressed_column = zlib.compress( column_values, MatrixColumnWriter.COMPRESSION_LEVEL )
+            chunk_entry['columns'][column_name] = [ data_offset, len( compressed_column ) ]
+            chunk_data.append( compressed_column )
+            data_offset += len( compressed_column )
+        return ( chunk_entry, b''.join( chunk_data ) )
+
+    def add_chunk( self, contig_name, first_position, position_count, column_data ):
+        self.add_encoded_chunk( *MatrixColumnWriter.encode_chunk( contig_name, first_position, position_count, column_data ) )
+
+    def add_encoded_chunk( self, chunk_entry, chunk_data ):
+        for column_name in chunk_entry['columns']:
+            chunk_entry['columns'][column_name][0] += self._data_offset
+        self._chunk_table.append( chunk_entry )
+        self._columns_handle.write( chunk_data )
+        self._data_offset += len( chunk_data )
+
+    def close( self ):
+        import json
+        table_data = json.dumps( { 'samples': self._sample_identifiers, 'failed': self._failed_paths, 'columns': MatrixColumnWriter.COLUMN_TYPES, 'chunks': self._chunk_table } ).encode( 'utf-8' )
+        self._columns_handle.write( table_data + len( table_data ).to_bytes( 8, 'little' ) + MatrixColumnWriter.FILE_MAGIC )
+        self._columns_handle.close()
+
+
+# Reads a file from MatrixColumnWriter. Only the chunks a request overlaps are decompressed, and only the columns asked for.
+class MatrixColumnReader:
+
+    def __init__( self, columns_filename ):
+        import json
+        import mmap
+        with open( columns_filename, 'rb' ) as columns_handle:
+            self._columns_map = mmap.mmap( columns_handle.fileno(), 0, access=mmap.ACCESS_READ )
+        file_magic = MatrixColumnWriter.FILE_MAGIC
+        if len( self._columns_map ) < 28 or self._columns_map[0:8] != file_magic or self._columns_map[-8:] != file_magic or int.from_bytes( self._columns_map[8:12], 'little' ) != MatrixColumnWriter.FILE_VERSION:
+            raise MalformedInputFile( columns_filename, "not a version {0} matrix column file".format( MatrixColumnWriter.FILE_VERSION ) )
+        table_length = int.from_bytes( self._columns_map[-16:-8], 'little' )
+        column_table = json.loads( self._columns_map[( -16 - table_length ):-16].decode( 'utf-8' ) )
+        self._sample_identifiers = column_table['samples']
+        self._failed_paths = column_table['failed']
+        self._column_types = dict( ( column_name, tuple( column_type ) ) for ( column_name, column_type ) in column_table['columns'].items() )
+        self._chunk_table = column_table['chunks']
+
+    def get_sample_identifiers( self ):
+        return self._sample_identifiers
+
+    def get_failed_paths( self ):
+        return self._failed_paths
+
+    def get_column_names( self ):
+        return sorted( self._column_types.keys() )
+
+    # The ( contig_name, first_position, last_position ) of every chunk, in matrix order.
+    def get_ranges( self ):
+        return [ ( chunk_entry['contig'], chunk_entry['first_position'], chunk_entry['first_position'] + chunk_entry['length'] - 1 ) for chunk_entry in self._chunk_table ]
+
+    def _read_chunk_column( self, chunk_entry, column_name ):
+        import sys
+        import zlib
+        from array import array
+        ( data_offset, data_length ) = chunk_entry['columns'][column_name]
+        column_values = zlib.decompress( self._columns_map[data_offset:( data_offset + data_length )] )
+        typecode = self._column_types[column_name][0]
+        if typecode != 'B':
+            column_values = array( typecode, column_values )
+            if sys.byteorder != 'little':
+                column_values.byteswap()
+        return column_values
+
+    # Returns the positions and values of a column over a range of a contig, or over the whole contig if no range is given.
+    # Values are bytes for character and flag columns and array('I') for counts; sample columns give a list with one such
+    # sequence per sample, in get_sample_identifiers() order. Positions are a list of ranges, one per chunk read.
+    def get_column( self, column_name, contig_name, first_position = 1, last_position = None ):
+        if column_name not in self._column_types:
+            raise KeyError( column_name )
+        ( typecode, per_sample ) = self._column_types[column_name]
+        sample_count = len( self._sample_identifiers ) if per_sample else 1
+        positions = []
+        sample_values = [ [] for sample_index in range( sample_count ) ]
+        for chunk_entry in self._chunk_table:
+            chunk_start = chunk_entry['first_position']
+            chunk_end = chunk_start + chunk_entry['length'] - 1
+            if chunk_entry['contig'] != contig_name or chunk_end < first_position or ( last_position is not None and chunk_start > last_position ):
+                continue
+            range_start = max( chunk_start, first_position )
+            range_end = chunk_end if last_position is None else min( chunk_end, last_position )
+            column_values = self._read_chunk_column( chunk_entry, column_name )
+            for sample_index in range( sample_count ):
+                row_start = sample_index * chunk_entry['length'] - chunk_start
+                sample_values[sample_index].append( column_values[( row_start + range_start ):( row_start + range_end + 1 )] )
+            positions.append( range( range_start, range_end + 1 ) )
+        if typecode == 'B':
+            sample_values = [ b''.join( value_parts ) for value_parts in sample_values ]
+        else:
+            from array import array
+            joined_values = []
+            for value_parts in sample_values:
+                joined_values.append( array( typecode ) )
+                for column_values in value_parts:
+                    joined_values[-1].extend( column_values )
+            sample_values = joined_values
+        return ( positions, sample_values if per_sample else sample_values[0] )
+
+
+# Random access to the lines of a master matrix through its sidecar index, a text file written by write_to_matrices().
+# Its first line is "#NASP matrix index", the number of rows between entries, and the size of the matrix it was made for,
+# tab-separated; every other line is the contig, the position and the byte offset of a matrix line, in matrix order.
+# A lookup seeks to the last entry at or before the first position asked for and reads on from there.
+class MatrixIndex:
+
+    INDEX_HEADER = "#NASP matrix index"
+
+    @staticmethod
+    def write_index_file( index_filename, matrix_filename, index_rows, index_entries ):
+        import os
+        temporary_filename = index_filename + ".tmp{0}".format( os.getpid() )
+        with open( temporary_filename, 'w' ) as index_handle:
+            index_handle.write( "{0}\t{1}\t{2}\n".format( MatrixIndex.INDEX_HEADER, index_rows, os.path.getsize( matrix_filename ) ) )
+            index_handle.writelines( "{0}\t{1}\t{2}\n".format( *index_entry ) for index_entry in index_entries )
+        os.replace( temporary_filename, index_filename )
+
+    # The index is index_filename, or the matrix path with ".idx" added.
+    def __init__( self, matrix_filename, index_filename = None ):
+        import os
+        self._matrix_filename = matrix_filename
+        if index_filename is None:
+            index_filename = matrix_filename + ".idx"
+        self._contig_positions = {}
+        self._contig_offsets = {}
+        with open( index_filename ) as index_handle:
+            header_fields = index_handle.readline().rstrip( "\n" ).split( "\t" )
+            if len( header_fields ) != 3 or header_fields[0] != MatrixIndex.INDEX_HEADER:
+                raise MalformedInputFile( index_filename, "not a matrix index" )
+            if int( header_fields[2] ) != os.path.getsize( matrix_filename ):
+                raise MalformedInputFile( index_filename, "made for another version of '{0}'".format( matrix_filename ) )
+            for index_line in index_handle:
+                ( contig_name, current_pos, byte_offset ) = index_line.rstrip( "\n" ).rsplit( "\t", 2 )
+                self._contig_positions.setdefault( contig_name, [] ).append( int( current_pos ) )
+                self._contig_offsets.setdefault( contig_name, [] ).append( int( byte_offset ) )
+        self._matrix_handle = open( matrix_filename, 'rb' )
+        self._header_fields = self._matrix_handle.readline().decode( 'utf-8' ).rstrip( "\n" ).split( "\t" )
+
+    def close( self ):
+        self._matrix_handle.close()
+
+    def get_header( self ):
+        return self._header_fields
+
+    # Returns the rows of a contig from first_position to last_position, or just first_position if last_position is not
+    # given, as lists of fields in get_header() order. Positions the matrix has no line for are skipped.
+    def get_rows( self, contig_name, first_position, last_position = None ):
+        import bisect
+        if last_position is None:
+            last_position = first_position
+        matrix_rows = []
+        if contig_name not in self._contig_positions:
+            return matrix_rows
+        entry_index = max( bisect.bisect_right( self._contig_positions[contig_name], first_position ) - 1, 0 )
+        self._matrix_handle.seek( self._contig_offsets[contig_name][entry_index] )
+        locus_prefix = ( contig_name + "::" ).encode( 'utf-8' )
+        for matrix_line in self._matrix_handle:
+            row_locus = matrix_line[0:matrix_line.index( b'\t' )]
+            if not row_locus.startswith( locus_prefix ) or int( row_locus[len( locus_prefix ):] ) > last_position:
+                break
+            if int( row_locus[len( locus_prefix ):] ) >= first_position:
+                matrix_rows.append( matrix_line.decode( 'utf-8' ).rstrip( "\n" ).split( "\t" ) )
+        return matrix_rows
+
+
+# Matrix-writing pool workers are handed the collection once, through the pool initializer, rather than with every shard.
+_matrix_shard_collection = None
+
+def _initialize_matrix_shard_worker( genome_collection ):
+    global _matrix_shard_collection
+    _matrix_shard_collection = genome_collection
+
+def _write_matrix_shard( shard_arguments ):
+    return _matrix_shard_collection._write_matrix_shard( *shard_arguments )
+
 
 class GenomeCollection( CollectionStatistics ):
 
+    # Number of reference positions formatted together by _format_matrix_block().
+    MATRIX_BLOCK_SIZE = 65536
+    # Number of master matrix lines between the entries of its index.
+    MATRIX_INDEX_ROWS = 4096
+    # Number of reference positions handed to each matrix-writing worker at a time.
+    MATRIX_SHARD_SIZE = 262144
+    # Number of reference positions each sample window holds during streaming matrix generation.
+    STREAMING_BLOCK_SIZE = 8192
+
     def __init__( self ):
         CollectionStatistics.__init__( self )
         self._reference = None
         self._genomes = []
         self._genome_identifiers = {}
         self._failed_genomes = []
+        self._failed_genome_paths = set()
+        self._genomes_sorted = True
+        self._regions = None
 
-    # To preserve sample-analysis order across different runs
+    # To preserve sample-analysis order across different runs, whatever order the inputs finish parsing in
     @staticmethod
     def _get_key( genome ):
-        return genome.identifier()
+        return ( genome.identifier(), genome.file_path() or "" )
 
     def set_reference( self, reference ):
         self._reference = reference
@@ -357,6 +1839,20 @@ class GenomeCollection( CollectionStatistics ):
     def reference( self ):
         return self._reference
 
+    # Restricts matrix and statistics generation to a GenomeRegions.
+    def set_regions( self, regions ):
+        self._regions = regions
+
+    def regions( self ):
+        return self._regions
+
+    # Returns the ( first_position, last_position ) ranges of a contig to write out, clipped to the reference.
+    def _get_contig_ranges( self, contig_name ):
+        contig_length = self._reference.get_contig_length( contig_name )
+        if self._regions is None:
+            return [ ( 1, contig_length ) ] if contig_length > 0 else []
+        return [ ( first_position, min( last_position, contig_length ) ) for ( first_position, last_position ) in self._regions.get_contig_regions( contig_name ) if first_position <= contig_length ]
+
     def get_dups_call( self, first_position, last_position = None, contig_name = None ):
         return self._reference.get_dups_call( first_position, last_position, contig_name )
 
@@ -366,11 +1862,20 @@ class GenomeCollection( CollectionStatistics ):
         if genome_nickname not in self._genome_identifiers:
             self._genome_identifiers[genome_nickname] = {}
         self._genome_identifiers[genome_nickname][ ( genome.identifier(), genome.file_path() ) ] = True
-        self._genomes.sort( key=GenomeCollection._get_key )
+        self._genomes_sorted = False
 
     def add_failed_genome( self, genome_path ):
-        if genome_path not in self._failed_genomes:
+        if genome_path not in self._failed_genome_paths:
+            self._failed_genome_paths.add( genome_path )
             self._failed_genomes.append( genome_path )
+            self._genomes_sorted = False
+
+    # Genomes are registered unsorted and put in order once, before anything is written out.
+    def _sort_genomes( self ):
+        if not self._genomes_sorted:
+            self._genomes.sort( key=GenomeCollection._get_key )
+            self._failed_genomes.sort()
+            self._genomes_sorted = True
 
     def set_current_contig( self, contig_name ):
         contig_name = self._reference.set_current_contig( contig_name )
@@ -381,153 +1886,185 @@ class GenomeCollection( CollectionStatistics ):
     def get_contigs( self ):
         return self._reference.get_contigs()
 
-    # FIXME split into a larger number of smaller more testable functions
-    def _format_matrix_line( self, current_contig, current_pos, matrix_format ):
+    # Reduces one stat over a block for every sample-analysis, sample, and the whole collection.
+    # Each entry of stat_masks is ( genome, recorded_lanes, passed_lanes ), with passed a subset of recorded.
+    def _record_block_stat( self, stat_id, stat_masks ):
+        cumulative_masks = {}
+        for ( genome, recorded_lanes, passed_lanes ) in stat_masks:
+            self.add_sample_stat( stat_id, genome.nickname(), genome.identifier(), genome.file_path(), _count_lanes( passed_lanes ) )
+            for sample_nickname in ( genome.nickname(), None ):
+                if sample_nickname not in cumulative_masks:
+                    cumulative_masks[sample_nickname] = [ 0, 0, 0 ]
+                cumulative_masks[sample_nickname][0] |= recorded_lanes
+                cumulative_masks[sample_nickname][1] |= passed_lanes
+                cumulative_masks[sample_nickname][2] |= recorded_lanes ^ passed_lanes
+        for sample_nickname in cumulative_masks:
+            ( recorded_lanes, any_passed_lanes, any_failed_lanes ) = cumulative_masks[sample_nickname]
+            self.add_cumulative_stat( stat_id, 'any', sample_nickname, _count_lanes( any_passed_lanes ) )
+            self.add_cumulative_stat( stat_id, 'all', sample_nickname, _count_lanes( recorded_lanes ^ any_failed_lanes ) )
+
+    # Formats a block of positions at once. Every sample track is fetched as one contiguous column, per-position
+    # conditions are evaluated with lane masks across the whole block, and the columns are transposed into
+    # positions-by-samples rows so per-position counts are a handful of C-level str.count() calls.
+    # If column_data is given, the block's columns for a MatrixColumnWriter are put in it.
+    def _format_matrix_block( self, current_contig, first_position, last_position, matrix_format, column_data = None ):
+        self._sort_genomes()
         genome_count = len( self._genomes )
-        failed_genome_count = len( self._failed_genomes )
-        matrix_line = '' + current_contig + "::" + str( current_pos ) + "\t"
-        reference_call = self._reference.get_call( current_pos, None, current_contig )
-        simplified_refcall = Genome.simple_call( reference_call )
-        self.increment_contig_stat( 'reference_length', current_contig )
-        if simplified_refcall != 'N':
-            self.increment_contig_stat( 'reference_clean', current_contig )
-        matrix_line += '' + reference_call + "\t"
-        custom_line = '' + matrix_line
-        dups_call = self._reference.get_dups_call( current_pos, None, current_contig )
-        if dups_call == "1":
-            dups_call = True
-            self.increment_contig_stat( 'reference_duplicated', current_contig )
-        else:
-            dups_call = False
-        call_data = { 'A': 0, 'C': 0, 'G': 0, 'T': 0, 'N': 0, 'indel': 0, 'snpcall': 0, 'indelcall': 0, 'refcall': 0, 'callstring': '', 'covstring': '', 'propstring': '', 'called': 0, 'passcov': 0, 'passprop': 0 }
-        consensus_check = {}
-        # The expensive loop, single threaded and runs for every sample-analysis-contig-position
+        failed_genome_tabs = '\t' * len( self._failed_genomes )
+        block_length = last_position - first_position + 1
+        all_lanes = int.from_bytes( b'\x01' * block_length, 'big' )
+        reference_block = self._reference.get_call_block( first_position, last_position, current_contig )
+        simple_reference_block = reference_block.translate( Genome.SIMPLE_CALL_TABLE )
+        simple_reference_lanes = int.from_bytes( simple_reference_block, 'big' )
+        dups_block = self._reference.get_dups_call_block( first_position, last_position, current_contig )
+        reference_clean = _lane_mask( simple_reference_block, _CLEAN_TABLE )
+        not_duplicated = _lane_mask( dups_block, _NOT_DUPLICATED_TABLE )
+        breadth_positions = reference_clean & not_duplicated
+        self.increment_contig_stat( 'reference_length', current_contig, block_length )
+        self.increment_contig_stat( 'reference_clean', current_contig, _count_lanes( reference_clean ) )
+        self.increment_contig_stat( 'reference_duplicated', current_contig, block_length - _count_lanes( not_duplicated ) )
+        stat_masks = dict( ( stat_id, [] ) for stat_id in ( 'was_called', 'passed_coverage_filter', 'passed_proportion_filter', 'quality_breadth', 'called_reference', 'called_snp', 'called_indel', 'called_degen' ) )
+        columns = dict( ( column_id, [] ) for column_id in ( 'call', 'simple', 'quality', 'called', 'coverage', 'proportion', 'custom' ) )
+        consensus_calls = {}
+        all_called_lanes = all_passed_coverage_lanes = all_passed_proportion_lanes = no_degen_lanes = all_lanes
+        snp_lanes = 0
+        # The expensive loop, now once per sample-analysis per block instead of once per position
         for genome in self._genomes:
-            sample_call = genome.get_call( current_pos, None, current_contig, 'X' )
-            simplified_sample_call = Genome.simple_call( sample_call )
-            matrix_line += '' + sample_call + "\t"
-            call_data[simplified_sample_call] += 1
-            genome_nickname = genome.nickname()
-            genome_identifier = genome.identifier()
-            genome_path = genome.file_path()
-            was_called = genome.get_was_called( current_pos, current_contig )
-            call_data['callstring'] += '' + was_called
-            if was_called == 'Y':
-                was_called = True
-                call_data['called'] += 1
-            else:
-                was_called = False
-            self.record_sample_stat( 'was_called', genome_nickname, genome_identifier, genome_path, was_called )
-            passed_coverage = genome.get_coverage_pass( current_pos, current_contig )
-            call_data['covstring'] += '' + passed_coverage
-            if passed_coverage == 'Y' or passed_coverage == '-':
-                passed_coverage = True
-                call_data['passcov'] += 1
-            else:
-                passed_coverage = False
-            self.record_sample_stat( 'passed_coverage_filter', genome_nickname, genome_identifier, genome_path, passed_coverage )
-            passed_proportion = genome.get_proportion_pass( current_pos, current_contig )
-            call_data['propstring'] += '' + passed_proportion
-            if passed_proportion == 'Y' or passed_proportion == '-':
-                passed_proportion = True
-                call_data['passprop'] += 1
-            else:
-                passed_proportion = False
-            self.record_sample_stat( 'passed_proportion_filter', genome_nickname, genome_identifier, genome_path, passed_proportion )
-            if was_called and passed_coverage and passed_proportion:
-                if genome_nickname in consensus_check:
-                    if consensus_check[genome_nickname] != simplified_sample_call:
-                        consensus_check[genome_nickname] = 'N'
-                else:
-                    consensus_check[genome_nickname] = simplified_sample_call
+            call_block = genome.get_call_block( first_position, last_position, current_contig, 'X' )
+            simple_block = call_block.translate( Genome.SIMPLE_CALL_TABLE )
+            was_called_block = genome.get_was_called_block( first_position, last_position, current_contig )
+            coverage_block = genome.get_coverage_pass_block( first_position, last_position, current_contig )
+            proportion_block = genome.get_proportion_pass_block( first_position, last_position, current_contig )
+            was_called = _lane_mask( was_called_block, _YES_TABLE )
+            passed_coverage = _lane_mask( coverage_block, _PASSED_TABLE )
+            passed_proportion = _lane_mask( proportion_block, _PASSED_TABLE )
+            quality_call = was_called & passed_coverage & passed_proportion
+            simple_lanes = int.from_bytes( simple_block, 'big' )
+            quality_lanes = simple_lanes & ( quality_call * 0xFF )
+            called_reference = all_lanes ^ _differing_lanes( simple_lanes ^ simple_reference_lanes, all_lanes )
+            called_degen = _lane_mask( simple_block, _DEGEN_TABLE )
+            called_snp = all_lanes ^ ( called_reference | called_degen )
+            called_positions = quality_call & breadth_positions
+            all_called_lanes &= was_called
+            all_passed_coverage_lanes &= passed_coverage
+            all_passed_proportion_lanes &= passed_proportion
+            no_degen_lanes &= all_lanes ^ called_degen
+            snp_lanes |= quality_call & called_snp
+            stat_masks['was_called'].append( ( genome, all_lanes, was_called ) )
+            stat_masks['passed_coverage_filter'].append( ( genome, all_lanes, passed_coverage ) )
+            stat_masks['passed_proportion_filter'].append( ( genome, all_lanes, passed_proportion ) )
+            stat_masks['quality_breadth'].append( ( genome, breadth_positions, called_positions ) )
+            stat_masks['called_reference'].append( ( genome, called_positions, called_positions & called_reference ) )
+            stat_masks['called_snp'].append( ( genome, called_positions, called_positions & called_snp ) )
+            stat_masks['called_indel'].append( ( genome, called_positions, 0 ) )
+            stat_masks['called_degen'].append( ( genome, called_positions, called_positions & called_degen ) )
+            if genome.nickname() not in consensus_calls:
+                consensus_calls[genome.nickname()] = ( quality_lanes, quality_call & ( all_lanes ^ called_degen ) )
             else:
-                consensus_check[genome_nickname] = 'N'
-            # FIXME indels
-            if was_called and passed_coverage and passed_proportion and simplified_refcall != 'N':
-                if not dups_call:
-                    self.record_sample_stat( 'quality_breadth', genome_nickname, genome_identifier, genome_path, True )
-                if simplified_refcall == simplified_sample_call:
-                    call_data['refcall'] += 1
-                    if not dups_call:
-                        self.record_sample_stat( 'called_reference', genome_nickname, genome_identifier, genome_path, True )
-                        self.record_sample_stat( 'called_snp', genome_nickname, genome_identifier, genome_path, False )
-                        self.record_sample_stat( 'called_indel', genome_nickname, genome_identifier, genome_path, False )
-                        self.record_sample_stat( 'called_degen', genome_nickname, genome_identifier, genome_path, False )
-                elif simplified_sample_call != 'N':
-                    call_data['snpcall'] += 1
-                    if not dups_call:
-                        self.record_sample_stat( 'called_reference', genome_nickname, genome_identifier, genome_path, False )
-                        self.record_sample_stat( 'called_snp', genome_nickname, genome_identifier, genome_path, True )
-                        self.record_sample_stat( 'called_indel', genome_nickname, genome_identifier, genome_path, False )
-                        self.record_sample_stat( 'called_degen', genome_nickname, genome_identifier, genome_path, False )
-                else:
-                    if not dups_call:
-                        self.record_sample_stat( 'called_reference', genome_nickname, genome_identifier, genome_path, False )
-                        self.record_sample_stat( 'called_snp', genome_nickname, genome_identifier, genome_path, False )
-                        self.record_sample_stat( 'called_indel', genome_nickname, genome_identifier, genome_path, False )
-                        self.record_sample_stat( 'called_degen', genome_nickname, genome_identifier, genome_path, True )
-            elif simplified_refcall != 'N':
-                if not dups_call:
-                    self.record_sample_stat( 'quality_breadth', genome_nickname, genome_identifier, genome_path, False )
+                ( first_quality_lanes, agreeing_positions ) = consensus_calls[genome.nickname()]
+                consensus_calls[genome.nickname()] = ( first_quality_lanes, agreeing_positions & ( all_lanes ^ _differing_lanes( first_quality_lanes ^ quality_lanes, all_lanes ) ) )
+            columns['call'].append( call_block )
+            columns['simple'].append( simple_block )
+            columns['quality'].append( quality_lanes.to_bytes( block_length, 'big' ) )
+            columns['called'].append( was_called_block )
+            columns['coverage'].append( coverage_block )
+            columns['proportion'].append( proportion_block )
+            if matrix_format == "missingdata":
+                kept_call = quality_call & ( all_lanes ^ called_degen )
+                not_called = all_lanes ^ was_called
+                custom_lanes = ( int.from_bytes( call_block, 'big' ) & ( kept_call * 0xFF ) ) | ( not_called * ord( 'X' ) ) | ( ( all_lanes ^ kept_call ^ not_called ) * ord( 'N' ) )
+                columns['custom'].append( custom_lanes.to_bytes( block_length, 'big' ) )
+        for stat_id in stat_masks:
+            self._record_block_stat( stat_id, stat_masks[stat_id] )
+        consensus_lanes = all_lanes
+        for genome_nickname in consensus_calls:
+            passed_consensus = consensus_calls[genome_nickname][1]
+            consensus_lanes &= passed_consensus
+            self.add_sample_stat( 'consensus', genome_nickname, None, None, _count_lanes( passed_consensus ) )
+            self.add_cumulative_stat( 'consensus', 'any', genome_nickname, _count_lanes( passed_consensus ) )
+            self.add_cumulative_stat( 'consensus', 'all', genome_nickname, _count_lanes( passed_consensus ) )
+        if len( consensus_calls ) > 0:
+            any_consensus_lanes = 0
+            for genome_nickname in consensus_calls:
+                any_consensus_lanes |= consensus_calls[genome_nickname][1]
+            self.add_cumulative_stat( 'consensus', 'any', None, _count_lanes( any_consensus_lanes ) )
+            self.add_cumulative_stat( 'consensus', 'all', None, _count_lanes( consensus_lanes ) )
+        consensus_block = consensus_lanes.to_bytes( block_length, 'big' )
+        # The whole-collection conditions of every position, counted over the block rather than tallied line by line.
+        snp_lanes &= reference_clean
+        quality_breadth_lanes = consensus_lanes & not_duplicated & all_called_lanes & all_passed_coverage_lanes & all_passed_proportion_lanes & no_degen_lanes
+        self.increment_contig_stat( 'all_passed_consensus', current_contig, _count_lanes( consensus_lanes ) )
+        self.increment_contig_stat( 'all_called', current_contig, _count_lanes( all_called_lanes ) )
+        self.increment_contig_stat( 'all_passed_coverage', current_contig, _count_lanes( all_passed_coverage_lanes ) )
+        self.increment_contig_stat( 'all_passed_proportion', current_contig, _count_lanes( all_passed_proportion_lanes ) )
+        self.increment_contig_stat( 'quality_breadth', current_contig, _count_lanes( quality_breadth_lanes ) )
+        self.increment_contig_stat( 'best_snps', current_contig, _count_lanes( quality_breadth_lanes & snp_lanes ) )
+        self.increment_contig_stat( 'any_snps', current_contig, _count_lanes( not_duplicated & snp_lanes ) )
+        reference_rows = reference_block.decode( 'latin-1' )
+        simple_reference_rows = simple_reference_block.decode( 'latin-1' )
+        call_rows = _transpose_columns( columns['call'], block_length, b'\t' ).decode( 'latin-1' )
+        simple_rows = _transpose_columns( columns['simple'], block_length ).decode( 'latin-1' )
+        quality_rows = _transpose_columns( columns['quality'], block_length ).decode( 'latin-1' )
+        called_rows = _transpose_columns( columns['called'], block_length ).decode( 'latin-1' )
+        coverage_rows = _transpose_columns( columns['coverage'], block_length ).decode( 'latin-1' )
+        proportion_rows = _transpose_columns( columns['proportion'], block_length ).decode( 'latin-1' )
+        custom_rows = _transpose_columns( columns['custom'], block_length, b'\t' ).decode( 'latin-1' )
+        matrix_lines = []
+        custom_lines = []
+        count_columns = []
+        for block_index in range( block_length ):
+            current_pos = first_position + block_index
+            row_start = block_index * genome_count
+            row_end = row_start + genome_count
+            simple_row = simple_rows[row_start:row_end]
+            quality_row = quality_rows[row_start:row_end]
+            called_row = called_rows[row_start:row_end]
+            coverage_row = coverage_rows[row_start:row_end]
+            proportion_row = proportion_rows[row_start:row_end]
+            simplified_refcall = simple_reference_rows[block_index]
+            dups_call = ( dups_block[block_index] == 49 )
+            consensus_check = ( consensus_block[block_index] == 1 )
+            call_data = { 'snpcall': 0, 'refcall': 0, 'N': simple_row.count( 'N' ) }
+            if simplified_refcall != 'N':
+                call_data['refcall'] = quality_row.count( simplified_refcall )
+                call_data['snpcall'] = genome_count - quality_row.count( '\x00' ) - quality_row.count( 'N' ) - call_data['refcall']
+            call_data['called'] = called_row.count( 'Y' )
+            call_data['passcov'] = coverage_row.count( 'Y' ) + coverage_row.count( '-' )
+            call_data['passprop'] = proportion_row.count( 'Y' ) + proportion_row.count( '-' )
+            line_start = '' + current_contig + "::" + str( current_pos ) + "\t" + reference_rows[block_index] + "\t"
+            line_counts = "%d\t0\t%d\t%d/%d\t%d/%d\t%d/%d\t%d\t%d\t%d\t%d\t0\t%d\t%s\t%d\t%s\t%s\t" % ( call_data['snpcall'], call_data['refcall'], call_data['called'], genome_count, call_data['passcov'], genome_count, call_data['passprop'], genome_count, simple_row.count( 'A' ), simple_row.count( 'C' ), simple_row.count( 'G' ), simple_row.count( 'T' ), call_data['N'], current_contig, current_pos, dups_call, consensus_check )
+            line_end = '' + called_row + "\t" + coverage_row + "\t" + proportion_row + "\n"
+            if column_data is not None:
+                count_columns.append( ( call_data['snpcall'], call_data['refcall'], call_data['called'], call_data['passcov'], call_data['passprop'], simple_row.count( 'A' ), simple_row.count( 'C' ), simple_row.count( 'G' ), simple_row.count( 'T' ), call_data['N'] ) )
+            matrix_lines.append( line_start + call_rows[( row_start * 2 ):( row_end * 2 )] + failed_genome_tabs + line_counts + line_end )
             if matrix_format is None:
-                custom_line += '' + sample_call + "\t"
+                if not ( call_data['snpcall'] == 0 or call_data['snpcall'] + call_data['refcall'] < genome_count or dups_call or not consensus_check ):
+                    custom_lines.append( line_start + call_rows[( row_start * 2 ):( row_end * 2 )] + failed_genome_tabs + line_counts + "\n" )
             elif matrix_format == "missingdata":
-                if was_called and passed_coverage and passed_proportion and simplified_sample_call != 'N':
-                    custom_line += '' + sample_call + "\t"
-                elif not was_called:
-                    custom_line += "X\t"
-                else:
-                    custom_line += "N\t"
-        matrix_line += '' + '\t' * failed_genome_count
-        custom_line += '' + '\t' * failed_genome_count
-        for genome_nickname in consensus_check:
-            if consensus_check[genome_nickname] != 'N':
-                self.record_sample_stat( 'consensus', genome_nickname, None, None, True )
-            else:
-                self.record_sample_stat( 'consensus', genome_nickname, None, None, False )
-        # FIXME The hard way? Why?
-        matrix_line += '' + str( call_data['snpcall'] ) + "\t" + str( call_data['indelcall'] ) + "\t" + str( call_data['refcall'] ) + "\t"
-        custom_line += '' + str( call_data['snpcall'] ) + "\t" + str( call_data['indelcall'] ) + "\t" + str( call_data['refcall'] ) + "\t"
-        matrix_line += '' + str( call_data['called'] ) + "/" + str( genome_count ) + "\t" + str( call_data['passcov'] ) + "/" + str( genome_count ) + "\t" + str( call_data['passprop'] ) + "/" + str( genome_count ) + "\t"
-        custom_line += '' + str( call_data['called'] ) + "/" + str( genome_count ) + "\t" + str( call_data['passcov'] ) + "/" + str( genome_count ) + "\t" + str( call_data['passprop'] ) + "/" + str( genome_count ) + "\t"
-        matrix_line += '' + str( call_data['A'] ) + "\t" + str( call_data['C'] ) + "\t" + str( call_data['G'] ) + "\t" + str( call_data['T'] ) + "\t" + str( call_data['indel'] ) + "\t" + str( call_data['N'] ) + "\t"
-        custom_line += '' + str( call_data['A'] ) + "\t" + str( call_data['C'] ) + "\t" + str( call_data['G'] ) + "\t" + str( call_data['T'] ) + "\t" + str( call_data['indel'] ) + "\t" + str( call_data['N'] ) + "\t"
-        matrix_line += '' + current_contig + "\t" + str( current_pos ) + "\t"
-        custom_line += '' + current_contig + "\t" + str( current_pos ) + "\t"
-        if 'N' not in consensus_check.values():
-            consensus_check = True
-            self.increment_contig_stat( 'all_passed_consensus', current_contig )
-        else:
-            consensus_check = False
-        if call_data['called'] == genome_count:
-            self.increment_contig_stat( 'all_called', current_contig )
-        if call_data['passcov'] == genome_count:
-            self.increment_contig_stat( 'all_passed_coverage', current_contig )
-        if call_data['passprop'] == genome_count:
-            self.increment_contig_stat( 'all_passed_proportion', current_contig )
-        if consensus_check and not dups_call and call_data['called'] == genome_count and call_data['passcov'] == genome_count and call_data['passprop'] == genome_count and call_data['N'] == 0:
-            self.increment_contig_stat( 'quality_breadth', current_contig )
-            if call_data['snpcall'] > 0:
-                self.increment_contig_stat( 'best_snps', current_contig )
-        if not dups_call and call_data['snpcall'] > 0:
-            self.increment_contig_stat( 'any_snps', current_contig )
-        matrix_line += '' + str( dups_call ) + "\t" + str( consensus_check ) + "\t"
-        custom_line += '' + str( dups_call ) + "\t" + str( consensus_check ) + "\t"
-        matrix_line += '' + str( call_data['callstring'] ) + "\t" + str( call_data['covstring'] ) + "\t" + str( call_data['propstring'] ) + "\n"
-        if matrix_format is None:
-            if call_data['snpcall'] == 0 or call_data['indelcall'] > 0 or call_data['snpcall'] + call_data['refcall'] < genome_count or dups_call or not consensus_check:
-                custom_line = None
-            else:
-                custom_line += "\n"
-        elif matrix_format == "missingdata":
-            if call_data['snpcall'] == 0 or call_data['indelcall'] > 0 or dups_call:
-                custom_line = None
+                if not ( call_data['snpcall'] == 0 or dups_call ):
+                    custom_lines.append( line_start + custom_rows[( row_start * 2 ):( row_end * 2 )] + failed_genome_tabs + line_counts + line_end )
             else:
-                custom_line += '' + str( call_data['callstring'] ) + "\t" + str( call_data['covstring'] ) + "\t" + str( call_data['propstring'] ) + "\n"
-        self.flush_cumulative_stat_cache()
-        return ( matrix_line, custom_line )
-
-    def _send_to_matrix_handles( self, master_handle, custom_handle, matrix_format ):
+                custom_lines.append( line_start + failed_genome_tabs + line_counts )
+        if column_data is not None:
+            from array import array
+            column_data['reference'] = reference_block
+            column_data['calls'] = b''.join( columns['call'] )
+            column_data['was_called'] = b''.join( columns['called'] )
+            column_data['passed_coverage'] = b''.join( columns['coverage'] )
+            column_data['passed_proportion'] = b''.join( columns['proportion'] )
+            column_data['duplicated'] = ( all_lanes ^ not_duplicated ).to_bytes( block_length, 'big' )
+            column_data['consensus'] = consensus_block
+            for ( column_name, column_counts ) in zip( ( 'snp_count', 'reference_count', 'called_count', 'passed_coverage_count', 'passed_proportion_count', 'a_count', 'c_count', 'g_count', 't_count', 'degen_count' ), zip( *count_columns ) ):
+                column_data[column_name] = array( 'I', column_counts )
+        return ( ''.join( matrix_lines ), ''.join( custom_lines ) )
+
+    def _send_to_matrix_handles( self, master_handle, custom_handle, matrix_format, column_writer = None, matrix_index = None ):
+        self._send_header_to_matrix_handles( master_handle, custom_handle, matrix_format )
+        for matrix_shard in self._get_matrix_shards():
+            self._send_shard_to_matrix_handles( master_handle, custom_handle, matrix_shard, matrix_format, column_writer, matrix_index )
+
+    def _send_header_to_matrix_handles( self, master_handle, custom_handle, matrix_format ):
+        self._sort_genomes()
         master_handle.write( "LocusID\tReference\t" )
         custom_handle.write( "LocusID\tReference\t" )
         for genome in self._genomes:
@@ -541,94 +2078,248 @@ class GenomeCollection( CollectionStatistics ):
             custom_handle.write( "#SNPcall\t#Indelcall\t#Refcall\t#CallWasMade\t#PassedDepthFilter\t#PassedProportionFilter\t#A\t#C\t#G\t#T\t#Indel\t#NXdegen\tContig\tPosition\tInDupRegion\tSampleConsensus\n" )
         elif matrix_format == "missingdata":
             custom_handle.write( "#SNPcall\t#Indelcall\t#Refcall\t#CallWasMade\t#PassedDepthFilter\t#PassedProportionFilter\t#A\t#C\t#G\t#T\t#Indel\t#NXdegen\tContig\tPosition\tInDupRegion\tSampleConsensus\tCallWasMade\tPassedDepthFilter\tPassedProportionFilter\n" )
+
+    # Contigs with nothing to write out, like those outside of the regions, are left out of the statistics.
+    def _get_stats_contigs( self ):
+        return [ contig_name for contig_name in self.get_contigs() if len( self._get_contig_ranges( contig_name ) ) > 0 ]
+
+    def _get_stats_samples( self ):
+        return self._genome_identifiers
+
+    def _get_matrix_shards( self ):
+        matrix_shards = []
         for current_contig in self.get_contigs():
-            for current_pos in range( 1, self._reference.get_contig_length( current_contig ) + 1 ):
-                matrix_lines = self._format_matrix_line( current_contig, current_pos, matrix_format )
-                master_handle.write( matrix_lines[0] )
-                if matrix_lines[1] is not None:
-                    custom_handle.write( matrix_lines[1] )
+            for ( range_start, range_end ) in self._get_contig_ranges( current_contig ):
+                for first_position in range( range_start, range_end + 1, GenomeCollection.MATRIX_SHARD_SIZE ):
+                    matrix_shards.append( ( current_contig, first_position, min( first_position + GenomeCollection.MATRIX_SHARD_SIZE - 1, range_end ) ) )
+        return matrix_shards
 
-    def write_to_matrices( self, master_filename, custom_filename, matrix_format ):
+    # Writes a block of master matrix lines MATRIX_INDEX_ROWS at a time, adding a ( contig_name, position, byte_offset )
+    # entry to matrix_index for the first line of each. Every line starts with its locus, so the next group is a find() away.
+    @staticmethod
+    def _send_indexed_lines( master_handle, matrix_lines, current_contig, first_position, last_position, matrix_index ):
+        group_start = 0
+        for group_position in range( first_position, last_position + 1, GenomeCollection.MATRIX_INDEX_ROWS ):
+            group_end = matrix_lines.find( "\n{0}::{1}\t".format( current_contig, group_position + GenomeCollection.MATRIX_INDEX_ROWS ), group_start ) + 1
+            if group_end == 0:
+                group_end = len( matrix_lines )
+            matrix_index.append( ( current_contig, group_position, master_handle.tell() ) )
+            master_handle.write( matrix_lines[group_start:group_end] )
+            group_start = group_end
+
+    # column_writer is a MatrixColumnWriter, or a list to gather encoded chunks in, E.G. in a pool worker.
+    # matrix_index, if given, is a list to gather the index entries of the master matrix lines in.
+    def _send_shard_to_matrix_handles( self, master_handle, custom_handle, matrix_shard, matrix_format, column_writer = None, matrix_index = None ):
+        ( current_contig, first_position, last_position ) = matrix_shard
+        for block_start in range( first_position, last_position + 1, GenomeCollection.MATRIX_BLOCK_SIZE ):
+            block_end = min( block_start + GenomeCollection.MATRIX_BLOCK_SIZE - 1, last_position )
+            column_data = None if column_writer is None else {}
+            ( matrix_lines, custom_lines ) = self._format_matrix_block( current_contig, block_start, block_end, matrix_format, column_data )
+            if matrix_index is None:
+                master_handle.write( matrix_lines )
+            else:
+                GenomeCollection._send_indexed_lines( master_handle, matrix_lines, current_contig, block_start, block_end, matrix_index )
+            custom_handle.write( custom_lines )
+            if isinstance( column_writer, list ):
+                column_writer.append( MatrixColumnWriter.encode_chunk( current_contig, block_start, block_end - block_start + 1, column_data ) )
+            elif column_writer is not None:
+                column_writer.add_chunk( current_contig, block_start, block_end - block_start + 1, column_data )
+
+    # Runs in a pool worker holding its own copy of the collection, so the statistics gathered here belong to this shard alone.
+    # The encoded column chunks and index entries, if asked for, go back to the parent along with the statistics.
+    # Index offsets are within the master chunk.
+    def _write_matrix_shard( self, shard_number, matrix_shard, matrix_format, chunk_folder, write_columns = False, write_index = False ):
+        import os
+        CollectionStatistics.__init__( self )
+        master_chunk = os.path.join( chunk_folder, "master_{0}.tsv".format( shard_number ) )
+        custom_chunk = os.path.join( chunk_folder, "custom_{0}.tsv".format( shard_number ) )
+        master_handle = open( master_chunk, 'w' )
+        custom_handle = open( custom_chunk, 'w' )
+        column_chunks = [] if write_columns else None
+        index_entries = [] if write_index else None
+        self._send_shard_to_matrix_handles( master_handle, custom_handle, matrix_shard, matrix_format, column_chunks, index_entries )
+        master_handle.close()
+        custom_handle.close()
+        shard_stats = CollectionStatistics()
+        shard_stats.merge( self )
+        return ( master_chunk, custom_chunk, shard_stats, column_chunks, index_entries )
+
+    # Shards are formatted by a process pool into temporary chunks, which are appended to the matrices in reference order.
+    # The pool is always forked, whatever the platform's default start method: the workers inherit the collection, whose
+    # reference and genomes are usually memory mapped, and a memory map can not be pickled over to a spawned worker.
+    def _send_to_matrix_handles_in_parallel( self, master_handle, custom_handle, matrix_format, num_threads, chunk_folder, column_writer = None, matrix_index = None ):
+        import multiprocessing
+        import shutil
+        import os
+        matrix_shards = self._get_matrix_shards()
+        shard_pool = multiprocessing.get_context( 'fork' ).Pool( min( num_threads, max( len( matrix_shards ), 1 ) ), _initialize_matrix_shard_worker, [ self ] )
+        try:
+            shard_arguments = [ ( shard_number, matrix_shard, matrix_format, chunk_folder, column_writer is not None, matrix_index is not None ) for ( shard_number, matrix_shard ) in enumerate( matrix_shards ) ]
+            for ( master_chunk, custom_chunk, shard_stats, column_chunks, index_entries ) in shard_pool.imap( _write_matrix_shard, shard_arguments ):
+                if matrix_index is not None:
+                    chunk_offset = master_handle.tell()
+                    matrix_index.extend( ( contig_name, current_pos, chunk_offset + byte_offset ) for ( contig_name, current_pos, byte_offset ) in index_entries )
+                for ( output_handle, chunk_filename ) in ( ( master_handle, master_chunk ), ( custom_handle, custom_chunk ) ):
+                    chunk_handle = open( chunk_filename, 'r' )
+                    shutil.copyfileobj( chunk_handle, output_handle, 1048576 )
+                    chunk_handle.close()
+                    os.remove( chunk_filename )
+                self.merge( shard_stats )
+                if column_writer is not None:
+                    for ( chunk_entry, chunk_data ) in column_chunks:
+                        column_writer.add_encoded_chunk( chunk_entry, chunk_data )
+        finally:
+            shard_pool.terminate()
+            shard_pool.join()
+
+    # columns_filename, if given, is where a MatrixColumnWriter file of the master matrix goes, and index_filename where
+    # a MatrixIndex of it goes.
+    # Without fork, E.G. on Windows, the matrices are written by this process alone.
+    def write_to_matrices( self, master_filename, custom_filename, matrix_format, num_threads = 1, columns_filename = None, index_filename = None ):
+        import multiprocessing
+        import tempfile
+        import os
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            num_threads = 1
         master_handle = open( master_filename, 'w' )
         custom_handle = open( custom_filename, 'w' )
-        self._send_to_matrix_handles( master_handle, custom_handle, matrix_format )
+        column_writer = None
+        if columns_filename is not None:
+            self._sort_genomes()
+            column_writer = MatrixColumnWriter( columns_filename, [ genome.identifier() for genome in self._genomes ], list( self._failed_genomes ) )
+        matrix_index = None if index_filename is None else []
+        if num_threads > 1:
+            self._send_header_to_matrix_handles( master_handle, custom_handle, matrix_format )
+            chunk_folder = tempfile.mkdtemp( prefix="matrix_chunks_", dir=( os.path.dirname( os.path.abspath( master_filename ) ) ) )
+            try:
+                self._send_to_matrix_handles_in_parallel( master_handle, custom_handle, matrix_format, num_threads, chunk_folder, column_writer, matrix_index )
+            finally:
+                os.rmdir( chunk_folder )
+        else:
+            self._send_to_matrix_handles( master_handle, custom_handle, matrix_format, column_writer, matrix_index )
         master_handle.close()
         custom_handle.close()
+        if column_writer is not None:
+            column_writer.close()
+        if matrix_index is not None:
+            MatrixIndex.write_index_file( index_filename, master_filename, GenomeCollection.MATRIX_INDEX_ROWS, matrix_index )
 
-    def _write_general_stats( self, general_handle ):
-        general_stat_array = [ 'reference_length', 'reference_clean', 'reference_duplicated', 'all_called', 'all_passed_coverage', 'all_passed_proportion', 'all_passed_consensus', 'quality_breadth', 'any_snps', 'best_snps' ]
-        denominator_stat = 'reference_length'
-        general_handle.write( "Contig\t" )
-        for current_stat in general_stat_array:
-            general_handle.write( '' + current_stat + "\t" )
-            if current_stat != denominator_stat:
-                general_handle.write( '' + current_stat + " (%)\t" )
-        general_handle.write( "\n" )
-        general_handle.write( "\tstat descriptions go here\n" )
-        for current_contig in ( [ None ] + self.get_contigs() ):
-            denominator_value = self.get_contig_stat( denominator_stat, current_contig )
-            if current_contig is None:
-                general_handle.write( "Whole Genome\t" )
-            else:
-                general_handle.write( '' + current_contig + "\t" )
-            for current_stat in general_stat_array:
-                general_handle.write( '' + str( self.get_contig_stat( current_stat, current_contig ) ) + "\t" )
-                if current_stat != denominator_stat:
-                    general_handle.write( "%.2f%%\t" % ( self.get_contig_stat( current_stat, current_contig ) / denominator_value * 100 ) )
-            general_handle.write( "\n" )
-
-    def _write_sample_stats( self, sample_handle ):
-        sample_stat_array = [ 'was_called', 'passed_coverage_filter', 'passed_proportion_filter', 'called_reference', 'called_snp', 'called_degen' ]
-        #denominator_stat = 'reference_length'
-        #denominator_value = self.get_contig_stat( denominator_stat )
-        sample_handle.write( "Sample\tSample::Analysis\t" )
-        for current_stat in sample_stat_array:
-            sample_handle.write( '' + current_stat + "\t" )
-            #sample_handle.write( '' + current_stat + " (%)\t" )
-        sample_handle.write( "\n" )
-        sample_handle.write( "\tstat descriptions go here\n\n" )
-        for current_sample in ( [ None ] + sorted( self._genome_identifiers.keys() ) ):
-            for current_analysis in [ 'any', 'all' ]:
-                if current_sample is not None:
-                    sample_handle.write( "{0}\t".format( current_sample ) )
-                sample_handle.write( "[{0}]\t".format( current_analysis ) )
-                if current_sample is None:
-                    sample_handle.write( "\t" )
-                for current_stat in sample_stat_array:
-                    sample_handle.write( '' + str( self.get_cumulative_stat( current_stat, current_analysis, current_sample ) ) + "\t" )
-                    #if current_stat != denominator_stat:
-                    #    sample_handle.write( "%.2f%%\t" % ( self.get_contig_stat( current_stat, current_contig ) / denominator_value * 100 ) )
-                sample_handle.write( "\n" )
-            if current_sample is not None:
-                for current_analysis in sorted( self._genome_identifiers[current_sample].keys() ):
-                    ( sample_identifier, sample_path ) = current_analysis
-                    sample_handle.write( "{0}\t{1}\t".format( current_sample, sample_identifier ) )
-                    for current_stat in sample_stat_array:
-                        sample_handle.write( '' + str( self.get_sample_stat( current_stat, current_sample, sample_identifier, sample_path ) ) + "\t" )
-                        #if current_stat != denominator_stat:
-                        #    sample_handle.write( "%.2f%%\t" % ( self.get_contig_stat( current_stat, current_contig ) / denominator_value * 100 ) )
-                    sample_handle.write( "\n" )
-            sample_handle.write( "\n" )
-
-    def write_to_stats_files( self, general_filename, sample_filename ):
-        general_handle = open( general_filename, 'w' )
-        sample_handle = open( sample_filename, 'w' )
-        self._write_general_stats( general_handle )
-        self._write_sample_stats( sample_handle )
-        general_handle.close()
-        sample_handle.close()
-        #print( self._stats._contig_stats )
-        #print( self._stats._sample_stats )
+    # Pushes the next record of an input stream onto the merge heap, refusing to move backwards along the reference.
+    @staticmethod
+    def _push_stream_record( merge_heap, input_streams, stream_number, stream_positions, contig_ranks ):
+        import heapq
+        ( genome_windows, stream_records ) = input_streams[stream_number]
+        for ( contig_name, first_position, record_data ) in stream_records:
+            if contig_name in contig_ranks:
+                stream_position = ( contig_ranks[contig_name], first_position )
+                if stream_position < stream_positions[stream_number]:
+                    raise MalformedInputFile( genome_windows[0].file_path(), "records are not sorted in reference order at position {0} on contig '{1}'".format( first_position, contig_name ) )
+                stream_positions[stream_number] = stream_position
+                heapq.heappush( merge_heap, ( stream_position[0], first_position, stream_number, record_data ) )
+                break
+
+    # K-way merge of coordinate-sorted inputs. Each input stream is ( genome_windows, records ), where the windows have
+    # already been added to this collection and records yields ( contig_name, first_position, record_data ) in reference order.
+    # record_data is either a run of calls for a single window, or a list of set_values() arguments, one per window.
+    # Matrix lines are written block by block, as soon as every stream has moved past the block, in reference file order.
+    def write_streamed_matrices( self, master_filename, custom_filename, matrix_format, input_streams ):
+        self._write_matrix_files( master_filename, custom_filename, self._send_streamed_matrices, matrix_format, input_streams )
+
+    def _send_streamed_matrices( self, master_handle, custom_handle, matrix_format, input_streams ):
+        import heapq
+        self._send_header_to_matrix_handles( master_handle, custom_handle, matrix_format )
+        contig_ranks = dict( ( contig_name, contig_rank ) for ( contig_rank, contig_name ) in enumerate( self._reference.get_contigs( False ) ) )
+        stream_positions = [ ( -1, 0 ) ] * len( input_streams )
+        merge_heap = []
+        for stream_number in range( len( input_streams ) ):
+            GenomeCollection._push_stream_record( merge_heap, input_streams, stream_number, stream_positions, contig_ranks )
+        stream_blocks = []
+        for current_contig in self._reference.get_contigs( False ):
+            for ( range_start, range_end ) in self._get_contig_ranges( current_contig ):
+                for first_position in range( range_start, range_end + 1, GenomeCollection.STREAMING_BLOCK_SIZE ):
+                    stream_blocks.append( ( current_contig, first_position, min( first_position + GenomeCollection.STREAMING_BLOCK_SIZE - 1, range_end ) ) )
+        for ( current_contig, first_position, last_position ) in stream_blocks:
+            for genome in self._genomes:
+                genome.reset_window( current_contig, first_position, last_position )
+            while len( merge_heap ) > 0 and merge_heap[0][0:2] <= ( contig_ranks[current_contig], last_position ):
+                ( contig_rank, record_position, stream_number, record_data ) = heapq.heappop( merge_heap )
+                genome_windows = input_streams[stream_number][0]
+                # A run that started in a gap between regions is trimmed to the part inside the block
+                if isinstance( record_data, ( bytes, bytearray ) ) and contig_rank == contig_ranks[current_contig] and record_position < first_position < record_position + len( record_data ):
+                    ( record_position, record_data ) = ( first_position, record_data[( first_position - record_position ):] )
+                # Anything left behind the current block ran off the end of its contig
+                if ( contig_rank, record_position ) >= ( contig_ranks[current_contig], first_position ):
+                    if isinstance( record_data, ( bytes, bytearray ) ):
+                        if record_position + len( record_data ) - 1 > last_position:
+                            genome_windows[0].set_call_range( record_data[:( last_position - record_position + 1 )], record_position )
+                            heapq.heappush( merge_heap, ( contig_rank, last_position + 1, stream_number, record_data[( last_position - record_position + 1 ):] ) )
+                            continue
+                        genome_windows[0].set_call_range( record_data, record_position )
+                    else:
+                        for window_number in range( len( genome_windows ) ):
+                            genome_windows[window_number].set_values( record_position, *record_data[window_number] )
+                GenomeCollection._push_stream_record( merge_heap, input_streams, stream_number, stream_positions, contig_ranks )
+            ( matrix_lines, custom_lines ) = self._format_matrix_block( current_contig, first_position, last_position, matrix_format )
+            master_handle.write( matrix_lines )
+            custom_handle.write( custom_lines )
+
+    # Contig-at-a-time matrix generation. Each contig stream is ( genomes, contig_loads ), where the genomes have already been
+    # added to this collection and contig_loads loads their data for one contig at a time, in get_contigs() order, and yields
+    # the name of each contig once it is loaded. It is advanced again once the contig has been written out, so it can release
+    # that contig before loading the next. Only a single contig of every genome needs to be held in memory.
+    def write_contig_matrices( self, master_filename, custom_filename, matrix_format, contig_streams ):
+        self._write_matrix_files( master_filename, custom_filename, self._send_contig_matrices, matrix_format, contig_streams )
+
+    def _send_contig_matrices( self, master_handle, custom_handle, matrix_format, contig_streams ):
+        self._send_header_to_matrix_handles( master_handle, custom_handle, matrix_format )
+        for current_contig in self.get_contigs():
+            for ( contig_genomes, contig_loads ) in contig_streams:
+                loaded_contig = next( contig_loads )
+                if loaded_contig != current_contig:
+                    raise ValueError( "contig stream loaded '{0}' where '{1}' was expected".format( loaded_contig, current_contig ) )
+            for ( range_start, range_end ) in self._get_contig_ranges( current_contig ):
+                self._send_shard_to_matrix_handles( master_handle, custom_handle, ( current_contig, range_start, range_end ), matrix_format )
+        for ( contig_genomes, contig_loads ) in contig_streams:
+            next( contig_loads, None )
+
+    # The streamed and contig-at-a-time modes read their inputs while the matrices are being written, so they write them
+    # under temporary names and only move them into place once send_matrices() has finished. A run that stops part way
+    # through removes its partial matrices instead of leaving them behind to be mistaken for complete ones.
+    def _write_matrix_files( self, master_filename, custom_filename, send_matrices, *send_arguments ):
+        import os
+        temporary_suffix = ".tmp{0}".format( os.getpid() )
+        master_handle = open( master_filename + temporary_suffix, 'w' )
+        custom_handle = open( custom_filename + temporary_suffix, 'w' )
+        try:
+            send_matrices( master_handle, custom_handle, *send_arguments )
+        except:
+            master_handle.close()
+            custom_handle.close()
+            os.remove( master_filename + temporary_suffix )
+            os.remove( custom_filename + temporary_suffix )
+            raise
+        master_handle.close()
+        custom_handle.close()
+        os.replace( master_filename + temporary_suffix, master_filename )
+        os.replace( custom_filename + temporary_suffix, custom_filename )
 
 
 class VCFRecord:
 
-    def __init__( self, file_path ):
+    # caller_name is the snpcaller that made the file, E.G. from its input file tag. If it is not given,
+    # the ##source line and other meta-information keys of the header are used to find the record dialect.
+    # Files have to be opened seekable for set_record_section() to work on them.
+    def __init__( self, file_path, caller_name = None, seekable = False ):
         self._file_path = file_path
-        self._file_handle = open( self._file_path, 'r' )
+        self._file_handle = open_input_file( self._file_path, 'r', seekable=seekable )
+        self._lines_left = None
+        self._regions = None
         self._header_list = []
         self._sample_list = []
         self._current_record = {}
+        self._block_columns = None
+        self._format_decoders = {}
+        self._dialect = VCFRecord.find_dialect( caller_name )
         self._get_header_map()
 
     def _get_header_map( self ):
@@ -637,6 +2328,9 @@ class VCFRecord:
             current_line = self._file_handle.readline()
             if current_line == '':
                 raise MalformedInputFile( self._file_path, "mandatory VCF header not found or not recognized" )
+            if self._dialect is None and current_line[0:2] == "##":
+                ( meta_key, separator, meta_value ) = current_line[2:].rstrip().partition( '=' )
+                self._dialect = VCFRecord.find_dialect( meta_value if meta_key == "source" else meta_key )
         header_list = current_line.rstrip()[1:].split( "\t" )
         sample_headers_started = False
         for current_header in header_list:
@@ -773,6 +2467,343 @@ class VCFRecord:
         sample_info['proportion'] = self.get_proportion( current_sample, sample_info['coverage'], sample_info['is_a_snp'] )
         return sample_info
 
+    # Number of sample values read and parsed together by fetch_record_block(), so wide multi-sample VCFs get shorter blocks.
+    RECORD_BLOCK_SIZE = 65536
+    # The only INFO keys get_coverage() and get_proportion() ever look at. All of them contain 'DP' or 'AR'.
+    _BLOCK_INFO_KEYS = ( 'DP', 'ADP', 'AR', 'DP4' )
+
+    # Batch counterpart of fetch_next_record(). Reads up to block_size lines, splits each into its columns once,
+    # and decodes only the fields get_sample_info() would use into a VCFRecordBlock. Returns None at the end of the file.
+    def fetch_record_block( self, block_size = None ):
+        import itertools
+        if block_size is None:
+            block_size = max( VCFRecord.RECORD_BLOCK_SIZE // len( self._sample_list ), 64 )
+        record_lines = []
+        while len( record_lines ) == 0:
+            if self._lines_left is not None:
+                block_size = min( block_size, self._lines_left )
+            next_lines = list( itertools.islice( self._file_handle, block_size ) )
+            if self._lines_left is not None:
+                self._lines_left -= len( next_lines )
+            if len( next_lines ) == 0:
+                return None
+            record_lines = [ current_line for current_line in next_lines if current_line[0:1] != "#" and not current_line.isspace() ]
+            if self._regions is not None and len( record_lines ) > 0:
+                record_lines = self._get_region_lines( record_lines )
+        return self._decode_record_block( record_lines )
+
+    # Only records inside the regions, a GenomeRegions, are decoded by fetch_record_block() from then on.
+    def set_regions( self, regions ):
+        self._regions = regions
+
+    def _get_region_lines( self, record_lines ):
+        ( contig_column, position_column ) = self._get_block_columns()[0:2]
+        split_count = max( contig_column, position_column ) + 1
+        region_lines = []
+        for current_line in record_lines:
+            line_fields = current_line.split( '\t', split_count )
+            if self._regions.contains( line_fields[contig_column], int( line_fields[position_column] ) ):
+                region_lines.append( current_line )
+        return region_lines
+
+    # One pass over the records that finds where each contig's lines are, as { contig: [ ( offset, line_count ), ... ] },
+    # with a section for every stretch of consecutive lines of the contig. Offsets count bytes of the uncompressed file.
+    def get_contig_sections( self ):
+        contig_column = self._header_list.index( 'CHROM' )
+        contig_sections = {}
+        current_contig = None
+        current_section = None
+        current_offset = 0
+        with open_input_file( self._file_path ) as section_handle:
+            for record_line in section_handle:
+                line_start = current_offset
+                current_offset += len( record_line )
+                if record_line[0:1] != b'#' and not record_line.isspace():
+                    line_contig = record_line.split( b'\t', contig_column + 1 )[contig_column].decode( 'utf-8' )
+                    if line_contig != current_contig:
+                        current_contig = line_contig
+                        current_section = [ line_start, 0 ]
+                        contig_sections.setdefault( current_contig, [] ).append( current_section )
+                if current_section is not None:
+                    current_section[1] += 1
+        return dict( ( contig_name, [ tuple( contig_section ) for contig_section in contig_sections[contig_name] ] ) for contig_name in contig_sections )
+
+    # Moves to a section found by get_contig_sections(); fetch_record_block() stops at its end.
+    def set_record_section( self, section_offset, line_count ):
+        self._file_handle.seek( section_offset )
+        self._lines_left = line_count
+
+    def _get_block_columns( self ):
+        if self._block_columns is None:
+            format_column = self._header_list.index( 'FORMAT' ) if 'FORMAT' in self._header_list else None
+            sample_columns = [ self._header_list.index( current_sample ) for current_sample in self._sample_list ] if format_column is not None else []
+            self._block_columns = ( self._header_list.index( 'CHROM' ), self._header_list.index( 'POS' ), self._header_list.index( 'REF' ), self._header_list.index( 'ALT' ), self._header_list.index( 'INFO' ), format_column, sample_columns )
+        return self._block_columns
+
+    @staticmethod
+    def _get_block_info( info_string ):
+        info_values = {}
+        if 'DP' in info_string or 'AR' in info_string:
+            for info_entry in info_string.split( ';' ):
+                ( info_key, separator, info_value ) = info_entry.partition( '=' )
+                if info_key in VCFRecord._BLOCK_INFO_KEYS:
+                    info_values[info_key] = info_value if separator else None
+        return info_values
+
+    # Maps the FORMAT keys the decoders use to their index in a sample column, and picks the sample decoder for lines with
+    # that FORMAT, once per distinct FORMAT string. Returns ( ( gt_index, dp_index, ad_index, rd_index, minimum_fields ), decoder ).
+    def _get_format_decoder( self, format_string ):
+        if format_string not in self._format_decoders:
+            format_indexes = {}
+            if format_string is not None:
+                for ( format_index, format_key ) in enumerate( format_string.split( ':' ) ):
+                    if format_key in ( 'GT', 'DP', 'AD', 'RD' ):
+                        format_indexes[format_key] = format_index
+            sample_decoder = VCFRecord._decode_generic_sample
+            minimum_fields = 0
+            if self._dialect is not None:
+                ( required_keys, excluded_keys, decoder_name ) = VCFRecord._DIALECT_DECODERS[self._dialect]
+                if all( format_key in format_indexes for format_key in required_keys ) and not any( format_key in format_indexes for format_key in excluded_keys ):
+                    sample_decoder = getattr( VCFRecord, decoder_name )
+                    minimum_fields = max( [ format_indexes[format_key] + 1 for format_key in required_keys ] + [ 0 ] )
+            format_indexes = tuple( format_indexes.get( format_key ) for format_key in ( 'GT', 'DP', 'AD', 'RD' ) )
+            self._format_decoders[format_string] = ( format_indexes + ( minimum_fields, ), sample_decoder )
+        return self._format_decoders[format_string]
+
+    # Gives the same call, coverage and proportion get_sample_info() would for every sample of every line.
+    def _decode_record_block( self, record_lines ):
+        ( chrom_column, pos_column, ref_column, alt_column, info_column, format_column, sample_columns ) = self._get_block_columns()
+        sample_count = len( self._sample_list )
+        record_block = VCFRecordBlock( sample_count )
+        sample_rows = []
+        for current_line in record_lines:
+            record_fields = current_line.rstrip().split( "\t" )
+            reference_call = record_fields[ref_column]
+            alt_calls = [ reference_call ]
+            if record_fields[alt_column] != '.':
+                alt_calls += record_fields[alt_column].split( ',' )
+            info_values = VCFRecord._get_block_info( record_fields[info_column] )
+            info_coverage = None
+            if info_values.get( 'DP' ) is not None and info_values['DP'].isdigit():
+                info_coverage = int( info_values['DP'] ) / sample_count
+            elif info_values.get( 'ADP' ) is not None and info_values['ADP'].isdigit():
+                info_coverage = int( info_values['ADP'] ) / sample_count
+            line_data = ( reference_call, alt_calls, Genome.simple_call( reference_call ), info_values, info_coverage, sample_count, {} )
+            if format_column is not None and len( record_fields ) > format_column:
+                ( format_indexes, sample_decoder ) = self._get_format_decoder( record_fields[format_column] )
+                sample_strings = [ record_fields[sample_column] for sample_column in sample_columns ]
+            else:
+                ( format_indexes, sample_decoder ) = self._get_format_decoder( None )
+                format_indexes = None
+                sample_strings = [ None ] * sample_count
+            record_block.contigs.append( record_fields[chrom_column] )
+            record_block.positions.append( int( record_fields[pos_column] ) )
+            record_block.reference_calls.append( reference_call )
+            sample_rows.append( [ sample_decoder( line_data, format_indexes, sample_string ) for sample_string in sample_strings ] )
+        record_block.set_sample_columns( sample_rows )
+        return record_block
+
+    # Picks the call get_sample_call() would, given the sample's GT allele number. is_a_snp follows get_sample_info().
+    # Samples on the same line mostly share a genotype, so each answer is cached for the rest of the line.
+    @staticmethod
+    def _get_block_call( line_data, alt_number, has_format ):
+        call_cache = line_data[6]
+        if alt_number in call_cache:
+            return call_cache[alt_number]
+        ( reference_call, alt_calls, simple_reference ) = line_data[0:3]
+        # FIXME indels
+        sample_call = None
+        if len( alt_calls ) == 1:
+            sample_call = alt_calls[0]
+        elif has_format:
+            if alt_number is not None and alt_number.isdigit():
+                sample_call = alt_calls[int( alt_number )]
+                # OMG varscan
+                if len( reference_call ) > 1 and ( len( reference_call ) - 1 ) == len( sample_call ) and reference_call[:len( sample_call )] != sample_call and reference_call[-len( sample_call ):] == sample_call:
+                    sample_call = alt_calls[0]
+        else:
+            sample_call = alt_calls[1]
+        if sample_call is not None and len( sample_call ) > 1:
+            sample_call = sample_call[0]
+        is_a_snp = sample_call is not None and sample_call != 'N' and Genome.simple_call( sample_call ) != simple_reference
+        call_cache[alt_number] = ( sample_call, is_a_snp )
+        return call_cache[alt_number]
+
+    # Sample decoders return ( call, coverage, proportion, is_a_snp ) for one sample column, None when the line has no FORMAT.
+    # The generic decoder probes for every caller's way of reporting depths, in the same order get_proportion() does.
+    @staticmethod
+    def _decode_generic_sample( line_data, format_indexes, sample_string ):
+        ( info_values, info_coverage, sample_count ) = line_data[3:6]
+        alt_number = None
+        sample_coverage = info_coverage
+        sample_depths = None
+        read_depth = None
+        if sample_string is not None:
+            ( gt_index, dp_index, ad_index, rd_index ) = format_indexes[0:4]
+            sample_fields = sample_string.split( ':' )
+            field_count = len( sample_fields )
+            if gt_index is not None and gt_index < field_count:
+                alt_number = sample_fields[gt_index].split( '/', 1 )[0].split( '|', 1 )[0]
+            if dp_index is not None and dp_index < field_count and sample_fields[dp_index].isdigit():
+                sample_coverage = int( sample_fields[dp_index] )
+            if ad_index is not None and ad_index < field_count:
+                sample_depths = sample_fields[ad_index].split( ',' )
+            if rd_index is not None and rd_index < field_count:
+                read_depth = sample_fields[rd_index]
+        ( sample_call, is_a_snp ) = VCFRecord._get_block_call( line_data, alt_number, sample_string is not None )
+        sample_proportion = None
+        if sample_depths is not None:
+            if len( sample_depths ) > 1:
+                if alt_number is not None and alt_number.isdigit():
+                    sample_proportion = int( sample_depths[int( alt_number )] ) / sample_coverage
+            elif is_a_snp:
+                sample_proportion = int( sample_depths[0] ) / sample_coverage
+            elif read_depth is not None:
+                sample_proportion = int( read_depth ) / sample_coverage
+        elif 'AR' in info_values:
+            sample_proportion = float( info_values['AR'] )
+            if not is_a_snp:
+                sample_proportion = 1 - sample_proportion
+        elif 'DP4' in info_values:
+            call_depths = info_values['DP4'].split( ',' )
+            if is_a_snp:
+                sample_proportion = ( int( call_depths[2] ) + int( call_depths[3] ) ) / ( sample_coverage * sample_count )
+            else:
+                sample_proportion = ( int( call_depths[0] ) + int( call_depths[1] ) ) / ( sample_coverage * sample_count )
+        return ( sample_call, sample_coverage, sample_proportion, is_a_snp )
+
+    # GATK: GT:AD:DP, with a depth for every allele in AD.
+    @staticmethod
+    def _decode_gatk_sample( line_data, format_indexes, sample_string ):
+        ( gt_index, dp_index, ad_index, rd_index, minimum_fields ) = format_indexes
+        sample_fields = sample_string.split( ':' )
+        if len( sample_fields ) < minimum_fields or not sample_fields[dp_index].isdigit():
+            return VCFRecord._decode_generic_sample( line_data, format_indexes, sample_string )
+        alt_number = sample_fields[gt_index].split( '/', 1 )[0].split( '|', 1 )[0]
+        sample_coverage = int( sample_fields[dp_index] )
+        ( sample_call, is_a_snp ) = VCFRecord._get_block_call( line_data, alt_number, True )
+        sample_depths = sample_fields[ad_index].split( ',' )
+        sample_proportion = None
+        if len( sample_depths ) > 1:
+            if alt_number.isdigit():
+                sample_proportion = int( sample_depths[int( alt_number )] ) / sample_coverage
+        elif is_a_snp:
+            sample_proportion = int( sample_depths[0] ) / sample_coverage
+        return ( sample_call, sample_coverage, sample_proportion, is_a_snp )
+
+    # VarScan: GT:...:DP:RD:AD, with the reference depth in RD and the single variant depth in AD.
+    @staticmethod
+    def _decode_varscan_sample( line_data, format_indexes, sample_string ):
+        ( gt_index, dp_index, ad_index, rd_index, minimum_fields ) = format_indexes
+        sample_fields = sample_string.split( ':' )
+        if len( sample_fields ) < minimum_fields or not sample_fields[dp_index].isdigit() or ',' in sample_fields[ad_index]:
+            return VCFRecord._decode_generic_sample( line_data, format_indexes, sample_string )
+        sample_coverage = int( sample_fields[dp_index] )
+        ( sample_call, is_a_snp ) = VCFRecord._get_block_call( line_data, sample_fields[gt_index].split( '/', 1 )[0].split( '|', 1 )[0], True )
+        if is_a_snp:
+            sample_proportion = int( sample_fields[ad_index] ) / sample_coverage
+        else:
+            sample_proportion = int( sample_fields[rd_index] ) / sample_coverage
+        return ( sample_call, sample_coverage, sample_proportion, is_a_snp )
+
+    # SolSNP: no per-sample depths, and the allele ratio of the call in INFO AR.
+    @staticmethod
+    def _decode_solsnp_sample( line_data, format_indexes, sample_string ):
+        if 'AR' not in line_data[3]:
+            return VCFRecord._decode_generic_sample( line_data, format_indexes, sample_string )
+        alt_number = None
+        sample_coverage = line_data[4]
+        if sample_string is not None:
+            ( gt_index, dp_index ) = format_indexes[0:2]
+            sample_fields = sample_string.split( ':' )
+            if gt_index is not None and gt_index < len( sample_fields ):
+                alt_number = sample_fields[gt_index].split( '/', 1 )[0].split( '|', 1 )[0]
+            if dp_index is not None and dp_index < len( sample_fields ) and sample_fields[dp_index].isdigit():
+                sample_coverage = int( sample_fields[dp_index] )
+        ( sample_call, is_a_snp ) = VCFRecord._get_block_call( line_data, alt_number, sample_string is not None )
+        sample_proportion = float( line_data[3]['AR'] )
+        if not is_a_snp:
+            sample_proportion = 1 - sample_proportion
+        return ( sample_call, sample_coverage, sample_proportion, is_a_snp )
+
+    # samtools: no per-sample depths, and the read counts of the whole record in INFO DP4.
+    @staticmethod
+    def _decode_samtools_sample( line_data, format_indexes, sample_string ):
+        info_values = line_data[3]
+        if 'DP4' not in info_values or 'AR' in info_values:
+            return VCFRecord._decode_generic_sample( line_data, format_indexes, sample_string )
+        alt_number = None
+        sample_coverage = line_data[4]
+        if sample_string is not None:
+            ( gt_index, dp_index ) = format_indexes[0:2]
+            sample_fields = sample_string.split( ':' )
+            if gt_index is not None and gt_index < len( sample_fields ):
+                alt_number = sample_fields[gt_index].split( '/', 1 )[0].split( '|', 1 )[0]
+            if dp_index is not None and dp_index < len( sample_fields ) and sample_fields[dp_index].isdigit():
+                sample_coverage = int( sample_fields[dp_index] )
+        ( sample_call, is_a_snp ) = VCFRecord._get_block_call( line_data, alt_number, sample_string is not None )
+        call_depths = info_values['DP4'].split( ',' )
+        if is_a_snp:
+            sample_proportion = ( int( call_depths[2] ) + int( call_depths[3] ) ) / ( sample_coverage * line_data[5] )
+        else:
+            sample_proportion = ( int( call_depths[0] ) + int( call_depths[1] ) ) / ( sample_coverage * line_data[5] )
+        return ( sample_call, sample_coverage, sample_proportion, is_a_snp )
+
+    # Record decoders for the callers the pipeline runs, as ( FORMAT keys required, FORMAT keys excluded, sample decoder ).
+    # Lines whose FORMAT does not have the caller's layout, and samples or lines that turn out not to fit it,
+    # are handed to the generic decoder, so the results never differ from it.
+    _DIALECT_DECODERS = {
+        'gatk': ( ( 'GT', 'DP', 'AD' ), ( 'RD', ), '_decode_gatk_sample' ),
+        'varscan': ( ( 'GT', 'DP', 'AD', 'RD' ), (), '_decode_varscan_sample' ),
+        'solsnp': ( (), ( 'AD', ), '_decode_solsnp_sample' ),
+        'samtools': ( (), ( 'AD', ), '_decode_samtools_sample' )
+    }
+
+    # Patterns that pick a dialect out of a snpcaller name or a ##source header line, tried in order.
+    DIALECT_PATTERNS = ( ( 'gatk', r'gatk|unifiedgenotyper|haplotypecaller' ), ( 'varscan', r'varscan' ), ( 'solsnp', r'solsnp' ), ( 'samtools', r'samtools|bcftools' ) )
+
+    @staticmethod
+    def find_dialect( caller_name ):
+        import re
+        if caller_name is not None:
+            for ( dialect_name, dialect_pattern ) in VCFRecord.DIALECT_PATTERNS:
+                if re.search( dialect_pattern, caller_name, re.IGNORECASE ):
+                    return dialect_name
+        return None
+
+    def get_dialect( self ):
+        return self._dialect
+
+
+# The decoded contents of a block of VCF lines, one entry per line, with the sample data kept as one column per sample.
+# Coverage and proportion are double arrays where NO_DATA ( a NaN ) stands in for the None get_sample_info() would return.
+class VCFRecordBlock:
+
+    NO_DATA = float( 'nan' )
+
+    def __init__( self, sample_count ):
+        from array import array
+        self.contigs = []
+        self.positions = array( 'q' )
+        self.reference_calls = []
+        self.calls = [ [] for sample_index in range( sample_count ) ]
+        self.coverages = [ array( 'd' ) for sample_index in range( sample_count ) ]
+        self.proportions = [ array( 'd' ) for sample_index in range( sample_count ) ]
+        self.snps = [ bytearray() for sample_index in range( sample_count ) ]
+
+    def get_record_count( self ):
+        return len( self.positions )
+
+    # Turns one row of ( call, coverage, proportion, is_a_snp ) sample values per line into the per-sample columns.
+    def set_sample_columns( self, sample_rows ):
+        from array import array
+        for sample_index in range( len( self.calls ) ):
+            ( sample_calls, sample_coverages, sample_proportions, sample_snps ) = zip( *[ sample_row[sample_index] for sample_row in sample_rows ] ) if len( sample_rows ) > 0 else ( (), (), (), () )
+            self.calls[sample_index] = list( sample_calls )
+            self.coverages[sample_index] = array( 'd', [ VCFRecordBlock.NO_DATA if sample_coverage is None else sample_coverage for sample_coverage in sample_coverages ] )
+            self.proportions[sample_index] = array( 'd', [ VCFRecordBlock.NO_DATA if sample_proportion is None else sample_proportion for sample_proportion in sample_proportions ] )
+            self.snps[sample_index] = bytearray( sample_snps )
+
 
 class InvalidContigName( Exception ):
 
@@ -0,0 +1,630 @@
+#!/usr/bin/env python3
+
+'''
+Created on Oct 17, 2026
+
+@author: dsmith
+'''
+
+import logging
+import unittest
+import os
+
+
+class GenomeStatusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from nasp_objects import GenomeStatus
+        self.status = GenomeStatus()
+        self.fasta_out = "genome_status_test.fasta"
+
+    def tearDown(self):
+        if os.path.exists(self.fasta_out) : os.remove(self.fasta_out)
+
+    def test_set_value_extends_with_filler(self):
+        self.status.set_value("A", 5, "X", "contig_1")
+        self.assertEqual(self.status.get_contig_length("contig_1"), 5)
+        self.assertEqual(self.status.get_value(1, 5, "contig_1"), ["X", "X", "X", "X", "A"])
+
+    def test_set_value_list(self):
+        self.status.set_value(["A", "C", "G"], 2, "X", "contig_1")
+        self.assertEqual(self.status.get_value(1, -1, "contig_1"), ["X", "A", "C", "G"])
+
+    def test_get_value_past_end(self):
+        self.status.append_contig(list("ACGT"), "contig_1")
+        self.assertEqual(self.status.get_value(3, None, "contig_1", "?"), "G")
+        self.assertEqual(self.status.get_value(9, None, "contig_1", "?"), "?")
+        self.assertEqual(self.status.get_value(3, 6, "contig_1", "?"), ["G", "T", "?", "?"])
+
+    def test_extend_contig_preallocates(self):
+        self.status.extend_contig(1000, "N", "contig_1")
+        self.assertIsInstance(self.status._status_data["contig_1"], bytearray)
+        self.assertEqual(len(self.status._status_data["contig_1"]), 1000)
+        self.status.set_value("Y", 10, "N", "contig_1")
+        self.assertEqual(self.status.get_contig_length("contig_1"), 1000)
+        self.assertEqual(self.status.get_value(10, None, "contig_1"), "Y")
+
+    def test_run_length_contigs(self):
+        from nasp_objects import GenomeStatus, RunLengthContig
+        status = GenomeStatus(RunLengthContig)
+        status.extend_contig(100000, "0", "contig_1")
+        status.set_value("111", 50, "!", "contig_1")
+        status.set_value("1", 120000, "0", "contig_1")
+        self.assertEqual(status.get_contig_length("contig_1"), 120000)
+        self.assertEqual(status._status_data["contig_1"].get_run_count(), 4)
+        self.assertEqual(status.get_value(48, 54, "contig_1"), list("0011100"))
+        self.assertEqual(status.get_value_block(119999, 120002, "contig_1", "?"), b"01??")
+        status.set_value("0", 51, "!", "contig_1")
+        self.assertEqual(status.get_value(49, 53, "contig_1"), list("01010"))
+        status.to_dense()
+        self.assertIsInstance(status._status_data["contig_1"], bytearray)
+        self.assertEqual(status.get_value(49, 53, "contig_1"), list("01010"))
+        self.assertEqual(status.get_value(120000, None, "contig_1"), "1")
+
+    def test_write_to_fasta_file(self):
+        self.status.append_contig("ACGT" * 30, "contig_b")
+        self.status.append_contig("TTTT", "contig_a")
+        self.status.write_to_fasta_file(self.fasta_out, "franken::")
+        with open(self.fasta_out) as fasta_handle:
+            self.assertEqual(fasta_handle.read(), ">franken::contig_a\nTTTT\n>franken::contig_b\n" + ("ACGT" * 20) + "\n" + ("ACGT" * 10) + "\n")
+
+    def test_write_to_fasta_file_single_line(self):
+        from nasp_objects import GenomeStatus
+        self.status.append_contig("ACGT" * 30, "contig_1")
+        self.status.append_contig("", "contig_2")
+        GenomeStatus.FASTA_WRITE_SIZE = 7
+        try:
+            self.status.write_to_fasta_file(self.fasta_out, "", 0)
+            with open(self.fasta_out) as fasta_handle:
+                self.assertEqual(fasta_handle.read(), ">contig_1\n" + ("ACGT" * 30) + "\n>contig_2\n\n")
+            self.status.write_to_fasta_file(self.fasta_out, "", 50)
+            with open(self.fasta_out) as fasta_handle:
+                self.assertEqual(fasta_handle.read(), ">contig_1\n" + ("ACGT" * 12) + "AC\n" + "GT" + ("ACGT" * 12) + "\n" + ("ACGT" * 5) + "\n>contig_2\n")
+        finally:
+            GenomeStatus.FASTA_WRITE_SIZE = 1048576
+
+
+class GenomeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fasta_in = "genome_test.fasta"
+
+    def tearDown(self):
+        if os.path.exists(self.fasta_in) : os.remove(self.fasta_in)
+        if os.path.exists(self.fasta_in + ".fai") : os.remove(self.fasta_in + ".fai")
+
+    def test_import_fasta_file(self):
+        from nasp_objects import Genome, GenomeStatus
+        with open(self.fasta_in, "wb") as fasta_handle:
+            fasta_handle.write(b">franken::contig_1 description\r\nACGT\r\nac-.\t\nAC GT\n12\n>contig_2\nTTTT\n\n>franken::contig_2\nGG\n>franken::contig_1\nNN")
+        GenomeStatus.FASTA_READ_SIZE = 5
+        try:
+            genome = Genome()
+            genome.import_fasta_file(self.fasta_in, "franken::")
+        finally:
+            GenomeStatus.FASTA_READ_SIZE = 16777216
+        self.assertEqual(genome.get_contigs(False), ["contig_1", "contig_2"])
+        self.assertEqual(genome.get_call(1, -1, "contig_1"), list("ACGTac-.TTTTNN"))
+        self.assertEqual(genome.get_call(1, -1, "contig_2"), list("GG"))
+
+    def test_import_compressed_fasta_file(self):
+        import gzip
+        import zlib
+        from nasp_objects import Genome, BGZFReader, get_input_compression
+        fasta_data = b">contig_1\nACGTAC\nGT\n>contig_2\nGG\n"
+        with gzip.open(self.fasta_in, "wb") as fasta_handle:
+            fasta_handle.write(fasta_data)
+        self.assertEqual(get_input_compression(self.fasta_in), "gzip")
+        genome = Genome()
+        genome.import_fasta_file(self.fasta_in)
+        self.assertEqual(genome.get_call(1, -1, "contig_1"), list("ACGTACGT"))
+        with open(self.fasta_in, "wb") as fasta_handle:
+            for block_start in range(0, len(fasta_data), 7):
+                block_data = fasta_data[block_start:(block_start + 7)]
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                compressed_data = compressor.compress(block_data) + compressor.flush()
+                fasta_handle.write(b"\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0" + (len(compressed_data) + 25).to_bytes(2, "little") + compressed_data + zlib.crc32(block_data).to_bytes(4, "little") + len(block_data).to_bytes(4, "little"))
+        self.assertEqual(get_input_compression(self.fasta_in), "bgzf")
+        BGZFReader.BLOCKS_PER_TASK = 2
+        try:
+            genome = Genome()
+            genome.import_fasta_file(self.fasta_in)
+        finally:
+            BGZFReader.BLOCKS_PER_TASK = 16
+        self.assertEqual(genome.get_contigs(False), ["contig_1", "contig_2"])
+        self.assertEqual(genome.get_call(1, -1, "contig_1"), list("ACGTACGT"))
+        self.assertEqual(genome.get_call(1, -1, "contig_2"), list("GG"))
+
+    def test_import_indexed_fasta_file(self):
+        from nasp_objects import Genome, FastaGenome, IndexedFastaContig
+        with open(self.fasta_in, "wb") as fasta_handle:
+            fasta_handle.write(b">franken::contig_1 description\r\nACGTA\r\nCGTAC\r\nGT\r\n>franken::contig_2\nacgt\nN\n\n")
+        genome = FastaGenome()
+        self.assertTrue(genome.import_indexed_fasta_file(self.fasta_in, "franken::"))
+        self.assertIsInstance(genome._status_data["contig_1"], IndexedFastaContig)
+        self.assertFalse(os.path.exists(self.fasta_in + ".fai"))
+        self.assertEqual(Genome.read_fasta_index(self.fasta_in)[0], ("franken::contig_1", 12, 32, 5, 7))
+        self.assertEqual(genome.get_contigs(False), ["contig_1", "contig_2"])
+        self.assertEqual(genome.get_call(1, -1, "contig_1"), list("ACGTACGTACGT"))
+        self.assertEqual(genome.get_call_block(4, 14, "contig_1"), b"TACGTACGTXX")
+        self.assertEqual(genome.get_call(11, None, "contig_1"), "G")
+        self.assertEqual(genome.get_call(1, -1, "contig_2"), list("acgtN"))
+        genome.write_to_track_file(self.fasta_in + ".tracks")
+        tracked_genome = FastaGenome()
+        tracked_genome.import_track_file(self.fasta_in + ".tracks")
+        os.remove(self.fasta_in + ".tracks")
+        self.assertEqual(tracked_genome.get_call_block(1, 12, "contig_1"), b"ACGTACGTACGT")
+        with open(self.fasta_in, "wb") as fasta_handle:
+            fasta_handle.write(b">franken::contig_1\nACG\nACGT\n")
+        self.assertFalse(FastaGenome().import_indexed_fasta_file(self.fasta_in, "franken::"))
+
+    def test_read_bad_fasta_index(self):
+        from nasp_objects import Genome
+        with open(self.fasta_in, "wb") as fasta_handle:
+            fasta_handle.write(b">contig_1\nACGTA\nCG\n>contig_2\nTT\n")
+        fasta_time = os.path.getmtime(self.fasta_in)
+        for index_data in ("contig_1\t7\t10\t5\t6\ncontig_2\t200\t24\t2\t3\n", "contig_1\t7\t10\t5\t6\ncontig_2\t2"):
+            with open(self.fasta_in + ".fai", "w") as index_handle:
+                index_handle.write(index_data)
+            os.utime(self.fasta_in + ".fai", (fasta_time + 10, fasta_time + 10))
+            self.assertEqual(Genome.read_fasta_index(self.fasta_in), [("contig_1", 7, 10, 5, 6), ("contig_2", 2, 29, 2, 3)])
+            with open(self.fasta_in + ".fai") as index_handle:
+                self.assertEqual(index_handle.read(), index_data)
+        with open(self.fasta_in + ".fai", "w") as index_handle:
+            index_handle.write("contig_1\t7\t10\t5\t6\ncontig_2\t2\t24\t2\t3\n")
+        os.utime(self.fasta_in + ".fai", (fasta_time + 10, fasta_time + 10))
+        self.assertEqual(Genome.read_fasta_index(self.fasta_in)[1], ("contig_2", 2, 24, 2, 3))
+
+    def test_import_dups_file(self):
+        from nasp_objects import ReferenceGenome
+        with open(self.fasta_in, "w") as fasta_handle:
+            fasta_handle.write(">contig_1\n0101\n0A10\n11 \n")
+        reference = ReferenceGenome()
+        reference.import_dups_file(self.fasta_in)
+        self.assertEqual(reference.get_contigs(), ["contig_1"])
+        self.assertEqual(reference.get_dups_call(1, -1, "contig_1"), list("010111"))
+
+    def test_genome_pack(self):
+        from nasp_objects import ReferenceGenome
+        reference = ReferenceGenome()
+        reference.append_contig("ACGTACGTAC", "contig_2")
+        reference.append_contig("GGN", "contig_1")
+        reference._dups.append_contig("0100000011-", "contig_2")
+        reference.write_to_genome_pack(self.fasta_in)
+        packed_reference = ReferenceGenome()
+        packed_reference.import_genome_pack(self.fasta_in)
+        self.assertEqual(packed_reference.get_contigs(False), ["contig_2", "contig_1"])
+        self.assertEqual(packed_reference.get_call(1, -1, "contig_2"), list("ACGTACGTAC"))
+        self.assertEqual(packed_reference.get_call(3, None, "contig_1"), "N")
+        self.assertEqual(packed_reference.get_dups_call(1, 12, "contig_2"), list("01000000110?"))
+        self.assertEqual(packed_reference.get_dups_call(10, None, "contig_2"), "1")
+        self.assertEqual(packed_reference.get_dups_call_block(8, 13, "contig_2"), b"0110??")
+        self.assertEqual(packed_reference.get_dups_call(1, None, "contig_1"), "?")
+
+
+class VCFGenomeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from nasp_objects import VCFGenome
+        self.genome = VCFGenome()
+        self.genome.extend_contig(4, b"\0", "contig_1")
+
+    def test_packed_values(self):
+        self.assertEqual(len(self.genome._status_data["contig_1"]), 4)
+        self.genome.set_values(2, "G", "Y", "N", "-", "contig_1")
+        self.genome.set_values(3, "*", None, "Y", None, "contig_1")
+        self.genome.set_proportion_pass("N", 3, "contig_1")
+        self.genome.set_values(6, "a", "Y", None, None, "contig_1")
+        self.assertEqual(self.genome.get_contig_length("contig_1"), 6)
+        self.assertEqual(self.genome.get_call_block(1, 7, "contig_1"), b"XG*XXaX")
+        self.assertEqual(self.genome.get_was_called_block(1, 7, "contig_1"), b"NYNNNYN")
+        self.assertEqual(self.genome.get_coverage_pass_block(1, 7, "contig_1"), b"?NY????")
+        self.assertEqual(self.genome.get_proportion_pass_block(1, 7, "contig_1"), b"?-N????")
+        self.assertEqual(self.genome.get_call(3, None, "contig_1"), "*")
+        self.assertEqual(self.genome.get_call(1, -1, "contig_1"), list("XG*XXa"))
+        self.assertEqual(self.genome.get_was_called(9, "contig_1"), "N")
+        self.genome.set_call("C", 3, "X", "contig_1")
+        self.assertEqual(self.genome.get_call_block(2, 3, "contig_1"), b"GC")
+        self.assertEqual(self.genome.get_coverage_pass(3, "contig_1"), "Y")
+
+
+    def test_pack_record_column(self):
+        from nasp_objects import VCFGenome, VCFRecordBlock
+        record_block = VCFRecordBlock(1)
+        record_block.set_sample_columns([[("A", 12, 0.95, False)], [("C", 4, None, True)], [(None, None, None, False)], [("N", 20, 0.5, False)], [("*", 10, 0.9, True)]])
+        (packed_values, escaped_records) = VCFGenome.pack_record_column(record_block, 0, 10, 0.9)
+        self.assertEqual(escaped_records, [4])
+        self.genome.set_packed_values(1, packed_values, "contig_1")
+        self.genome.set_values(5, "*", None, None, None, "contig_1")
+        self.assertEqual(self.genome.get_call_block(1, 5, "contig_1"), b"ACXN*")
+        self.assertEqual(self.genome.get_was_called_block(1, 5, "contig_1"), b"YYNNY")
+        self.assertEqual(self.genome.get_coverage_pass_block(1, 5, "contig_1"), b"YN?YY")
+        self.assertEqual(self.genome.get_proportion_pass_block(1, 5, "contig_1"), b"Y?-NY")
+
+    def test_track_file(self):
+        from nasp_objects import VCFGenome, RunLengthContig
+        track_filename = "vcf_genome_test.tracks"
+        self.genome.set_nickname("sample_1")
+        self.genome.set_file_path("sample_1.vcf")
+        self.genome.set_file_type("vcf")
+        self.genome.add_generators(["bwa", "gatk"])
+        self.genome.set_values(2, "*", "Y", "Y", "N", "contig_1")
+        self.genome._status_data["contig_2"] = RunLengthContig(b"\0" * 50)
+        self.genome.set_values(40, "T", "Y", "N", "-", "contig_2")
+        try:
+            self.genome.write_to_track_file(track_filename)
+            track_genome = VCFGenome()
+            track_genome.import_track_file(track_filename)
+        finally:
+            os.remove(track_filename)
+        self.assertEqual(track_genome.identifier(), "sample_1::bwa,gatk")
+        self.assertEqual(track_genome.file_type(), "vcf")
+        self.assertIsInstance(track_genome._status_data["contig_1"], memoryview)
+        self.assertEqual(track_genome._status_data["contig_2"].get_run_count(), 3)
+        for contig_name in ("contig_1", "contig_2"):
+            contig_length = self.genome.get_contig_length(contig_name)
+            self.assertEqual(track_genome.get_call_block(1, contig_length, contig_name), self.genome.get_call_block(1, contig_length, contig_name))
+            self.assertEqual(track_genome.get_proportion_pass_block(1, contig_length, contig_name), self.genome.get_proportion_pass_block(1, contig_length, contig_name))
+
+class InputCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_folder = "input_cache_test"
+        self.input_file = "input_cache_test.frankenfasta"
+        with open(self.input_file, "w") as input_handle:
+            input_handle.write(">franken::contig_1\nACGT\n")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_folder, ignore_errors=True)
+        os.remove(self.input_file)
+
+    def test_input_cache(self):
+        from nasp_objects import InputCache, FastaGenome
+        input_cache = InputCache(self.cache_folder, 0)
+        entry_key = input_cache.get_entry_key(self.input_file, {"version": 1})
+        self.assertNotEqual(entry_key, input_cache.get_entry_key(self.input_file, {"version": 2}))
+        self.assertIsNone(input_cache.get_entry_key("missing.frankenfasta", {"version": 1}))
+        self.assertIsNone(input_cache.get_entry(entry_key))
+        genome = FastaGenome()
+        genome.set_file_path(self.input_file)
+        genome.import_fasta_file(self.input_file, "franken::")
+        track_filename = os.path.join(self.cache_folder, "parsed.tracks")
+        genome.write_to_track_file(track_filename)
+        entry_tracks = input_cache.add_entry(entry_key, [("FastaGenome", track_filename)])
+        self.assertFalse(os.path.exists(track_filename))
+        self.assertEqual(input_cache.get_entry(entry_key), entry_tracks)
+        cached_genome = FastaGenome()
+        cached_genome.import_track_file(entry_tracks[0][1])
+        self.assertEqual(cached_genome.file_path(), self.input_file)
+        self.assertEqual(cached_genome.get_call_block(1, 4, "contig_1"), b"ACGT")
+        with open(self.input_file, "a") as input_handle:
+            input_handle.write("ACGT\n")
+        self.assertNotEqual(input_cache.get_entry_key(self.input_file, {"version": 1}), entry_key)
+        input_cache.evict_entries()
+        self.assertIsNone(input_cache.get_entry(entry_key))
+        self.assertEqual(os.listdir(self.cache_folder), [])
+
+    def test_evict_unused_entries(self):
+        from nasp_objects import InputCache
+        for (entry_key, track_data) in (("old_entry", b"old"), ("new_entry", b"new")):
+            track_filename = os.path.join(self.cache_folder, entry_key + ".parsed")
+            os.makedirs(self.cache_folder, exist_ok=True)
+            with open(track_filename, "wb") as track_handle:
+                track_handle.write(track_data)
+            InputCache(self.cache_folder).add_entry(entry_key, [("FastaGenome", track_filename)])
+        run_cache = InputCache(self.cache_folder)
+        self.assertIsNotNone(run_cache.get_entry("new_entry"))
+        run_cache.evict_entries()
+        self.assertIsNotNone(run_cache.get_entry("old_entry"))
+        run_cache = InputCache(self.cache_folder)
+        run_cache.get_entry("new_entry")
+        run_cache.evict_entries(True)
+        self.assertIsNone(run_cache.get_entry("old_entry"))
+        self.assertEqual(sorted(os.listdir(self.cache_folder)), ["new_entry.0.tracks", "new_entry.entry"])
+
+class VCFRecordTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vcf_in = "vcf_record_test.vcf"
+        with open(self.vcf_in, "w") as vcf_handle:
+            vcf_handle.write("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample_1\tsample_2\n")
+            vcf_handle.write("contig_1\t1\t.\tA\t.\t.\t.\tDP=20\tGT:AD:DP\t0/0:9:12\t./.\n")
+            vcf_handle.write("#comment\n")
+            vcf_handle.write("contig_1\t2\t.\tC\tT,G\t.\t.\tAC=1\tGT:AD:DP\t2/2:1,2,7:10\t1/1:3,1,0:4\n")
+            vcf_handle.write("contig_1\t3\t.\tG\tT\t.\t.\tAR=0.25\tGT\t1\t0\n")
+
+    def tearDown(self):
+        if os.path.exists(self.vcf_in) : os.remove(self.vcf_in)
+
+    def test_fetch_record_block(self):
+        from nasp_objects import VCFRecord
+        vcf_record = VCFRecord(self.vcf_in)
+        expected_info = []
+        while vcf_record.fetch_next_record():
+            expected_info.append([vcf_record.get_sample_info(vcf_sample) for vcf_sample in vcf_record.get_samples()])
+        vcf_record = VCFRecord(self.vcf_in)
+        record_block = vcf_record.fetch_record_block(2)
+        self.assertEqual(record_block.get_record_count(), 1)
+        self.assertEqual(list(record_block.positions), [1])
+        record_info = []
+        while record_block is not None:
+            for record_index in range(record_block.get_record_count()):
+                record_info.append([])
+                for sample_index in range(2):
+                    sample_coverage = record_block.coverages[sample_index][record_index]
+                    sample_proportion = record_block.proportions[sample_index][record_index]
+                    record_info[-1].append((record_block.calls[sample_index][record_index], None if sample_coverage != sample_coverage else sample_coverage, None if sample_proportion != sample_proportion else sample_proportion, bool(record_block.snps[sample_index][record_index])))
+            record_block = vcf_record.fetch_record_block(2)
+        self.assertEqual(record_info, [[(sample_info['call'], sample_info['coverage'], sample_info['proportion'], sample_info['is_a_snp']) for sample_info in line_info] for line_info in expected_info])
+        self.assertEqual(record_info[1], [("G", 10, 0.7, True), ("T", 4, 0.25, True)])
+
+    def test_contig_sections(self):
+        from nasp_objects import VCFRecord
+        with open(self.vcf_in, "a") as vcf_handle:
+            vcf_handle.write("contig_2\t1\t.\tA\t.\t.\t.\tDP=20\tGT\t0\t0\n")
+            vcf_handle.write("contig_1\t4\t.\tA\t.\t.\t.\tDP=20\tGT\t0\t0\n")
+        vcf_record = VCFRecord(self.vcf_in, seekable=True)
+        contig_sections = vcf_record.get_contig_sections()
+        self.assertEqual(sorted(contig_sections), ["contig_1", "contig_2"])
+        self.assertEqual([line_count for (section_offset, line_count) in contig_sections["contig_1"]], [4, 1])
+        record_positions = []
+        for (section_offset, line_count) in reversed(contig_sections["contig_1"]):
+            vcf_record.set_record_section(section_offset, line_count)
+            record_block = vcf_record.fetch_record_block(3)
+            while record_block is not None:
+                record_positions.append((record_block.contigs[0], list(record_block.positions)))
+                record_block = vcf_record.fetch_record_block(3)
+        self.assertEqual(record_positions, [("contig_1", [4]), ("contig_1", [1, 2]), ("contig_1", [3])])
+
+
+    def test_record_dialects(self):
+        from nasp_objects import VCFRecord
+        with open(self.vcf_in, "w") as vcf_handle:
+            vcf_handle.write("##fileformat=VCFv4.1\n##source=VarScan2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample_1\n")
+            vcf_handle.write("contig_1\t1\t.\tA\tC\t.\t.\tADP=20\tGT:DP:RD:AD\t1/1:20:2:18\n")
+            vcf_handle.write("contig_1\t2\t.\tC\t.\t.\t.\tADP=20\tGT:DP:RD:AD\t0/0:20:19:1,0\n")
+            vcf_handle.write("contig_1\t3\t.\tG\tT\t.\t.\tAR=0.8;DP4=1,2,3,4;DP=10\tGT\t1\n")
+        self.assertEqual(VCFRecord(self.vcf_in).get_dialect(), "varscan")
+        self.assertEqual(VCFRecord(self.vcf_in, "SAMtools").get_dialect(), "samtools")
+        self.assertEqual(VCFRecord.find_dialect("UnifiedGenotyper"), "gatk")
+        self.assertIsNone(VCFRecord.find_dialect("mystery_caller"))
+        generic_record = VCFRecord(self.vcf_in)
+        generic_record._dialect = None
+        generic_block = generic_record.fetch_record_block()
+        for caller_name in ("varscan", "gatk", "solsnp", "samtools"):
+            record_block = VCFRecord(self.vcf_in, caller_name).fetch_record_block()
+            self.assertEqual(record_block.calls, generic_block.calls)
+            self.assertEqual(record_block.coverages, generic_block.coverages)
+            self.assertEqual(record_block.proportions, generic_block.proportions)
+        self.assertEqual(list(generic_block.proportions[0]), [0.9, 0.05, 0.8])
+
+class GenomeCollectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from nasp_objects import ReferenceGenome, FastaGenome, GenomeCollection
+        self.reference = ReferenceGenome()
+        self.reference.append_contig("ACGTN", "contig_1")
+        self.reference._dups.append_contig("00010", "contig_1")
+        self.genomes = GenomeCollection()
+        self.genomes.set_reference(self.reference)
+        for (nickname, calls) in (("sample_1", "ACCTA"), ("sample_2", "AXGTA")):
+            genome = FastaGenome()
+            genome.set_nickname(nickname)
+            genome.set_file_path(nickname + ".frankenfasta")
+            genome.append_contig(calls, "contig_1")
+            self.genomes.add_genome(genome)
+
+    def test_format_matrix_block(self):
+        (matrix_lines, custom_lines) = self.genomes._format_matrix_block("contig_1", 1, 5, None)
+        matrix_lines = matrix_lines.splitlines()
+        self.assertEqual(len(matrix_lines), 5)
+        self.assertEqual(matrix_lines[0], "contig_1::1\tA\tA\tA\t0\t0\t2\t2/2\t2/2\t2/2\t2\t0\t0\t0\t0\t0\tcontig_1\t1\tFalse\tTrue\tYY\t--\t--")
+        self.assertEqual(matrix_lines[1], "contig_1::2\tC\tC\tX\t0\t0\t1\t1/2\t2/2\t2/2\t0\t1\t0\t0\t0\t1\tcontig_1\t2\tFalse\tFalse\tYN\t--\t--")
+        self.assertEqual(custom_lines, "contig_1::3\tG\tC\tG\t1\t0\t1\t2/2\t2/2\t2/2\t0\t1\t1\t0\t0\t0\tcontig_1\t3\tFalse\tTrue\t\n")
+        self.assertEqual(self.genomes.get_contig_stat('reference_duplicated', 'contig_1'), 1)
+        self.assertEqual(self.genomes.get_contig_stat('any_snps'), 1)
+        self.assertEqual(self.genomes.get_cumulative_stat('called_snp', 'any'), 1)
+        self.assertEqual(self.genomes.get_sample_stat('was_called', 'sample_2', 'sample_2', 'sample_2.frankenfasta'), 4)
+
+    def test_add_genome_sorts_once(self):
+        from nasp_objects import FastaGenome
+        genome = FastaGenome()
+        genome.set_nickname("sample_0")
+        genome.set_file_path("sample_0.frankenfasta")
+        genome.append_contig("ACGTN", "contig_1")
+        self.genomes.add_genome(genome)
+        for failed_path in ("b.vcf", "a.vcf", "b.vcf"):
+            self.genomes.add_failed_genome(failed_path)
+        self.assertEqual([genome.nickname() for genome in self.genomes._genomes], ["sample_1", "sample_2", "sample_0"])
+        (matrix_lines, custom_lines) = self.genomes._format_matrix_block("contig_1", 1, 1, None)
+        self.assertEqual([genome.nickname() for genome in self.genomes._genomes], ["sample_0", "sample_1", "sample_2"])
+        self.assertEqual(self.genomes._failed_genomes, ["a.vcf", "b.vcf"])
+        self.assertTrue(matrix_lines.startswith("contig_1::1\tA\tA\tA\tA\t\t\t"))
+
+    def test_regions(self):
+        from nasp_objects import GenomeRegions
+        bed_in = "genome_collection_test.bed"
+        with open(bed_in, "w") as bed_handle:
+            bed_handle.write("track name=panel\ncontig_1\t3\t4\n# comment\ncontig_1\t0\t1\ncontig_1\t1\t2\ncontig_2\t0\t9\n")
+        regions = GenomeRegions()
+        try:
+            regions.import_bed_file(bed_in)
+        finally:
+            os.remove(bed_in)
+        self.assertEqual(regions.get_contig_regions("contig_1"), [(1, 2), (4, 4)])
+        self.assertEqual([regions.contains("contig_1", position) for position in range(1, 6)], [True, True, False, True, False])
+        self.assertFalse(regions.contains("contig_3", 1))
+        self.genomes.set_regions(regions)
+        self.assertEqual(self.genomes._get_matrix_shards(), [("contig_1", 1, 2), ("contig_1", 4, 4)])
+
+    def test_write_to_matrices_in_parallel(self):
+        from nasp_objects import GenomeCollection, CollectionStatistics
+        import copy
+        serial_genomes = copy.deepcopy(self.genomes)
+        serial_genomes.write_to_matrices("serial_master.tsv", "serial_filter.tsv", "missingdata")
+        GenomeCollection.MATRIX_SHARD_SIZE = 2
+        try:
+            self.genomes.write_to_matrices("parallel_master.tsv", "parallel_filter.tsv", "missingdata", 3)
+        finally:
+            GenomeCollection.MATRIX_SHARD_SIZE = 262144
+        for (serial_file, parallel_file) in (("serial_master.tsv", "parallel_master.tsv"), ("serial_filter.tsv", "parallel_filter.tsv")):
+            with open(serial_file) as serial_handle, open(parallel_file) as parallel_handle:
+                self.assertEqual(serial_handle.read(), parallel_handle.read())
+            os.remove(serial_file)
+            os.remove(parallel_file)
+        self.assertEqual(serial_genomes.get_contig_stats(), self.genomes.get_contig_stats())
+        self.assertEqual(serial_genomes.get_sample_stats(), self.genomes.get_sample_stats())
+
+    def test_write_streamed_matrices(self):
+        from nasp_objects import GenomeCollection, FastaGenomeWindow
+        self.genomes.write_to_matrices("loaded_master.tsv", "loaded_filter.tsv", "missingdata")
+        streamed_genomes = GenomeCollection()
+        streamed_genomes.set_reference(self.reference)
+        input_streams = []
+        for (nickname, records) in (("sample_1", [("contig_1", 1, b"ACC"), ("contig_1", 4, b"TA")]), ("sample_2", [("contig_1", 1, b"AXGTA")])):
+            genome_window = FastaGenomeWindow()
+            genome_window.set_nickname(nickname)
+            genome_window.set_file_path(nickname + ".frankenfasta")
+            streamed_genomes.add_genome(genome_window)
+            input_streams.append(([genome_window], iter(records)))
+        GenomeCollection.STREAMING_BLOCK_SIZE = 2
+        try:
+            streamed_genomes.write_streamed_matrices("streamed_master.tsv", "streamed_filter.tsv", "missingdata", input_streams)
+        finally:
+            GenomeCollection.STREAMING_BLOCK_SIZE = 8192
+        for (loaded_file, streamed_file) in (("loaded_master.tsv", "streamed_master.tsv"), ("loaded_filter.tsv", "streamed_filter.tsv")):
+            with open(loaded_file) as loaded_handle, open(streamed_file) as streamed_handle:
+                self.assertEqual(loaded_handle.read(), streamed_handle.read())
+            os.remove(loaded_file)
+            os.remove(streamed_file)
+        self.assertEqual(self.genomes.get_contig_stats(), streamed_genomes.get_contig_stats())
+        self.assertEqual(self.genomes.get_sample_stats(), streamed_genomes.get_sample_stats())
+
+    def test_merge_statistics(self):
+        from nasp_objects import CollectionStatistics
+        shard_stats = CollectionStatistics()
+        shard_stats.increment_contig_stat("extra_stat", "contig_2", 3)
+        shard_stats.add_sample_stat("was_called", "sample_1", "sample_1", "sample_1.frankenfasta", 2)
+        self.genomes._format_matrix_block("contig_1", 1, 5, None)
+        self.genomes.merge(shard_stats)
+        self.assertEqual(self.genomes.get_contig_stat("extra_stat", "contig_2"), 3)
+        self.assertEqual(self.genomes.get_contig_stat("extra_stat"), 3)
+        self.assertEqual(self.genomes.get_contig_stat("extra_stat", "contig_1"), 0)
+        self.assertEqual(self.genomes.get_contig_stat("reference_length", "contig_1"), 5)
+        self.assertEqual(self.genomes.get_contig_stat("all_called", "contig_1"), 4)
+        self.assertEqual(self.genomes.get_sample_stat("was_called", "sample_1", "sample_1", "sample_1.frankenfasta"), 7)
+        self.assertEqual(self.genomes.get_contig_stats()[("extra_stat", None)], 3)
+
+    def test_stats_snapshots(self):
+        from nasp_objects import CollectionStatistics, GenomeCollection, GenomeRegions
+        self.genomes.write_to_matrices("full_master.tsv", "full_filter.tsv", None)
+        self.genomes.write_to_stats_files("full_general.tsv", "full_sample.tsv")
+        combined_stats = CollectionStatistics()
+        for (snapshot_file, first_position, last_position) in (("first.stats", 1, 2), ("second.stats", 3, 5)):
+            partial_genomes = GenomeCollection()
+            partial_genomes.set_reference(self.reference)
+            for genome in self.genomes._genomes:
+                partial_genomes.add_genome(genome)
+            regions = GenomeRegions()
+            regions.add_region("contig_1", first_position, last_position)
+            partial_genomes.set_regions(regions)
+            partial_genomes.write_to_matrices("partial_master.tsv", "partial_filter.tsv", None)
+            partial_genomes.write_stats_snapshot(snapshot_file)
+            combined_stats.merge_stats_snapshot(snapshot_file)
+        combined_stats.write_to_stats_files("combined_general.tsv", "combined_sample.tsv")
+        for (full_file, combined_file) in (("full_general.tsv", "combined_general.tsv"), ("full_sample.tsv", "combined_sample.tsv")):
+            with open(full_file) as full_handle, open(combined_file) as combined_handle:
+                self.assertEqual(full_handle.read(), combined_handle.read())
+        self.assertEqual(combined_stats.get_sample_stats(), self.genomes.get_sample_stats())
+        for stats_file in ("full_master.tsv", "full_filter.tsv", "full_general.tsv", "full_sample.tsv", "partial_master.tsv", "partial_filter.tsv", "first.stats", "second.stats", "combined_general.tsv", "combined_sample.tsv"):
+            os.remove(stats_file)
+
+    def test_stats_snapshots_contig_order(self):
+        from nasp_objects import CollectionStatistics, GenomeCollection, GenomeRegions
+        self.reference.append_contig("TTGCA", "contig_2")
+        self.reference._dups.append_contig("00000", "contig_2")
+        for (genome, calls) in zip(self.genomes._genomes, ("TTGCA", "TAGCN")):
+            genome.append_contig(calls, "contig_2")
+        self.genomes.write_to_matrices("full_master.tsv", "full_filter.tsv", None)
+        self.genomes.write_to_stats_files("full_general.tsv", "full_sample.tsv")
+        combined_stats = CollectionStatistics()
+        for (snapshot_file, contig_name) in (("second.stats", "contig_2"), ("first.stats", "contig_1")):
+            partial_genomes = GenomeCollection()
+            partial_genomes.set_reference(self.reference)
+            for genome in self.genomes._genomes:
+                partial_genomes.add_genome(genome)
+            regions = GenomeRegions()
+            regions.add_region(contig_name, 1, 5)
+            partial_genomes.set_regions(regions)
+            partial_genomes.write_to_matrices("partial_master.tsv", "partial_filter.tsv", None)
+            partial_genomes.write_stats_snapshot(snapshot_file)
+            combined_stats.merge_stats_snapshot(snapshot_file)
+        combined_stats.write_to_stats_files("combined_general.tsv", "combined_sample.tsv")
+        for (full_file, combined_file) in (("full_general.tsv", "combined_general.tsv"), ("full_sample.tsv", "combined_sample.tsv")):
+            with open(full_file) as full_handle, open(combined_file) as combined_handle:
+                self.assertEqual(full_handle.read(), combined_handle.read())
+        for stats_file in ("full_master.tsv", "full_filter.tsv", "full_general.tsv", "full_sample.tsv", "partial_master.tsv", "partial_filter.tsv", "first.stats", "second.stats", "combined_general.tsv", "combined_sample.tsv"):
+            os.remove(stats_file)
+
+    def test_matrix_columns(self):
+        from nasp_objects import MatrixColumnReader, GenomeCollection
+        GenomeCollection.MATRIX_BLOCK_SIZE = 2
+        try:
+            self.genomes.write_to_matrices("columns_master.tsv", "columns_filter.tsv", None, 1, "columns_master.cols")
+            column_reader = MatrixColumnReader("columns_master.cols")
+        finally:
+            GenomeCollection.MATRIX_BLOCK_SIZE = 65536
+            for matrix_file in ("columns_master.tsv", "columns_filter.tsv", "columns_master.cols"):
+                os.remove(matrix_file)
+        self.assertEqual(column_reader.get_sample_identifiers(), ["sample_1", "sample_2"])
+        self.assertEqual(column_reader.get_ranges(), [("contig_1", 1, 2), ("contig_1", 3, 4), ("contig_1", 5, 5)])
+        (positions, sample_calls) = column_reader.get_column("calls", "contig_1", 2, 4)
+        self.assertEqual([position for position_range in positions for position in position_range], [2, 3, 4])
+        self.assertEqual(sample_calls, [b"CCT", b"XGT"])
+        self.assertEqual(column_reader.get_column("reference", "contig_1")[1], b"ACGTN")
+        self.assertEqual(list(column_reader.get_column("snp_count", "contig_1")[1]), [0, 0, 1, 0, 0])
+        self.assertEqual(column_reader.get_column("duplicated", "contig_1", 3, 5)[1], b"\x00\x01\x00")
+        self.assertEqual(column_reader.get_column("calls", "contig_2"), ([], [b"", b""]))
+
+    def test_matrix_index(self):
+        from nasp_objects import MatrixIndex, GenomeCollection, MalformedInputFile
+        GenomeCollection.MATRIX_INDEX_ROWS = 2
+        try:
+            self.genomes.write_to_matrices("indexed_master.tsv", "indexed_filter.tsv", None, 1, None, "indexed_master.tsv.idx")
+            matrix_index = MatrixIndex("indexed_master.tsv")
+            with open("indexed_master.tsv") as master_handle:
+                matrix_lines = [matrix_line.rstrip("\n").split("\t") for matrix_line in master_handle]
+            self.assertEqual(matrix_index.get_header(), matrix_lines[0])
+            self.assertEqual(matrix_index.get_rows("contig_1", 4), [matrix_lines[4]])
+            self.assertEqual(matrix_index.get_rows("contig_1", 2, 5), matrix_lines[2:6])
+            self.assertEqual(matrix_index.get_rows("contig_1", 6), [])
+            self.assertEqual(matrix_index.get_rows("contig_2", 1), [])
+            matrix_index.close()
+            with open("indexed_master.tsv", "a") as master_handle:
+                master_handle.write("\n")
+            self.assertRaises(MalformedInputFile, MatrixIndex, "indexed_master.tsv")
+        finally:
+            GenomeCollection.MATRIX_INDEX_ROWS = 4096
+            for matrix_file in ("indexed_master.tsv", "indexed_filter.tsv", "indexed_master.tsv.idx"):
+                os.remove(matrix_file)
+
+    def test_write_streamed_matrices_unsorted(self):
+        from nasp_objects import GenomeCollection, VCFGenomeWindow, MalformedInputFile
+        streamed_genomes = GenomeCollection()
+        streamed_genomes.set_reference(self.reference)
+        genome_window = VCFGenomeWindow()
+        genome_window.set_file_path("unsorted.vcf")
+        streamed_genomes.add_genome(genome_window)
+        records = iter([("contig_1", 3, [("A", "Y", "Y", "Y")]), ("contig_1", 2, [("A", "Y", "Y", "Y")])])
+        try:
+            self.assertRaises(MalformedInputFile, streamed_genomes.write_streamed_matrices, "streamed_master.tsv", "streamed_filter.tsv", None, [([genome_window], records)])
+            self.assertEqual([file_name for file_name in os.listdir(".") if file_name.startswith("streamed_")], [])
+        finally:
+            for streamed_file in ("streamed_master.tsv", "streamed_filter.tsv"):
+                if os.path.exists(streamed_file) : os.remove(streamed_file)
+
+
+if __name__ == "__main__":
+    #import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
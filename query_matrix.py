@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+__author__ = "David Smith"
+__version__ = "1"
+__email__ = "dsmith@tgen.org"
+
+import logging
+
+
+def _parse_args():
+    import argparse
+    parser = argparse.ArgumentParser( description="Prints the master matrix lines of a position or range, looked up through the index written by vcf_to_matrix.py --matrix-index." )
+    parser.add_argument( "--master-matrix", default="master_matrix.tsv", help="Path to the master matrix to look positions up in." )
+    parser.add_argument( "--matrix-index", help="Path to the index of the master matrix, if it is not the master matrix path with '.idx' added." )
+    parser.add_argument( "--contig", required=True, help="Name of the contig to look up." )
+    parser.add_argument( "--position", type=int, required=True, help="Position to look up, or the first position of the range to look up." )
+    parser.add_argument( "--last-position", type=int, help="Last position of the range to look up." )
+    return parser.parse_args()
+
+def main():
+    import sys
+    from nasp_objects import MatrixIndex
+    commandline_args = _parse_args()
+    matrix_index = MatrixIndex( commandline_args.master_matrix, commandline_args.matrix_index )
+    sys.stdout.write( "\t".join( matrix_index.get_header() ) + "\n" )
+    for matrix_row in matrix_index.get_rows( commandline_args.contig, commandline_args.position, commandline_args.last_position ):
+        sys.stdout.write( "\t".join( matrix_row ) + "\n" )
+    matrix_index.close()
+
+
+if __name__ == "__main__": main()
+
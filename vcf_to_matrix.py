@@ -12,24 +12,48 @@ def _parse_args():
     parser = argparse.ArgumentParser( description="Meant to be called from the pipeline automatically." )
     parser.add_argument( "--mode", required=True, choices=[ 'commandline', 'xml' ], help="Data passing mode, must be set to 'commandline' or 'xml'." )
     parser.add_argument( "--reference-fasta", help="Path to input reference fasta file." )
-    parser.add_argument( "--reference-dups", help="Path to input reference dups file." )
+    parser.add_argument( "--reference-dups", help="Path to input reference dups file. Used in place of any dups data in --reference-pack." )
+    parser.add_argument( "--reference-pack", help="Path to a binary genome pack of the reference, used in place of parsing the reference fasta." )
     parser.add_argument( "--input-files", nargs="+", help="Path to input VCF/fasta files for matrix conversion." )
     parser.add_argument( "--master-matrix", default="master_matrix.tsv", help="Name of master matrix to create." )
     parser.add_argument( "--filter-matrix", default="filter_matrix.tsv", help="Name of custom matrix to create." )
     parser.add_argument( "--filter-matrix-format", help="String describing the custom format of the filter matrix." )
+    parser.add_argument( "--matrix-columns", help="Name of an optional binary, column-oriented copy of the master matrix to create. Not written with --streaming or --by-contig." )
+    parser.add_argument( "--matrix-index", help="Name of an optional index of the master matrix to create, for query_matrix.py to look positions up with. Not written with --streaming or --by-contig." )
     parser.add_argument( "--general-stats", default="general_stats.tsv", help="Name of general statistics file to create." )
     parser.add_argument( "--sample-stats", default="sample_stats.tsv", help="Name of sample statistics file to create." )
     parser.add_argument( "--minimum-coverage", type=int, default=10, help="Minimum coverage depth at a position." )
     parser.add_argument( "--minimum-proportion", type=float, default=0.9, help="Minimum proportion of reads that must match the call at a position." )
-    parser.add_argument( "--num-threads", type=int, default=1, help="Number of threads to use when processing input." )
+    parser.add_argument( "--num-threads", type=int, default=1, help="Number of threads to use when processing input and writing the matrices." )
     parser.add_argument( "--dto-file", help="Path to a matrix_dto XML file that defines all the parameters." )
-    return parser.parse_args()
+    parser.add_argument( "--stats-snapshot", help="Path to a binary statistics snapshot to write alongside the statistics files, for merge_stats_snapshots.py to add to those of other partial runs." )
+    input_reuse = parser.add_mutually_exclusive_group()
+    input_reuse.add_argument( "--input-cache", help="Path to a folder to keep parsed inputs in, so later runs map the ones that have not changed instead of parsing them again. Not used with --streaming or --by-contig." )
+    input_reuse.add_argument( "--run-data", help="Path to a folder to keep the input list and parsed inputs of this run in, so samples can be added to it later with --update-run. Not used with --streaming or --by-contig." )
+    parser.add_argument( "--input-cache-size", type=int, default=10240, help="Size in megabytes the input cache is trimmed to after a run, least recently used inputs first." )
+    parser.add_argument( "--update-run", action="store_true", help="Add the inputs of the earlier run kept in --run-data to --input-files. Only the new and changed inputs are parsed." )
+    parser.add_argument( "--regions", help="Path to a BED file of the regions to restrict the matrices and statistics to. VCF records outside of them are not imported." )
+    execution_mode = parser.add_mutually_exclusive_group()
+    execution_mode.add_argument( "--streaming", action="store_true", help="Merge coordinate-sorted inputs position by position instead of loading whole genomes into memory. Matrix lines follow the contig order of the reference fasta. Inputs that can not be read are reported as failed only if the problem is in their header or first block; one further in stops the run." )
+    execution_mode.add_argument( "--by-contig", action="store_true", help="Load, write out and release one contig of every input at a time instead of loading whole genomes into memory. Inputs do not need to be sorted." )
+    commandline_args = parser.parse_args()
+    if commandline_args.update_run and not commandline_args.run_data:
+        parser.error( "--update-run needs the --run-data folder of the run to update" )
+    if commandline_args.run_data and ( commandline_args.streaming or commandline_args.by_contig ):
+        parser.error( "--run-data can not be used with --streaming or --by-contig" )
+    if commandline_args.matrix_columns and ( commandline_args.streaming or commandline_args.by_contig ):
+        parser.error( "--matrix-columns can not be used with --streaming or --by-contig" )
+    if commandline_args.matrix_index and ( commandline_args.streaming or commandline_args.by_contig ):
+        parser.error( "--matrix-index can not be used with --streaming or --by-contig" )
+    return commandline_args
 
 def _parse_input_config(commandline_args):
     import matrix_DTO
     (matrix_parms, input_files) = matrix_DTO.parse_dto(commandline_args.dto_file)
     commandline_args.reference_fasta = matrix_parms['reference-fasta']
     commandline_args.reference_dups = matrix_parms['reference-dups']
+    if "reference-pack" in matrix_parms:
+        commandline_args.reference_pack = matrix_parms['reference-pack']
     commandline_args.master_matrix = matrix_parms['master-matrix']
     commandline_args.filter_matrix = matrix_parms['filter-matrix']
     commandline_args.general_stats = matrix_parms['general-stats']
@@ -38,74 +62,320 @@ def _parse_input_config(commandline_args):
     commandline_args.minimum_proportion = float(matrix_parms['minimum-proportion']) if "minimum-proportion" in matrix_parms else 0
     if "filter-matrix-format" in matrix_parms:
         commandline_args.filter_matrix_format = matrix_parms['filter-matrix-format']
+    if "regions" in matrix_parms:
+        commandline_args.regions = matrix_parms['regions']
+    if "input-cache" in matrix_parms:
+        commandline_args.input_cache = matrix_parms['input-cache']
+    if "matrix-columns" in matrix_parms:
+        commandline_args.matrix_columns = matrix_parms['matrix-columns']
+    if "matrix-index" in matrix_parms:
+        commandline_args.matrix_index = matrix_parms['matrix-index']
+    if "stats-snapshot" in matrix_parms:
+        commandline_args.stats_snapshot = matrix_parms['stats-snapshot']
     commandline_args.input_files = input_files
     return commandline_args
 
-def import_reference( reference, reference_path, dups_path ):
-    reference.import_fasta_file( reference_path )
+def import_reference( reference, reference_path, dups_path, pack_path = None ):
+    # An explicit dups file takes the place of any dups data in the pack, which may have been made from an older one
+    if pack_path is not None:
+        reference.import_genome_pack( pack_path, dups_path is None )
+    elif not reference.import_indexed_fasta_file( reference_path ):
+        reference.import_fasta_file( reference_path )
     if dups_path is not None:
         reference.import_dups_file( dups_path )
     #from sys import stdout
-    #reference._genome._send_to_fasta_handle( stdout )
-    #reference._dups._send_to_fasta_handle( stdout )
+    #reference._genome._send_to_fasta_handle( stdout.buffer )
+    #reference._dups._send_to_fasta_handle( stdout.buffer )
 
 def import_external_fasta( input_file ):
     from nasp_objects import FastaGenome
     genome = FastaGenome()
     set_genome_metadata( genome, input_file )
-    genome.import_fasta_file( genome.file_path(), "franken::" )
+    if not genome.import_indexed_fasta_file( genome.file_path(), "franken::" ):
+        genome.import_fasta_file( genome.file_path(), "franken::" )
     #from sys import stdout
-    #genome._genome._send_to_fasta_handle( stdout )
+    #genome._genome._send_to_fasta_handle( stdout.buffer )
     return [ genome ]
 
 # FIXME split into a larger number of smaller more testable functions
 # FIXME This belongs in VCFGenome object perhaps?
-def read_vcf_file( reference, min_coverage, min_proportion, input_file ):
+# Records outside of regions, a GenomeRegions, are skipped if it is given.
+def read_vcf_file( reference, min_coverage, min_proportion, input_file, regions = None ):
     genomes = {}
     file_path = get_file_path( input_file )
     with open( file_path, 'r' ) as vcf_filehandle:
-        from nasp_objects import VCFGenome, Genome, ReferenceCallMismatch, VCFRecord
+        from nasp_objects import VCFGenome, VCFRecord
+        contig_type = get_vcf_contig_type( reference, file_path )
         #import vcf
-        vcf_record = VCFRecord( file_path )
+        vcf_record = VCFRecord( file_path, get_snpcaller_name( input_file ) )
+        if regions is not None:
+            vcf_record.set_regions( regions )
         #vcf_data_handle = vcf.Reader( vcf_filehandle )
         vcf_samples = vcf_record.get_samples()
         #print( vcf_samples )
         for vcf_sample in vcf_samples:
-            genomes[vcf_sample] = VCFGenome()
+            genomes[vcf_sample] = VCFGenome( contig_type )
             set_genome_metadata( genomes[vcf_sample], input_file )
             genomes[vcf_sample].set_nickname( vcf_sample )
-        while vcf_record.fetch_next_record():
-            current_contig = vcf_record.get_contig()
-            current_pos = vcf_record.get_position()
-            if current_pos <= reference.get_contig_length( current_contig ):
-                reference_call = reference.get_call( current_pos, None, current_contig )
-                simplified_refcall = Genome.simple_call( reference_call )
-                if ( simplified_refcall != 'N' ) and ( simplified_refcall != Genome.simple_call( vcf_record.get_reference_call()[0] ) ):
-                    raise ReferenceCallMismatch( reference_call, vcf_record.get_reference_call(), file_path, current_contig, current_pos )
-                for vcf_sample in vcf_samples:
-                    sample_info = vcf_record.get_sample_info( vcf_sample )
-                    # FIXME indels
-                    if sample_info['call'] is not None:
-                        genomes[vcf_sample].set_call( sample_info['call'], current_pos, 'X', current_contig )
-                    if sample_info['was_called']:
-                        genomes[vcf_sample].set_was_called( 'Y', current_pos, current_contig )
-                    if sample_info['coverage'] is not None:
-                        if sample_info['coverage'] >= min_coverage:
-                            genomes[vcf_sample].set_coverage_pass( 'Y', current_pos, current_contig )
-                        else:
-                            genomes[vcf_sample].set_coverage_pass( 'N', current_pos, current_contig )
-                    if sample_info['proportion'] is not None:
-                        if sample_info['proportion'] >= min_proportion:
-                            genomes[vcf_sample].set_proportion_pass( 'Y', current_pos, current_contig )
-                        else:
-                            genomes[vcf_sample].set_proportion_pass( 'N', current_pos, current_contig )
-                    elif not sample_info['is_a_snp']:
-                        genomes[vcf_sample].set_proportion_pass( '-', current_pos, current_contig )
+            genomes[vcf_sample].allocate_contigs( reference )
+        import_vcf_record_blocks( reference, min_coverage, min_proportion, vcf_record, [ genomes[vcf_sample] for vcf_sample in vcf_samples ], file_path, {} )
     #from sys import stdout
     #for genome in genomes:
-    #    genomes[genome]._genome._send_to_fasta_handle( stdout )
+    #    genomes[genome]._genome._send_to_fasta_handle( stdout.buffer )
     return genomes.values()
 
+# Lines are parsed a block at a time, with only the fields the matrix needs pulled out of each one,
+# and then every sample's values for the whole block are packed and written as one column.
+# sample_genomes are in the sample order of the VCF. written_positions is passed on to get_block_record_runs().
+def import_vcf_record_blocks( reference, min_coverage, min_proportion, vcf_record, sample_genomes, file_path, written_positions ):
+    from nasp_objects import VCFGenome
+    record_block = vcf_record.fetch_record_block()
+    while record_block is not None:
+        ( record_runs, rewritten_records, accepted_records ) = get_block_record_runs( reference, record_block, file_path, written_positions )
+        run_records = accepted_records.difference( rewritten_records )
+        for sample_index in range( len( sample_genomes ) ):
+            genome = sample_genomes[sample_index]
+            ( packed_values, escaped_records ) = VCFGenome.pack_record_column( record_block, sample_index, min_coverage, min_proportion )
+            for ( current_contig, first_position, first_record, last_record ) in record_runs:
+                genome.set_packed_values( first_position, packed_values[first_record:last_record], current_contig )
+            for record_index in escaped_records:
+                if record_index in run_records:
+                    genome.set_values( record_block.positions[record_index], record_block.calls[sample_index][record_index], None, None, None, contig_name=record_block.contigs[record_index] )
+            for record_index in rewritten_records:
+                # FIXME indels
+                genome.set_values( record_block.positions[record_index], *get_block_sample_values( record_block, sample_index, record_index, min_coverage, min_proportion ), contig_name=record_block.contigs[record_index] )
+        record_block = vcf_record.fetch_record_block()
+
+# Checks every line of a block against the reference once for all samples, and sorts the lines to keep into
+# runs of consecutive positions that nothing has been written to yet, as ( contig, first position, first line, last line + 1 ),
+# and lines that land on an already written position and have to be merged into it one at a time.
+# The set of every line kept is returned too; lines past the end of their contig, or on a contig the reference
+# does not have, are in none of the three and must not be written at all.
+# written_positions holds the last position written on each contig, carried from block to block.
+def get_block_record_runs( reference, record_block, file_path, written_positions ):
+    record_runs = []
+    rewritten_records = []
+    accepted_records = set()
+    contig_lengths = {}
+    for record_index in range( record_block.get_record_count() ):
+        current_contig = record_block.contigs[record_index]
+        current_pos = record_block.positions[record_index]
+        if current_contig not in contig_lengths:
+            contig_lengths[current_contig] = reference.get_contig_length( current_contig )
+        if current_pos <= contig_lengths[current_contig]:
+            check_reference_call( reference, record_block.reference_calls[record_index], file_path, current_contig, current_pos )
+            accepted_records.add( record_index )
+            if current_pos > written_positions.get( current_contig, 0 ):
+                written_positions[current_contig] = current_pos
+                if len( record_runs ) > 0 and record_runs[-1][0] == current_contig and record_runs[-1][1] + ( record_index - record_runs[-1][2] ) == current_pos and record_runs[-1][3] == record_index:
+                    record_runs[-1][3] = record_index + 1
+                else:
+                    record_runs.append( [ current_contig, current_pos, record_index, record_index + 1 ] )
+            else:
+                rewritten_records.append( record_index )
+    return ( record_runs, rewritten_records, accepted_records )
+
+# A VCF this small next to its reference can only carry scattered sites, which are cheaper to hold as runs.
+# At well over 4 bytes per record, the runs never take more memory than the dense contigs would.
+# The size of a compressed VCF says too little about its record count, so those always get dense contigs.
+def get_vcf_contig_type( reference, file_path ):
+    import os
+    from nasp_objects import RunLengthContig, get_input_compression
+    reference_length = sum( reference.get_contig_length( current_contig ) for current_contig in reference.get_contigs() )
+    if get_input_compression( file_path ) is None and os.path.getsize( file_path ) * 4 < reference_length:
+        return RunLengthContig
+    return bytearray
+
+def check_reference_call( reference, vcf_reference_call, file_path, current_contig, current_pos ):
+    from nasp_objects import Genome, ReferenceCallMismatch
+    reference_call = reference.get_call( current_pos, None, current_contig )
+    simplified_refcall = Genome.simple_call( reference_call )
+    if ( simplified_refcall != 'N' ) and ( simplified_refcall != Genome.simple_call( vcf_reference_call[0] ) ):
+        raise ReferenceCallMismatch( reference_call, vcf_reference_call, file_path, current_contig, current_pos )
+
+# Returns the call, was_called, coverage_pass and proportion_pass values for one sample of a VCF record.
+# None means the record says nothing about that data and the existing value should be left alone.
+def get_sample_values( sample_info, min_coverage, min_proportion ):
+    was_called = None
+    coverage_pass = None
+    proportion_pass = None
+    if sample_info['was_called']:
+        was_called = 'Y'
+    if sample_info['coverage'] is not None:
+        if sample_info['coverage'] >= min_coverage:
+            coverage_pass = 'Y'
+        else:
+            coverage_pass = 'N'
+    if sample_info['proportion'] is not None:
+        if sample_info['proportion'] >= min_proportion:
+            proportion_pass = 'Y'
+        else:
+            proportion_pass = 'N'
+    elif not sample_info['is_a_snp']:
+        proportion_pass = '-'
+    return ( sample_info['call'], was_called, coverage_pass, proportion_pass )
+
+# Same as get_sample_values(), for one sample of one line of a VCFRecordBlock.
+def get_block_sample_values( record_block, sample_index, record_index, min_coverage, min_proportion ):
+    import math
+    sample_call = record_block.calls[sample_index][record_index]
+    sample_coverage = record_block.coverages[sample_index][record_index]
+    sample_proportion = record_block.proportions[sample_index][record_index]
+    was_called = None
+    coverage_pass = None
+    proportion_pass = None
+    if sample_call is not None and sample_call != 'N':
+        was_called = 'Y'
+    if not math.isnan( sample_coverage ):
+        if sample_coverage >= min_coverage:
+            coverage_pass = 'Y'
+        else:
+            coverage_pass = 'N'
+    if not math.isnan( sample_proportion ):
+        if sample_proportion >= min_proportion:
+            proportion_pass = 'Y'
+        else:
+            proportion_pass = 'N'
+    elif not record_block.snps[sample_index][record_index]:
+        proportion_pass = '-'
+    return ( sample_call, was_called, coverage_pass, proportion_pass )
+
+def stream_vcf_file( reference, min_coverage, min_proportion, input_file, regions = None ):
+    from nasp_objects import VCFGenomeWindow, VCFRecord
+    file_path = get_file_path( input_file )
+    vcf_record = VCFRecord( file_path, get_snpcaller_name( input_file ) )
+    if regions is not None:
+        vcf_record.set_regions( regions )
+    genome_windows = []
+    for vcf_sample in vcf_record.get_samples():
+        genome_window = VCFGenomeWindow()
+        set_genome_metadata( genome_window, input_file )
+        genome_window.set_nickname( vcf_sample )
+        genome_windows.append( genome_window )
+    return ( genome_windows, _generate_vcf_records( reference, min_coverage, min_proportion, vcf_record, file_path ) )
+
+# Every line of a block is checked against the reference before any of them is yielded.
+def _generate_vcf_records( reference, min_coverage, min_proportion, vcf_record, file_path ):
+    reference_contigs = set( reference.get_contigs() )
+    sample_count = len( vcf_record.get_samples() )
+    record_block = vcf_record.fetch_record_block()
+    while record_block is not None:
+        accepted_records = []
+        for record_index in range( record_block.get_record_count() ):
+            current_contig = record_block.contigs[record_index]
+            current_pos = record_block.positions[record_index]
+            if ( current_contig in reference_contigs ) and ( current_pos <= reference.get_contig_length( current_contig ) ):
+                check_reference_call( reference, record_block.reference_calls[record_index], file_path, current_contig, current_pos )
+                accepted_records.append( record_index )
+        for record_index in accepted_records:
+            yield ( record_block.contigs[record_index], record_block.positions[record_index], [ get_block_sample_values( record_block, sample_index, record_index, min_coverage, min_proportion ) for sample_index in range( sample_count ) ] )
+        record_block = vcf_record.fetch_record_block()
+
+def stream_external_fasta( reference, input_file ):
+    from nasp_objects import FastaGenomeWindow
+    genome_window = FastaGenomeWindow()
+    set_genome_metadata( genome_window, input_file )
+    contig_offsets = _index_fasta_contigs( genome_window.file_path(), "franken::" )
+    return ( [ genome_window ], _generate_fasta_records( reference, genome_window.file_path(), contig_offsets, "franken::" ) )
+
+def _match_fasta_header( line_from_fasta, contig_prefix ):
+    import re
+    return re.match( r'^>' + re.escape( contig_prefix ) + r'([^\s]+)(?:\s|$)', line_from_fasta.decode( 'latin-1' ) )
+
+# Finds where the sequence data of every contig starts, so contigs can be read back in whatever order the reference wants them.
+# Offsets into compressed files are offsets into their inflated data. A usable .fai index saves reading the file for them.
+def _index_fasta_contigs( fasta_path, contig_prefix = "" ):
+    from nasp_objects import Genome, open_input_file
+    fasta_index = Genome.read_fasta_index( fasta_path, contig_prefix )
+    if fasta_index is not None:
+        return { index_entry[0]: [ index_entry[2] ] for index_entry in fasta_index }
+    contig_offsets = {}
+    current_offset = 0
+    with open_input_file( fasta_path, seekable=True ) as fasta_handle:
+        for line_from_fasta in fasta_handle:
+            current_offset += len( line_from_fasta )
+            if line_from_fasta.startswith( b'>' ):
+                contig_match = _match_fasta_header( line_from_fasta, contig_prefix )
+                if contig_match:
+                    contig_offsets.setdefault( contig_match.group(1), [] ).append( current_offset )
+    return contig_offsets
+
+# Yields the sequence lines of one contig, from each of its sections in turn.
+# A contig that shows up more than once continues where its previous section left off, as it does in import_fasta_file().
+def _read_fasta_contig_lines( fasta_handle, data_offsets, contig_prefix = "" ):
+    import re
+    for data_offset in data_offsets:
+        fasta_handle.seek( data_offset )
+        line_from_fasta = fasta_handle.readline()
+        while line_from_fasta and not ( line_from_fasta.startswith( b'>' ) and _match_fasta_header( line_from_fasta, contig_prefix ) ):
+            data_match = re.match( rb'^([A-Za-z.-]+)\s*$', line_from_fasta )
+            if data_match:
+                yield data_match.group(1)
+            line_from_fasta = fasta_handle.readline()
+
+# Yields the sequence lines of every contig the reference knows about, in reference order.
+def _generate_fasta_records( reference, fasta_path, contig_offsets, contig_prefix = "" ):
+    from nasp_objects import open_input_file
+    with open_input_file( fasta_path, seekable=True ) as fasta_handle:
+        for current_contig in reference.get_contigs( False ):
+            current_pos = 1
+            for sequence_data in _read_fasta_contig_lines( fasta_handle, contig_offsets.get( current_contig, [] ), contig_prefix ):
+                yield ( current_contig, current_pos, sequence_data )
+                current_pos += len( sequence_data )
+
+# Contig-at-a-time counterpart of import_external_fasta(). Returns the genome and a generator that loads it one contig at
+# a time, in reference contig order, and drops each contig again before loading the next; see write_contig_matrices().
+# An indexed frankenfasta is mapped instead, which already only reads the contig being written out.
+def open_external_fasta_contigs( reference, input_file ):
+    from nasp_objects import FastaGenome
+    genome = FastaGenome()
+    set_genome_metadata( genome, input_file )
+    if genome.import_indexed_fasta_file( genome.file_path(), "franken::" ):
+        return ( [ genome ], ( current_contig for current_contig in reference.get_contigs() ) )
+    contig_offsets = _index_fasta_contigs( genome.file_path(), "franken::" )
+    return ( [ genome ], _load_fasta_contigs( reference, genome, contig_offsets, "franken::" ) )
+
+def _load_fasta_contigs( reference, genome, contig_offsets, contig_prefix ):
+    from nasp_objects import open_input_file
+    with open_input_file( genome.file_path(), seekable=True ) as fasta_handle:
+        for current_contig in reference.get_contigs():
+            genome.add_contig( current_contig )
+            for sequence_data in _read_fasta_contig_lines( fasta_handle, contig_offsets.get( current_contig, [] ), contig_prefix ):
+                genome.append_contig( sequence_data, current_contig )
+            yield current_contig
+            genome.remove_contig( current_contig )
+
+# Contig-at-a-time counterpart of read_vcf_file(). A single pre-pass finds the sections of the file each contig's records
+# are in, and the generator returned with the sample genomes loads them from there one contig at a time.
+def open_vcf_contigs( reference, min_coverage, min_proportion, input_file, regions = None ):
+    from nasp_objects import VCFGenome, VCFRecord
+    file_path = get_file_path( input_file )
+    contig_type = get_vcf_contig_type( reference, file_path )
+    vcf_record = VCFRecord( file_path, get_snpcaller_name( input_file ), seekable=True )
+    contig_sections = vcf_record.get_contig_sections()
+    if regions is not None:
+        vcf_record.set_regions( regions )
+        contig_sections = dict( ( contig_name, contig_sections[contig_name] ) for contig_name in contig_sections if len( regions.get_contig_regions( contig_name ) ) > 0 )
+    sample_genomes = []
+    for vcf_sample in vcf_record.get_samples():
+        genome = VCFGenome( contig_type )
+        set_genome_metadata( genome, input_file )
+        genome.set_nickname( vcf_sample )
+        sample_genomes.append( genome )
+    return ( sample_genomes, _load_vcf_contigs( reference, min_coverage, min_proportion, vcf_record, sample_genomes, contig_sections, file_path ) )
+
+def _load_vcf_contigs( reference, min_coverage, min_proportion, vcf_record, sample_genomes, contig_sections, file_path ):
+    for current_contig in reference.get_contigs():
+        for genome in sample_genomes:
+            genome.allocate_contigs( reference, [ current_contig ] )
+        written_positions = {}
+        for ( section_offset, line_count ) in contig_sections.get( current_contig, [] ):
+            vcf_record.set_record_section( section_offset, line_count )
+            import_vcf_record_blocks( reference, min_coverage, min_proportion, vcf_record, sample_genomes, file_path, written_positions )
+        yield current_contig
+        for genome in sample_genomes:
+            genome.remove_contig( current_contig )
+
 # FIXME These three functions should be combined?
 def determine_file_type( input_file ):
     import re
@@ -128,6 +398,17 @@ def get_file_path( input_file ):
     #print( file_path )
     return file_path
 
+# The snpcaller is the second generator of a 'vcf,aligner,snpcaller,::path' input, used to pick the VCF record dialect.
+def get_snpcaller_name( input_file ):
+    import re
+    snpcaller_name = None
+    filename_match = re.match( r'^((?:[^,:]+,)+)::.*$', input_file )
+    if filename_match:
+        generator_array = filename_match.group(1).split( ',' )
+        if generator_array[0] == "vcf" and len( generator_array ) > 3:
+            snpcaller_name = generator_array[2]
+    return snpcaller_name
+
 def set_genome_metadata( genome, input_file ):
     import re
     filename_match = re.match( r'^((?:[^,:]+,)+)::(.*)$', input_file )
@@ -140,7 +421,44 @@ def set_genome_metadata( genome, input_file ):
         genome.set_file_path( input_file )
     #print( genome.identifier() )
 
-def manage_input_thread( reference, min_coverage, min_proportion, input_q, output_q ):
+# Parsed genomes go back to the parent as track files in a shared folder, so only a small handle crosses the queue.
+def write_genome_tracks( genome, track_folder ):
+    import tempfile
+    import os
+    ( track_handle, track_filename ) = tempfile.mkstemp( suffix=".tracks", dir=track_folder )
+    os.close( track_handle )
+    genome.write_to_track_file( track_filename )
+    return ( genome.__class__.__name__, track_filename )
+
+# The parent maps the tracks instead of unpickling them. Unless the file is kept, E.G. in the input cache, it is removed
+# straight away; the mapping outlives it.
+def read_genome_tracks( genome_tracks, keep_tracks = False ):
+    import nasp_objects
+    import os
+    ( genome_class, track_filename ) = genome_tracks
+    genome = getattr( nasp_objects, genome_class )()
+    genome.import_track_file( track_filename )
+    if not keep_tracks:
+        os.remove( track_filename )
+    return genome
+
+# Everything besides the input file itself that changes what parsing it gives. Frankenfasta files do not depend on the
+# reference or the filters, so changing those does not throw their cached tracks away.
+def get_parse_settings( input_file, reference_digest, min_coverage, min_proportion, regions = None ):
+    parse_settings = { 'version': __version__, 'input_file': input_file }
+    if determine_file_type( input_file ) == "vcf":
+        parse_settings['reference'] = reference_digest
+        parse_settings['minimum_coverage'] = min_coverage
+        parse_settings['minimum_proportion'] = min_proportion
+        if regions is not None:
+            parse_settings['regions'] = [ [ contig_name, regions.get_contig_regions( contig_name ) ] for contig_name in regions.get_contigs() ]
+    return parse_settings
+
+# Workers map the reference from a genome pack instead of being handed a copy, so they all share one read-only copy of its pages.
+def manage_input_thread( reference_pack, min_coverage, min_proportion, input_q, output_q, track_folder, regions = None ):
+    from nasp_objects import ReferenceGenome
+    reference = ReferenceGenome()
+    reference.import_genome_pack( reference_pack )
     input_file = input_q.get()
     while input_file is not None:
         try:
@@ -149,9 +467,8 @@ def manage_input_thread( reference, min_coverage, min_proportion, input_q, outpu
             if file_type == "frankenfasta":
                 new_genomes = import_external_fasta( input_file )
             elif file_type == "vcf":
-                new_genomes = read_vcf_file( reference, min_coverage, min_proportion, input_file )
-            for new_genome in new_genomes:
-                output_q.put( new_genome )
+                new_genomes = read_vcf_file( reference, min_coverage, min_proportion, input_file, regions )
+            output_q.put( ( input_file, [ write_genome_tracks( new_genome, track_folder ) for new_genome in new_genomes ] ) )
         except:
             failed_file_path = get_file_path( input_file )
             logging.exception( "Unable to read in data from '{0}'!".format( failed_file_path ) )
@@ -159,42 +476,154 @@ def manage_input_thread( reference, min_coverage, min_proportion, input_q, outpu
         input_file = input_q.get()
     output_q.put( None )
 
-def parse_input_files( input_files, num_threads, genomes, min_coverage, min_proportion ):
+def get_input_file_size( input_file ):
+    import os
+    try:
+        return os.path.getsize( get_file_path( input_file ) )
+    except OSError:
+        return 0
+
+# Inputs are handed out largest first, so the workers finish at about the same time instead of waiting on one big straggler.
+# With an input_cache, an InputCache, inputs that have not changed since they were cached are mapped from it instead of
+# being parsed, and the tracks of the rest are moved into it once they are read in.
+def parse_input_files( input_files, num_threads, genomes, min_coverage, min_proportion, input_cache = None ):
     from multiprocessing import Process, Queue
     #from queue import Queue
-    from time import sleep
+    import tempfile
+    import shutil
+    import os
+    entry_keys = {}
+    if input_cache is not None:
+        reference_digest = genomes.reference().get_content_digest()
+        uncached_files = []
+        for input_file in input_files:
+            entry_key = input_cache.get_entry_key( get_file_path( input_file ), get_parse_settings( input_file, reference_digest, min_coverage, min_proportion, genomes.regions() ) )
+            cached_tracks = input_cache.get_entry( entry_key ) if entry_key is not None else None
+            if cached_tracks is None:
+                entry_keys[input_file] = entry_key
+                uncached_files.append( input_file )
+            else:
+                for genome_tracks in cached_tracks:
+                    genomes.add_genome( read_genome_tracks( genome_tracks, True ) )
+        input_files = uncached_files
     input_q = Queue()
     output_q = Queue()
-    for input_file in input_files:
+    for input_file in sorted( input_files, key=get_input_file_size, reverse=True ):
         input_q.put( input_file )
-    if num_threads > input_q.qsize():
-        num_threads = input_q.qsize()
-    sleep( 1 )
-    thread_list = []
-    for current_thread in range( num_threads ):
-        input_q.put( None )
-        current_thread = Process( target=manage_input_thread, args=[ genomes.reference(), min_coverage, min_proportion, input_q, output_q ] )
-        current_thread.start()
-        #manage_input_thread( genomes.reference(), min_coverage, min_proportion, input_q, output_q )
-        thread_list.append( current_thread )
-    sleep( 1 )
-    while num_threads > 0:
-        new_genome = output_q.get()
-        if new_genome is None:
-            num_threads -= 1
-        elif isinstance( new_genome, str ):
-            genomes.add_failed_genome( new_genome )
-        else:
-            genomes.add_genome( new_genome )
-    sleep( 1 )
-    for current_thread in thread_list:
-        current_thread.join()
+    if num_threads > len( input_files ):
+        num_threads = len( input_files )
+    track_folder = tempfile.mkdtemp( prefix="genome_tracks_", dir=( input_cache.cache_folder() if input_cache is not None else None ) )
+    try:
+        # A reference that was mapped from a pack is shared as is; the workers never look at its dups
+        reference_pack = genomes.reference().get_genome_pack()
+        if reference_pack is None and num_threads > 0:
+            reference_pack = os.path.join( track_folder, "reference.pack" )
+            genomes.reference().write_to_genome_pack( reference_pack )
+        thread_list = []
+        for current_thread in range( num_threads ):
+            input_q.put( None )
+            current_thread = Process( target=manage_input_thread, args=[ reference_pack, min_coverage, min_proportion, input_q, output_q, track_folder, genomes.regions() ] )
+            current_thread.start()
+            #manage_input_thread( reference_pack, min_coverage, min_proportion, input_q, output_q, track_folder, genomes.regions() )
+            thread_list.append( current_thread )
+        # Every worker sends a None once it runs out of inputs, so nothing is left on the queue to wait for after that
+        while num_threads > 0:
+            new_genome = output_q.get()
+            if new_genome is None:
+                num_threads -= 1
+            elif isinstance( new_genome, str ):
+                genomes.add_failed_genome( new_genome )
+            else:
+                ( input_file, genome_tracks ) = new_genome
+                entry_key = entry_keys.get( input_file )
+                for current_tracks in genome_tracks:
+                    genomes.add_genome( read_genome_tracks( current_tracks, entry_key is not None ) )
+                if entry_key is not None:
+                    input_cache.add_entry( entry_key, genome_tracks )
+        for current_thread in thread_list:
+            current_thread.join()
+    finally:
+        shutil.rmtree( track_folder, ignore_errors=True )
+
+def write_output_matrices( genomes, master_matrix, filter_matrix, matrix_format, num_threads = 1, matrix_columns = None, matrix_index = None ):
+    genomes.write_to_matrices( master_matrix, filter_matrix, matrix_format, num_threads, matrix_columns, matrix_index )
+
+# A run data folder is an InputCache holding the parsed inputs of one run, plus the list of those inputs.
+RUN_INPUTS_FILENAME = "run_inputs.json"
+
+def read_run_inputs( run_folder ):
+    import json
+    import os
+    run_inputs_path = os.path.join( run_folder, RUN_INPUTS_FILENAME )
+    if not os.path.exists( run_inputs_path ):
+        return []
+    with open( run_inputs_path ) as run_inputs_handle:
+        return json.load( run_inputs_handle )
 
-def write_output_matrices( genomes, master_matrix, filter_matrix, matrix_format ):
-    genomes.write_to_matrices( master_matrix, filter_matrix, matrix_format )
+def write_run_inputs( run_folder, input_files ):
+    import json
+    import os
+    run_inputs_path = os.path.join( run_folder, RUN_INPUTS_FILENAME )
+    temporary_path = run_inputs_path + ".tmp{0}".format( os.getpid() )
+    with open( temporary_path, 'w' ) as run_inputs_handle:
+        json.dump( input_files, run_inputs_handle, indent=1 )
+    os.replace( temporary_path, run_inputs_path )
 
-def write_stats_data( genomes, general_stats, sample_stats ):
+# Streaming counterpart of parse_input_files() and write_output_matrices().
+# Inputs must be sorted in reference order; only a block of positions per sample is held in memory at a time.
+# The header and first block of every input are read before anything is written, so inputs that fail there are still
+# reported as failed; a problem that only turns up further into an input stops the run instead.
+def write_streamed_matrices( input_files, genomes, min_coverage, min_proportion, master_matrix, filter_matrix, matrix_format ):
+    import itertools
+    input_streams = []
+    for input_file in input_files:
+        try:
+            file_type = determine_file_type( input_file )
+            input_stream = None
+            if file_type == "frankenfasta":
+                input_stream = stream_external_fasta( genomes.reference(), input_file )
+            elif file_type == "vcf":
+                input_stream = stream_vcf_file( genomes.reference(), min_coverage, min_proportion, input_file, genomes.regions() )
+            if input_stream is not None:
+                ( genome_windows, stream_records ) = input_stream
+                first_record = next( stream_records, None )
+                if first_record is not None:
+                    stream_records = itertools.chain( [ first_record ], stream_records )
+                input_streams.append( ( genome_windows, stream_records ) )
+        except:
+            failed_file_path = get_file_path( input_file )
+            logging.exception( "Unable to read in data from '{0}'!".format( failed_file_path ) )
+            genomes.add_failed_genome( failed_file_path )
+    for ( genome_windows, stream_records ) in input_streams:
+        for genome_window in genome_windows:
+            genomes.add_genome( genome_window )
+    genomes.write_streamed_matrices( master_matrix, filter_matrix, matrix_format, input_streams )
+
+# Contig-at-a-time counterpart of parse_input_files() and write_output_matrices(), for references too big to hold every
+# sample's whole genome at once. Inputs are indexed up front, so ones that can not be read are still reported as failed;
+# a problem that only turns up while a later contig is loaded stops the run instead.
+def write_contig_matrices( input_files, genomes, min_coverage, min_proportion, master_matrix, filter_matrix, matrix_format ):
+    contig_streams = []
+    for input_file in input_files:
+        try:
+            file_type = determine_file_type( input_file )
+            if file_type == "frankenfasta":
+                contig_streams.append( open_external_fasta_contigs( genomes.reference(), input_file ) )
+            elif file_type == "vcf":
+                contig_streams.append( open_vcf_contigs( genomes.reference(), min_coverage, min_proportion, input_file, genomes.regions() ) )
+        except:
+            failed_file_path = get_file_path( input_file )
+            logging.exception( "Unable to read in data from '{0}'!".format( failed_file_path ) )
+            genomes.add_failed_genome( failed_file_path )
+    for ( contig_genomes, contig_loads ) in contig_streams:
+        for genome in contig_genomes:
+            genomes.add_genome( genome )
+    genomes.write_contig_matrices( master_matrix, filter_matrix, matrix_format, contig_streams )
+
+def write_stats_data( genomes, general_stats, sample_stats, stats_snapshot = None ):
     genomes.write_to_stats_files( general_stats, sample_stats )
+    if stats_snapshot:
+        genomes.write_stats_snapshot( stats_snapshot )
 
 
 def main():
@@ -204,12 +633,38 @@ def main():
     logging.basicConfig( level=logging.WARNING )
     from nasp_objects import ReferenceGenome, GenomeCollection
     reference = ReferenceGenome()
-    import_reference( reference, commandline_args.reference_fasta, commandline_args.reference_dups )
+    import_reference( reference, commandline_args.reference_fasta, commandline_args.reference_dups, commandline_args.reference_pack )
     genomes = GenomeCollection()
     genomes.set_reference( reference )
-    parse_input_files( commandline_args.input_files, commandline_args.num_threads, genomes, commandline_args.minimum_coverage, commandline_args.minimum_proportion )
-    write_output_matrices( genomes, commandline_args.master_matrix, commandline_args.filter_matrix, commandline_args.filter_matrix_format )
-    write_stats_data( genomes, commandline_args.general_stats, commandline_args.sample_stats )
+    if commandline_args.regions:
+        from nasp_objects import GenomeRegions
+        regions = GenomeRegions()
+        regions.import_bed_file( commandline_args.regions )
+        genomes.set_regions( regions )
+    if commandline_args.streaming:
+        write_streamed_matrices( commandline_args.input_files, genomes, commandline_args.minimum_coverage, commandline_args.minimum_proportion, commandline_args.master_matrix, commandline_args.filter_matrix, commandline_args.filter_matrix_format )
+    elif commandline_args.by_contig:
+        write_contig_matrices( commandline_args.input_files, genomes, commandline_args.minimum_coverage, commandline_args.minimum_proportion, commandline_args.master_matrix, commandline_args.filter_matrix, commandline_args.filter_matrix_format )
+    else:
+        from nasp_objects import InputCache
+        input_files = commandline_args.input_files or []
+        input_cache = None
+        if commandline_args.run_data:
+            # Inputs of the earlier run come first, so an updated run lists its samples like a full rerun would
+            input_cache = InputCache( commandline_args.run_data )
+            if commandline_args.update_run:
+                run_inputs = read_run_inputs( commandline_args.run_data )
+                input_files = run_inputs + [ input_file for input_file in input_files if input_file not in run_inputs ]
+        elif commandline_args.input_cache:
+            input_cache = InputCache( commandline_args.input_cache, commandline_args.input_cache_size * 1048576 )
+        parse_input_files( input_files, commandline_args.num_threads, genomes, commandline_args.minimum_coverage, commandline_args.minimum_proportion, input_cache )
+        if commandline_args.run_data:
+            write_run_inputs( commandline_args.run_data, input_files )
+            input_cache.evict_entries( True )
+        elif input_cache is not None:
+            input_cache.evict_entries()
+        write_output_matrices( genomes, commandline_args.master_matrix, commandline_args.filter_matrix, commandline_args.filter_matrix_format, commandline_args.num_threads, commandline_args.matrix_columns, commandline_args.matrix_index )
+    write_stats_data( genomes, commandline_args.general_stats, commandline_args.sample_stats, commandline_args.stats_snapshot )
 
 if __name__ == "__main__": main()
 